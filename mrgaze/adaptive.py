@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Deadline-driven quality control for live pupilometry
+
+Tracks a rolling mean of per-frame processing time (preprocessing and
+engine) and steps through a ladder of quality levels so that processing
+stays inside the camera frame period:
+
+  level 0 : configured downsampling, cascade every frame, full RANSAC budget
+  level 1 : cascade every 3rd frame, half RANSAC budget
+  level 2 : 1.5x downsampling, cascade every 5th frame
+  level 3 : 2x downsampling, cascade every 10th frame, minimal RANSAC budget
+
+Quality is degraded when the rolling mean exceeds the deadline and restored
+when there is comfortable headroom. Each adjustment is logged.
+
+Pupil centers and areas measured at a coarser downsampling are rescaled to
+the configured resolution by the caller (see Scale), so pupilometry units
+do not change when the level changes.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import collections
+
+# Quality ladder : (downsampling multiplier, cascade interval, RANSAC budget fraction)
+LEVELS = [
+    (1.0, 1, 1.0),
+    (1.0, 3, 0.5),
+    (1.5, 5, 0.5),
+    (2.0, 10, 0.0),
+]
+
+# Degrade above this fraction of the deadline, restore below
+DEGRADE_FRAC = 0.9
+RESTORE_FRAC = 0.5
+
+
+class DeadlineController(object):
+    '''
+    Adjust processing quality to keep frame time under a deadline
+
+    Arguments
+    ----
+    cfg : configuration object
+        Pipeline configuration. Its VIDEO.downsampling and PUPILFIT
+        budgets are taken as full quality and overwritten for each level.
+    deadline : float
+        Per-frame processing deadline in seconds
+    window : integer
+        Number of frames in the rolling mean, and the minimum number of
+        frames between adjustments
+    '''
+
+    def __init__(self, cfg, deadline, window=30):
+
+        self.deadline = deadline
+        self.window = window
+        self.level = 0
+
+        self._times = collections.deque(maxlen=window)
+        self._since_change = 0
+        self._since_detect = 0
+
+        self.Rebase(cfg)
+
+    def Rebase(self, cfg):
+        '''
+        Take full-quality settings from cfg and reapply the current level
+
+        Call after the configuration is reloaded.
+        '''
+
+        self._downsampling = cfg.getfloat('VIDEO', 'downsampling')
+        self._max_itts = cfg.getint('PUPILFIT', 'maxiterations')
+        self._max_refines = cfg.getint('PUPILFIT', 'maxrefinements')
+
+        self.Apply(cfg)
+
+    def Apply(self, cfg):
+        '''
+        Write the settings for the current level into cfg
+        '''
+
+        ds_mult, interval, budget = LEVELS[self.level]
+
+        self.interval = interval
+
+        cfg.set('VIDEO', 'downsampling', '%g' % (max(self._downsampling, 1.0) * ds_mult))
+        cfg.set('PUPILFIT', 'maxiterations', '%d' % max(1, int(round(self._max_itts * budget))))
+        cfg.set('PUPILFIT', 'maxrefinements', '%d' % max(1, int(round(self._max_refines * budget))))
+
+    def Scale(self):
+        '''
+        Factor converting pixels at the current level to full-quality pixels
+        '''
+
+        return LEVELS[self.level][0]
+
+    def Detect(self, blink):
+        '''
+        Whether to run the cascade detector on this frame
+
+        Detection runs every interval frames and always after a blink.
+        '''
+
+        if blink or self._since_detect + 1 >= self.interval:
+            self._since_detect = 0
+            return True
+
+        self._since_detect += 1
+        return False
+
+    def Update(self, dt, cfg):
+        '''
+        Add a frame processing time in seconds and adjust quality if needed
+
+        Returns
+        ----
+        changed : boolean
+            True if the level changed. Settings have been applied to cfg and
+            any cached ROI should be discarded.
+        '''
+
+        self._times.append(dt)
+        self._since_change += 1
+
+        if self._since_change < self.window:
+            return False
+
+        mean_dt = sum(self._times) / len(self._times)
+
+        if mean_dt > DEGRADE_FRAC * self.deadline and self.level < len(LEVELS) - 1:
+            new_level = self.level + 1
+        elif mean_dt < RESTORE_FRAC * self.deadline and self.level > 0:
+            new_level = self.level - 1
+        else:
+            return False
+
+        print('  Adaptive quality : level %d -> %d (mean frame %0.1f ms, deadline %0.1f ms)' % (
+            self.level, new_level, mean_dt * 1e3, self.deadline * 1e3))
+
+        self.level = new_level
+        self.Apply(cfg)
+
+        print('    downsampling %s, cascade every %d frames, RANSAC %s iterations / %s refinements' % (
+            cfg.get('VIDEO', 'downsampling'), self.interval,
+            cfg.get('PUPILFIT', 'maxiterations'), cfg.get('PUPILFIT', 'maxrefinements')))
+
+        self._times.clear()
+        self._since_change = 0
+        self._since_detect = 0
+
+        return True
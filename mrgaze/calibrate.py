@@ -28,10 +28,7 @@ import os
 import cv2
 import json
 import numpy as np
-import pylab as plt
-from skimage import filters, exposure
-from scipy import ndimage
-from mrgaze import moco, engine
+from mrgaze import moco, engine, utils
 
 
 def AutoCalibrate(ss_res_dir, cfg):
@@ -57,7 +54,7 @@ def AutoCalibrate(ss_res_dir, cfg):
 
     if not os.path.isfile(cal_pupils_csv):
         print('* Calibration pupilometry not found - returning')
-        return False
+        return np.array([]), (0.0, 0.0)
 
     # Read raw pupilometry data
     p = engine.ReadPupilometry(cal_pupils_csv)
@@ -72,24 +69,53 @@ def AutoCalibrate(ss_res_dir, cfg):
     ok = np.where(blink == 0)
     t, x, y = t[ok], px[ok], py[ok]
 
-    # Find spatial fixations and sort temporally
-    # Returns heatmap with axes
-    fixations, hmap, xedges, yedges = FindFixations(x, y, plims, sigma)
+    # Check for autocalibration problems
+    n_targets = targets.shape[0]
+
+    if cfg.get('CALIBRATION', 'fixmethod', fallback='heatmap') == 'cluster':
+
+        # Temporally ordered fixations from mean-shift clusters
+        fixations, stats = ClusterFixations(t, x, y,
+                                            cfg.getfloat('CALIBRATION', 'fixradius', fallback=3.0),
+                                            cfg.getfloat('CALIBRATION', 'fixdwell', fallback=0.5))
+
+        # Keep the run of fixations best matching the targets if there are more
+        if fixations.shape[0] > n_targets:
+            start = MatchFixations(fixations, targets, stats['confidence'],
+                                   cfg.getfloat('CALIBRATION', 'maxlooerror', fallback=0.1))
+            if start < 0:
+                return np.array([]), (0.0, 0.0)
+            keep = slice(start, start + n_targets)
+            fixations = fixations[keep]
+            stats = dict((k, v[keep]) for k, v in stats.items())
 
-    # Temporally sort fixations - required for matching to targets
-    fixations = SortFixations(t, x, y, fixations)
+        WriteFixationStats(ss_res_dir, stats)
+
+        # Heatmap for the calibration plot only
+        hmap, xedges, yedges = HeatMap(x, y, *HeatLimits(x, y, plims), sigma=sigma)
+
+    else:
+
+        # Find spatial fixations and sort temporally
+        # Returns heatmap with axes
+        fixations, hmap, xedges, yedges = FindFixations(x, y, plims, sigma)
+
+        # Temporally sort fixations - required for matching to targets
+        fixations = SortFixations(t, x, y, fixations)
 
     # Plot labeled calibration heatmap to results directory
     PlotCalibration(ss_res_dir, hmap, xedges, yedges, fixations)
 
-    # Check for autocalibration problems
-    n_targets = targets.shape[0]
     n_fixations = fixations.shape[0]
 
     if n_targets == n_fixations:
 
         # Compute calibration mapping video to gaze space
-        C = CalibrationModel(fixations, targets)
+        C, errors = ConfiguredModel(fixations, targets, cfg)
+        WriteModelErrors(ss_res_dir, errors)
+
+        if not C.any():
+            return np.array([]), (0.0, 0.0)
 
         # Determine central fixation coordinate in video space
         central_fix = CentralFixation(fixations, targets)
@@ -116,19 +142,12 @@ def FindFixations(x, y, plims=(5,95), sigma=2.0):
     Fixations returned are not time ordered
     '''
 
-    # Find robust ranges
-    xmin, xmax = np.percentile(x, plims)
-    ymin, ymax = np.percentile(y, plims)
-
-    # Expand bounding box by 30%
-    sf = 1.30
-    hx, hy = (xmax - xmin) * sf * 0.5, (ymax - ymin) * sf * 0.5
-    cx, cy = (xmin + xmax) * 0.5, (ymin + ymax) * 0.5
-    xmin, xmax = cx - hx, cx + hx
-    ymin, ymax = cy - hy, cy + hy
+    # Deferred imports - only needed once per calibration
+    from skimage import filters, exposure
+    from scipy import ndimage
 
     # Compute calibration video heatmap
-    hmap, xedges, yedges = HeatMap(x, y, (xmin, xmax), (ymin, ymax), sigma)
+    hmap, xedges, yedges = HeatMap(x, y, *HeatLimits(x, y, plims), sigma=sigma)
 
     # Heatmap dimensions
     # *** Note y/row, x/col ordering
@@ -175,6 +194,225 @@ def FindFixations(x, y, plims=(5,95), sigma=2.0):
     return fixations, hmap, xedges, yedges
 
 
+def HeatLimits(x, y, plims=(5,95)):
+    '''
+    Robust heatmap x and y limits - percentile range expanded by 30%
+    '''
+
+    # Find robust ranges
+    xmin, xmax = np.percentile(x, plims)
+    ymin, ymax = np.percentile(y, plims)
+
+    # Expand bounding box by 30%
+    sf = 1.30
+    hx, hy = (xmax - xmin) * sf * 0.5, (ymax - ymin) * sf * 0.5
+    cx, cy = (xmin + xmax) * 0.5, (ymin + ymax) * 0.5
+
+    return (cx - hx, cx + hx), (cy - hy, cy + hy)
+
+
+def ClusterFixations(t, x, y, bandwidth=3.0, min_dwell=0.5):
+    '''
+    Find fixations by mean-shift clustering of pupil centers with a temporal constraint
+
+    Alternative to FindFixations that does not depend on a fixed heatmap
+    resolution or on blob thresholds.
+
+    Samples are binned into a grid of quarter-bandwidth cells with integer
+    arithmetic. The mean-shift vector of every cell comes from Gaussian
+    blurred grid sums, so each mean-shift iteration is a table lookup for
+    all cells at once. Cells that converge to the same mode form a spatial
+    cluster.
+
+    The temporal constraint works on runs of consecutive samples with the
+    same cluster label. Runs shorter than min_dwell seconds (saccades,
+    brief excursions) are dropped. Runs of the same cluster that are next
+    to each other after this are merged into one fixation. A location
+    fixated again after another target is reported as a separate fixation.
+
+    Arguments
+    ----
+    t : float vector
+        Sample times in seconds (blinks removed)
+    x, y : float vectors
+        Pupil center timeseries in video pixels
+    bandwidth : float
+        Mean-shift Gaussian kernel sigma in pixels
+    min_dwell : float
+        Minimum fixation duration in seconds
+
+    Returns
+    ----
+    fixations : n x 2 float array
+        Fixation centroids in temporal order
+    stats : dict of n vectors
+        't_start', 't_end', 'n' (samples), 'sd' (rms distance from
+        centroid in pixels), 'purity' (fraction of samples between start
+        and end belonging to the fixation) and 'confidence' (purity scaled
+        by compactness, 0 to 1)
+    '''
+
+    ok = np.isfinite(x) & np.isfinite(y)
+    t, x, y = t[ok], x[ok], y[ok]
+
+    keys = ('t_start', 't_end', 'n', 'sd', 'purity', 'confidence')
+
+    if t.shape[0] == 0:
+        return np.zeros((0, 2)), dict((k, np.zeros(0)) for k in keys)
+
+    # Grid covering the samples with a bandwidth margin, at most 1024 cells a side
+    cell = bandwidth / 4.0
+    x0, y0 = x.min() - 3.0 * bandwidth, y.min() - 3.0 * bandwidth
+    span = max(x.max() - x0, y.max() - y0) + 3.0 * bandwidth
+    cell = max(cell, span / 1024.0)
+    nx = int((x.max() + 3.0 * bandwidth - x0) / cell) + 1
+    ny = int((y.max() + 3.0 * bandwidth - y0) / cell) + 1
+
+    # Sample counts and coordinate sums per cell
+    cells = ((y - y0) / cell).astype(np.intp) * nx + ((x - x0) / cell).astype(np.intp)
+    W = np.bincount(cells, minlength=nx * ny).astype(float)
+    SX = np.bincount(cells, weights=x, minlength=nx * ny)
+    SY = np.bincount(cells, weights=y, minlength=nx * ny)
+
+    # Mean-shift target of every cell (Gaussian kernel)
+    s = bandwidth / cell
+    bW = cv2.GaussianBlur(W.reshape(ny, nx), (0,0), s, s).ravel()
+    bX = cv2.GaussianBlur(SX.reshape(ny, nx), (0,0), s, s).ravel()
+    bY = cv2.GaussianBlur(SY.reshape(ny, nx), (0,0), s, s).ravel()
+    valid = bW > 1e-9 * bW.max()
+    MX = np.where(valid, bX / np.where(valid, bW, 1.0), 0.0)
+    MY = np.where(valid, bY / np.where(valid, bW, 1.0), 0.0)
+
+    # Shift every occupied cell to its mode
+    occupied = np.flatnonzero(W)
+    px, py = SX[occupied] / W[occupied], SY[occupied] / W[occupied]
+    for it in range(100):
+        ci = np.clip(((py - y0) / cell).astype(np.intp), 0, ny - 1) * nx + \
+             np.clip(((px - x0) / cell).astype(np.intp), 0, nx - 1)
+        qx, qy = MX[ci], MY[ci]
+        moved = np.hypot(qx - px, qy - py).max()
+        px, py = qx, qy
+        if moved < 0.1 * cell:
+            break
+
+    # Modes closer than one bandwidth are the same cluster
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    pairs = cKDTree(np.column_stack((px, py))).query_pairs(bandwidth, output_type='ndarray')
+    n_occ = occupied.shape[0]
+    graph = coo_matrix((np.ones(pairs.shape[0]), (pairs[:, 0], pairs[:, 1])), shape=(n_occ, n_occ))
+    _, cell_label = connected_components(graph, directed=False)
+
+    # Cluster label of each sample
+    lut = np.zeros(nx * ny, dtype=np.intp)
+    lut[occupied] = cell_label
+    label = lut[cells]
+
+    # Runs of consecutive samples with the same label
+    change = np.flatnonzero(np.diff(label)) + 1
+    r0 = np.concatenate(([0], change))
+    r1 = np.concatenate((change, [label.shape[0]])) - 1
+    r_label = label[r0]
+
+    # Temporal constraint - drop short runs, then merge neighbouring runs of the same cluster
+    keep = (t[r1] - t[r0]) >= min_dwell
+    r0, r1, r_label = r0[keep], r1[keep], r_label[keep]
+
+    new_fix = np.concatenate(([True], r_label[1:] != r_label[:-1])) if r_label.shape[0] else np.zeros(0, bool)
+    r_fix = np.cumsum(new_fix) - 1
+    n_fix = int(new_fix.sum())
+
+    if n_fix == 0:
+        return np.zeros((0, 2)), dict((k, np.zeros(0)) for k in keys)
+
+    # Fixation index of each sample (-1 outside kept runs, which are disjoint)
+    step = np.zeros(label.shape[0] + 1, dtype=np.intp)
+    np.add.at(step, r0, r_fix + 1)
+    np.add.at(step, r1 + 1, -(r_fix + 1))
+    fix_idx = np.cumsum(step)[:-1] - 1
+
+    # Per-fixation statistics
+    member = fix_idx >= 0
+    fi = fix_idx[member]
+    n = np.bincount(fi, minlength=n_fix).astype(float)
+    cx = np.bincount(fi, weights=x[member], minlength=n_fix) / n
+    cy = np.bincount(fi, weights=y[member], minlength=n_fix) / n
+    d2 = (x[member] - cx[fi]) ** 2 + (y[member] - cy[fi]) ** 2
+    sd = np.sqrt(np.bincount(fi, weights=d2, minlength=n_fix) / n)
+
+    first = np.zeros(n_fix, dtype=np.intp)
+    last = np.zeros(n_fix, dtype=np.intp)
+    first[r_fix[::-1]] = r0[::-1]
+    last[r_fix] = r1
+
+    purity = n / (last - first + 1)
+    confidence = purity / (1.0 + (sd / bandwidth) ** 2)
+
+    fixations = np.column_stack((cx, cy))
+
+    stats = {
+        't_start'    : t[first],
+        't_end'      : t[last],
+        'n'          : n,
+        'sd'         : sd,
+        'purity'     : purity,
+        'confidence' : confidence,
+    }
+
+    return fixations, stats
+
+
+def MatchFixations(fixations, targets, confidence, max_err=0.1):
+    '''
+    Find the run of temporally ordered fixations that best matches the targets
+
+    Each contiguous run of as many fixations as targets is scored by the
+    leave-one-out rms error of an affine fit to the targets. A run that is
+    out of step with the target sequence fits badly, so this finds where
+    the calibration pass starts among extra fixations before or after it.
+    Mean fixation confidence only breaks ties between equally good runs.
+
+    Arguments
+    ----
+    fixations : n x 2 float array
+        Temporally ordered fixations in video space
+    targets : m x 2 float array
+        Fixation targets in gaze space (m <= n)
+    confidence : float array
+        Confidence of each fixation (see ClusterFixations)
+    max_err : float
+        Largest acceptable leave-one-out rms error in gaze space
+
+    Returns
+    ----
+    start : integer
+        Index of the first fixation of the best run (-1 if none fits)
+    '''
+
+    n, m = fixations.shape[0], targets.shape[0]
+
+    rms = np.zeros(n - m + 1)
+    conf = np.zeros(n - m + 1)
+
+    for i in range(n - m + 1):
+        _, loo = FitModel(fixations[i:i+m], targets, 'affine')
+        rms[i] = np.sqrt(np.mean(np.sum(loo * loo, axis=1)))
+        conf[i] = np.mean(confidence[i:i+m])
+
+    # Equally good runs to within 1% (or 1e-3 gaze units) - prefer confidence
+    tied = np.where(rms <= min(rms.min() * 1.01, rms.min() + 1e-3))[0]
+    start = tied[np.argmax(conf[tied])]
+
+    if not rms[start] <= max_err:
+        print('* No run of %d fixations matches the targets (best LOO rms %0.4f) - exiting' % (m, rms.min()))
+        return -1
+
+    print('  Using fixations %d to %d of %d (affine LOO rms %0.4f)' % (start + 1, start + m, n, rms[start]))
+
+    return start
+
+
 def SortFixations(t, x, y, fixations):
     '''
     Temporally sort detected spatial fixations
@@ -198,22 +436,14 @@ def SortFixations(t, x, y, fixations):
         Pupil center in video space for central fixation
     '''
 
-    # Count number of fixations and timepoints
-    nt = x.shape[0]
-    nf = fixations.shape[0]
-
     # Put coordinate timeseries in columns
-    X = np.zeros([nt,2])
-    X[:,0] = x
-    X[:,1] = y
+    X = np.column_stack((x, y))
 
     # Map each pupil center to nearest fixation
     idx = NearestFixation(X, fixations)
 
     # Median time of each fixation
-    t_fix = np.zeros(nf)
-    for fc in np.arange(0,nf):
-        t_fix[fc] = np.median(t[idx==fc])
+    t_fix = GroupedMedian(t, idx, fixations.shape[0])
 
     # Temporally sort fixations
     fix_order = np.argsort(t_fix)
@@ -223,112 +453,423 @@ def SortFixations(t, x, y, fixations):
     return fixations_sorted
 
 
-def NearestFixation(X, fixations):
+def NearestFixation(X, fixations, chunk=65536):
     '''
     Map pupil centers to index of nearest fixation
+
+    Squared distances are computed with one matrix product per chunk of
+    samples, so memory stays bounded for long timeseries. Large fixation grids use
+    a KD-tree instead.
     '''
 
     # Number of time points and fixations
     nt = X.shape[0]
     nf = fixations.shape[0]
 
-    # Distance array
-    dist2fix = np.zeros((nt, nf))
+    if nf > 64:
+        from scipy.spatial import cKDTree
+        idx = cKDTree(fixations).query(X)[1]
 
-    # Fill distance array (nt x nfix)
-    for (fix_i, fix) in enumerate(fixations):
-        dx, dy = X[:,0] - fix[0], X[:,1] - fix[1]
-        dist2fix[:, fix_i] = np.sqrt(dx**2 + dy**2)
+        # Non-finite samples go to the first fixation, as with argmin
+        idx[idx == nf] = 0
+        return idx
+
+    idx = np.empty(nt, dtype=np.intp)
+
+    # Squared distance less the per-sample constant |X|^2, which does not
+    # change the nearest fixation : |f|^2 - 2 X.f
+    F = np.asarray(fixations, dtype=float)
+    f2 = (F * F).sum(axis=1)
 
     # Find index of minimum distance fixation for each timepoint
-    return np.argmin(dist2fix, axis=1)
+    for i0 in range(0, nt, chunk):
+        d2 = X[i0:i0+chunk].dot(-2.0 * F.T)
+        d2 += f2
+        idx[i0:i0+chunk] = np.argmin(d2, axis=1)
+
+    return idx
+
+
+def GroupedMedian(v, groups, n_groups):
+    '''
+    Median of v within each group index 0 .. n_groups-1
+
+    One sort by (group, value) replaces a full scan per group. Empty
+    groups give NaN.
+    '''
+
+    order = np.lexsort((v, groups))
+    vs = v[order]
+
+    counts = np.bincount(groups, minlength=n_groups)[:n_groups]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    med = np.full(n_groups, np.nan)
+
+    ok = counts > 0
+    lo = starts[ok] + (counts[ok] - 1) // 2
+    hi = starts[ok] + counts[ok] // 2
+    med[ok] = 0.5 * (vs[lo] + vs[hi])
 
+    return med
 
-def CalibrationModel(fixations, targets):
+
+# Polynomial calibration models : basis terms x^i y^j in row order of C
+# The biquadratic order (xx, xy, yy, x, y, 1) matches calibration matrices
+# written by earlier versions
+MODEL_TERMS = {
+    'affine'      : [(1,0), (0,1), (0,0)],
+    'biquadratic' : [(2,0), (1,1), (0,2), (1,0), (0,1), (0,0)],
+    'bicubic'     : [(3,0), (2,1), (1,2), (0,3), (2,0), (1,1), (0,2), (1,0), (0,1), (0,0)],
+}
+
+# All model families in order of increasing flexibility
+MODELS = ('affine', 'biquadratic', 'bicubic', 'tps')
+
+# Huber tuning constant and iteration limits for robust fitting
+_HUBER_K = 1.345
+_IRLS_ITER = 20
+_IRLS_TOL = 1e-4
+
+
+def CalibrationModel(fixations, targets, model='biquadratic', robust=False, smooth=0.01):
     '''
-    Construct biquadratic transform from video space to gaze space
+    Construct a transform from video space to gaze space
 
-    BIQUADRATIC CALIBRATION MODEL
+    CALIBRATION MODELS
     ----
 
-    We need to solve the matrix equation C * R = R0 where
+    Polynomial models solve C * R = R0 in the least squares sense where
+
+    C = transform matrix (2 x k)
 
-    C = biquadratic transform matrix (2 x 6) (rank 2, full row rank)
+    R = basis matrix (k x n) of the fixations in video space
 
-    R = fixation matrix (6 x n) in video space (rank 6)
+    R0 = fixation targets (2 x n) in gaze space
 
-    R0 = fixation targets (2 x n) in gaze space (rank 2)
+    affine (k = 3) : R has rows x, y, 1
+    biquadratic (k = 6) : R has rows xx, xy, yy, x, y, 1
+    bicubic (k = 10) : R has rows xxx, xxy, xyy, yyy, xx, xy, yy, x, y, 1
 
-    R has rows xx, xy, yy, x, y, 1
+    The thin-plate spline (tps) adds a radial basis function r^2 log(r)
+    centered on each fixation to the affine terms, with a smoothing penalty
+    so that it does not interpolate noisy fixations exactly. C is 4 x (n + 3)
+    for tps. The first two rows are the spline and affine coefficients and
+    the last two rows hold the spline centers (zero padded).
+
+    The model family is implied by the shape of C (see ModelName), so C can
+    be stored and passed around as a plain array.
 
     Arguments
     ----
     fixations : n x 2 float array
-        Fixation coordinates in video space. n >= 6
+        Fixation coordinates in video space. n >= number of model terms
     targets : n x 2 float array
         Fixation targets in normalized gazed space
+    model : string
+        Model family (see MODELS) ['biquadratic']
+    robust : boolean
+        Downweight outlying fixations by iteratively reweighted least squares
+    smooth : float
+        Thin-plate spline smoothing relative to the mean radial basis value
 
     Returns
     ----
-    C : 2 x 6 float array
-        Biquadratic video-gaze post-multiply transform matrix
+    C : float array
+        Video-gaze post-multiply transform matrix (zero if too few fixations)
     '''
 
-    # Init biquadratic coefficient array
-    C = np.zeros((2,6))
+    C, _ = FitModel(fixations, targets, model, robust, smooth)
 
-    # Need at least 6 points for biquadratic mapping
-    if fixations.shape[0] < 6:
-        print('Too few fixations for biquadratic video to gaze mapping')
-        return C
+    return C
 
-    # Create fixation biquadratic matrix, R
-    R = MakeR(fixations)
 
-    # R0t is the transposed target coordinate array (n x 2)
-    R0 = targets.transpose()
+def FitModel(fixations, targets, model='biquadratic', robust=False, smooth=0.01):
+    '''
+    Fit a calibration model and its leave-one-out residuals
 
-    # Compute C by pseudoinverse of R (R+)
-    # C.R = R0
-    # C.R.R+ = R0.R+ = C
-    Rplus = np.linalg.pinv(R)
-    C = R0.dot(Rplus)
+    Leave-one-out residuals come from the diagonal of the hat matrix of the
+    (weighted) fit, e_i / (1 - h_ii), so no refitting is needed.
 
-    # Check that C maps correctly
-    # print(C.dot(R).transpose())
-    # print(R0.transpose())
+    Arguments
+    ----
+    See CalibrationModel
 
-    return C
+    Returns
+    ----
+    C : float array
+        Video-gaze post-multiply transform matrix (zero if too few fixations)
+    loo : n x 2 float array
+        Leave-one-out residuals in gaze space (inf where undefined)
+    '''
 
+    n = fixations.shape[0]
+    k = n + 3 if model == 'tps' else len(MODEL_TERMS[model])
+    n_min = 4 if model == 'tps' else k
 
-def MakeR(points):
+    if n < n_min:
+        print('* Too few fixations (%d) for %s video to gaze mapping' % (n, model))
+        rows = 4 if model == 'tps' else 2
+        return np.zeros((rows, max(k, 3))), np.full((n, 2), np.inf)
 
-    # Extract coordinates from n x 2 points matrix
-    x, y = points[:,0], points[:,1]
+    w = np.ones(n)
 
-    # Additional binomial coordinates
-    xx = x * x
-    yy = y * y
-    xy = x * y;
+    for it in range(_IRLS_ITER if robust else 1):
 
-    # Construct R (n x 6)
-    R = np.array((xx, xy, yy, x, y, np.ones_like(x)))
+        C, fit, h = _WeightedFit(fixations, targets, model, w, smooth)
 
-    return R
+        if not robust:
+            break
 
+        # Huber weights from the residual distance in gaze space
+        r = np.hypot(*(targets - fit).T)
+        s = max(1.4826 * np.median(r), 1e-3)
+        w_new = np.minimum(1.0, _HUBER_K * s / np.maximum(r, 1e-12))
 
-def HeatMap(x, y, xlims, ylims, sigma=1.0):
+        done = np.abs(w_new - w).max() < _IRLS_TOL
+        w = w_new
+
+        if done:
+            break
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loo = (targets - fit) / (1.0 - h)[:, np.newaxis]
+
+    loo[h > 1.0 - 1e-9] = np.inf
+
+    return C, loo
+
+
+def _WeightedFit(fixations, targets, model, w, smooth):
     '''
-    Convert pupil center timeseries to 2D heatmap
+    Weighted least squares fit with fitted targets and hat matrix diagonal
+    '''
+
+    n = fixations.shape[0]
+    x, y = fixations[:,0], fixations[:,1]
+
+    if model == 'tps':
+
+        # Smoothing spline system [[K + lam/W, P], [P', 0]] [a; b] = [targets; 0]
+        B = ModelBasis(model, x, y, fixations)
+        K, P = B[:n].T, B[n:].T
+        lam = smooth * np.abs(K).mean()
+
+        A = np.zeros((n + 3, n + 3))
+        A[:n, :n] = K + np.diag(lam / w)
+        A[:n, n:] = P
+        A[n:, :n] = P.T
+
+        Ainv = np.linalg.pinv(A)
+        coef = Ainv[:, :n].dot(targets)
+
+        # Fitted = targets - lam/W * a, so h_ii = 1 - lam * Ainv_ii / w_i
+        fit = targets - (lam / w)[:, np.newaxis] * coef[:n]
+        h = 1.0 - lam * np.diag(Ainv)[:n] / w
+
+        C = np.zeros((4, n + 3))
+        C[:2] = coef.T
+        C[2:, :n] = fixations.T
+
+    else:
+
+        # Weighted design matrix (n x k) and its pseudoinverse (k x n)
+        sw = np.sqrt(w)[:, np.newaxis]
+        X = ModelBasis(model, x, y).T
+        Xw = X * sw
+        Xplus = np.linalg.pinv(Xw)
+
+        C = Xplus.dot(targets * sw).T
+        fit = X.dot(C.T)
+
+        # Hat matrix diagonal of the weighted problem, Xw Xw+
+        h = np.einsum('ik,ki->i', Xw, Xplus)
+
+    return C, fit, h
+
+
+def SelectModel(fixations, targets, models=MODELS, robust=False, smooth=0.01):
+    '''
+    Fit each candidate model and keep the one with lowest cross-validated error
+
+    Models with too few fixations for a leave-one-out estimate are skipped.
+
+    Returns
+    ----
+    C : float array
+        Video-gaze post-multiply transform matrix of the selected model
+    model : string
+        Selected model family
+    errors : dict
+        (rms, max) leave-one-out error in gaze space for each model fitted
+    '''
+
+    n = fixations.shape[0]
+
+    fits, errors = {}, {}
+
+    for model in models:
+
+        k = 3 if model == 'tps' else len(MODEL_TERMS[model])
+        if n <= k:
+            continue
+
+        C, loo = FitModel(fixations, targets, model, robust, smooth)
+        d = np.hypot(loo[:,0], loo[:,1])
+
+        fits[model] = C
+        errors[model] = (np.sqrt(np.mean(d * d)), d.max())
+
+    if not errors:
+        print('* Too few fixations (%d) for any calibration model' % n)
+        return np.zeros((2, 6)), 'biquadratic', errors
+
+    best = min(errors, key=lambda m: errors[m][0])
+
+    for model in errors:
+        print('  %-12s LOO error rms %0.4f max %0.4f%s' %
+              (model, errors[model][0], errors[model][1], ' *' if model == best else ''))
+
+    return fits[best], best, errors
+
+
+def ConfiguredModel(fixations, targets, cfg):
+    '''
+    Fit the calibration model family chosen in the CALIBRATION config section
+
+    CALIBRATION.model is one of MODELS, or auto to select the model with the
+    lowest leave-one-out error. The fit fails if the leave-one-out rms error
+    of the model used exceeds CALIBRATION.maxlooerror.
+
+    Returns
+    ----
+    C : float array
+        Video-gaze post-multiply transform matrix (empty if the fit failed)
+    errors : dict
+        (rms, max) leave-one-out error for each model fitted
+    '''
+
+    model = cfg.get('CALIBRATION', 'model', fallback='auto')
+    robust = cfg.getboolean('CALIBRATION', 'robust', fallback=True)
+    smooth = cfg.getfloat('CALIBRATION', 'tpssmooth', fallback=0.01)
+    max_err = cfg.getfloat('CALIBRATION', 'maxlooerror', fallback=0.1)
+
+    models = MODELS if model == 'auto' else (model,)
+
+    C, model, errors = SelectModel(fixations, targets, models, robust, smooth)
+
+    if model in errors and not errors[model][0] <= max_err:
+        print('* %s model LOO error rms %0.4f exceeds %0.4f - calibration failed' %
+              (model, errors[model][0], max_err))
+        return np.array([]), errors
+
+    print('  Using %s calibration model%s' % (model, ' (robust)' if robust else ''))
+
+    return C, errors
+
+
+def ModelName(C):
+    '''
+    Calibration model family implied by the shape of C
+    '''
+
+    if C.shape[0] == 4:
+        return 'tps'
+
+    for model, terms in MODEL_TERMS.items():
+        if len(terms) == C.shape[1]:
+            return model
+
+    raise ValueError('Unknown calibration matrix shape %s' % (C.shape,))
+
+
+def ModelBasis(model, x, y, centers=None):
+    '''
+    Basis matrix (k x n) of a calibration model at video space points
+
+    Arguments
+    ----
+    model : string
+        Model family (see MODELS)
+    x, y : 1D float arrays
+        Video space coordinates
+    centers : m x 2 float array
+        Thin-plate spline centers (tps only)
+    '''
+
+    if model == 'tps':
+
+        dx = x[np.newaxis, :] - centers[:, 0:1]
+        dy = y[np.newaxis, :] - centers[:, 1:2]
+        r2 = dx * dx + dy * dy
+
+        # r^2 log(r) = r^2 log(r^2) / 2, zero at the centers
+        with np.errstate(divide='ignore', invalid='ignore'):
+            U = 0.5 * r2 * np.log(r2)
+        U[r2 == 0.0] = 0.0
+
+        return np.vstack((U, x, y, np.ones_like(x)))
+
+    # Powers of x and y shared between terms
+    terms = MODEL_TERMS[model]
+    order = max(i for i, _ in terms)
+    xp, yp = [np.ones_like(x), x], [np.ones_like(y), y]
+    for _ in range(order - 1):
+        xp.append(xp[-1] * x)
+        yp.append(yp[-1] * y)
+
+    return np.array([xp[i] * yp[j] for i, j in terms])
+
+
+def ApplyModel(C, x, y, chunk=262144):
+    '''
+    Map video space points to gaze space with a calibration matrix
+
+    Points are transformed in chunks so the basis matrix stays small for
+    long recordings.
+
+    Arguments
+    ----
+    C : float array
+        Calibration matrix from CalibrationModel
+    x, y : float arrays
+        Video space coordinates
+    chunk : integer
+        Points transformed per basis matrix
+
+    Returns
+    ----
+    gaze_x, gaze_y : 1D float arrays
+        Gaze space coordinates
+    '''
+
+    x = np.atleast_1d(np.asarray(x, dtype=float)).ravel()
+    y = np.atleast_1d(np.asarray(y, dtype=float)).ravel()
+
+    model = ModelName(C)
+    centers = C[2:, :-3].T if model == 'tps' else None
+
+    gaze = np.empty((2, x.shape[0]))
+
+    for i0 in range(0, x.shape[0], chunk):
+        sl = slice(i0, i0 + chunk)
+        gaze[:, sl] = C[:2].dot(ModelBasis(model, x[sl], y[sl], centers))
+
+    return gaze[0], gaze[1]
+
+
+def MakeR(points):
+    '''
+    Biquadratic basis matrix (6 x n) of n x 2 video space points
     '''
 
-    # Eliminate NaNs in x, y (from blinks)
-    x = x[np.isfinite(x)]
-    y = y[np.isfinite(y)]
+    return ModelBasis('biquadratic', points[:,0], points[:,1])
 
-    # Parse out limits
-    xmin, xmax = xlims
-    ymin, ymax = ylims
+
+def HeatMap(x, y, xlims, ylims, sigma=1.0):
+    '''
+    Convert pupil center timeseries to 2D heatmap
+    '''
 
     #---
     # NOTE: heatmap dimensions are y (1st) then x (2nd)
@@ -336,20 +877,115 @@ def HeatMap(x, y, xlims, ylims, sigma=1.0):
     # All coordinate orderings are adjusted accordingly
     #---
 
-    # Composite histogram axis ranges
     # Make bin count different for x and y for debugging
-    # *** Note y/row, x/col ordering
-    hbins = [np.linspace(ymin, ymax, 64), np.linspace(xmin, xmax, 65)]
+    acc = HeatMapAccumulator(xlims, ylims, (63, 64))
+    acc.Add(x, y)
 
-    # Construct histogram
-    # *** Note y/row, x/col ordering
-    hmap, yedges, xedges = np.histogram2d(y, x, bins=hbins)
+    return acc.Read(sigma)
+
+
+class HeatMapAccumulator(object):
+    '''
+    2D sample heatmap built incrementally from chunks of samples
+
+    Samples are mapped to bins with integer arithmetic and counted with
+    np.bincount into an integer count grid. The Gaussian blur is applied
+    only when the map is read. Binning follows np.histogram2d with
+    uniform bins: samples outside the limits and NaNs (blinks) are
+    dropped, and the upper limit falls in the last bin.
+
+    Arguments
+    ----
+    xlims, ylims : float tuples
+        (min, max) heatmap extent
+    shape : integer tuple
+        (ny, nx) number of bins - y/row, x/col ordering
+    '''
+
+    def __init__(self, xlims, ylims, shape=(63, 64)):
+
+        self.xlims = tuple(float(v) for v in xlims)
+        self.ylims = tuple(float(v) for v in ylims)
+        self.shape = tuple(shape)
+
+        self.counts = np.zeros(self.shape[0] * self.shape[1], dtype=np.int64)
+        self._cache = None
+
+    def Add(self, x, y):
+        '''
+        Add a chunk of samples
+        '''
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        ny, nx = self.shape
+        (xmin, xmax), (ymin, ymax) = self.xlims, self.ylims
 
-    # Gaussian blur
-    if sigma > 0:
-        hmap = cv2.GaussianBlur(hmap, (0,0), sigma, sigma)
+        ok = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        if not ok.all():
+            x, y = x[ok], y[ok]
 
-    return hmap, xedges, yedges
+        ix = np.minimum(((x - xmin) * (nx / (xmax - xmin))).astype(np.intp), nx - 1)
+        iy = np.minimum(((y - ymin) * (ny / (ymax - ymin))).astype(np.intp), ny - 1)
+
+        self.counts += np.bincount(iy * nx + ix, minlength=ny * nx)
+        self._cache = None
+
+    def Edges(self):
+        '''
+        x and y bin edges
+        '''
+
+        ny, nx = self.shape
+
+        return np.linspace(self.xlims[0], self.xlims[1], nx + 1), np.linspace(self.ylims[0], self.ylims[1], ny + 1)
+
+    def Read(self, sigma=1.0):
+        '''
+        Blurred heatmap
+
+        Returns
+        ----
+        hmap : 2D float array
+            Heatmap (y/row, x/col ordering)
+        xedges, yedges : float vectors
+            Bin edges
+        '''
+
+        if self._cache is None or self._cache[0] != sigma:
+
+            hmap = self.counts.reshape(self.shape).astype(float)
+
+            # Gaussian blur
+            if sigma > 0:
+                hmap = cv2.GaussianBlur(hmap, (0,0), sigma, sigma)
+
+            self._cache = sigma, hmap
+
+        xedges, yedges = self.Edges()
+
+        return self._cache[1], xedges, yedges
+
+    def Save(self, heatmap_npz):
+        '''
+        Save counts and extent to a numpy archive
+        '''
+
+        np.savez(heatmap_npz, counts=self.counts.reshape(self.shape),
+                 xlims=self.xlims, ylims=self.ylims)
+
+    @classmethod
+    def Load(cls, heatmap_npz):
+        '''
+        Load an accumulator saved with Save
+        '''
+
+        with np.load(heatmap_npz) as d:
+            acc = cls(d['xlims'], d['ylims'], d['counts'].shape)
+            acc.counts += d['counts'].ravel()
+
+        return acc
 
 
 def ApplyCalibration(ss_dir, C, central_fix, cfg):
@@ -417,25 +1053,168 @@ def ApplyCalibration(ss_dir, C, central_fix, cfg):
         # Return dummy x and y baseline estimates
         bx, by = np.zeros_like(x), np.zeros_like(y)
 
-    # Additional binomial coordinates
-    xx = x * x
-    yy = y * y
-    xy = x * y
-
-    # Construct R
-    R = np.array((xx, xy, yy, x, y, np.ones_like(x)))
-
     # Apply calibration transform to pupil-glint vector timeseries
-    # (2 x n) = (2 x 6) x (6 x n)
-    gaze = C.dot(R)
+    gaze_x, gaze_y = ApplyModel(C, x, y)
 
     # Write calibrated gaze to CSV file in results directory
     gaze_csv = os.path.join(ss_dir,'results','gaze_calibrated.csv')
-    WriteGaze(gaze_csv, t, gaze[0,:], gaze[1,:], bx, by)
+    WriteGaze(gaze_csv, t, gaze_x, gaze_y, bx, by)
+
+    # Save gaze heatmap counts for the report
+    heatmap = HeatMapAccumulator((0.0, 1.0), (0.0, 1.0))
+    heatmap.Add(gaze_x, gaze_y)
+    heatmap.Save(GazeHeatMapFile(gaze_csv))
 
     return True
 
 
+class StreamingCalibration(object):
+    '''
+    Apply the calibration transform to gaze pupil centers as they are measured
+
+    Streaming counterpart of ApplyCalibration. Samples are buffered and
+    transformed in chunks, and each chunk is appended to the calibrated gaze
+    CSV and added to a gaze heatmap, so both are complete as soon as
+    pupilometry ends. Highpass motion
+    correction uses a causal (trailing) moving median. Samples added before
+    a calibration model is set are held and written once one arrives.
+
+    Arguments
+    ----
+    gaze_csv : string
+        Calibrated gaze CSV file path (same columns as WriteGaze)
+    cfg : configuration object
+        Motion correction settings
+    chunk : integer
+        Number of samples transformed at once
+    '''
+
+    def __init__(self, gaze_csv, cfg, chunk=64):
+
+        self.gaze_csv = gaze_csv
+        self.chunk = chunk
+
+        self.motioncorr = cfg.get('ARTIFACTS', 'motioncorr')
+        self.mocokernel = cfg.getint('ARTIFACTS', 'mocokernel')
+
+        self.C = None
+        self._moco = None
+        self._stream = None
+        self._buf = [], [], []
+        self.n_written = 0
+        self.complete = False
+
+        # Calibrated gaze heatmap for the report, saved on completion
+        self.heatmap = HeatMapAccumulator((0.0, 1.0), (0.0, 1.0))
+
+    def SetModel(self, C, central_fix):
+        '''
+        Use a new calibration model for all following samples
+        '''
+
+        # Samples so far belong to the previous model
+        if self.C is not None:
+            self.Flush()
+
+        self.C = C
+
+        if self.motioncorr == 'highpass':
+            print('  Causal motion correction by high pass filtering (%d sample kernel)' % self.mocokernel)
+            self._moco = moco.CausalHighPassFilter(self.mocokernel, central_fix)
+        else:
+            if self.motioncorr not in ('none', 'glint'):
+                print('* Motion correction %s not available while streaming - skipping' % self.motioncorr)
+            self._moco = None
+
+    def Add(self, t, x, y):
+        '''
+        Add one gaze pupil center sample
+        '''
+
+        bt, bx, by = self._buf
+        bt.append(t)
+        bx.append(x)
+        by.append(y)
+
+        if self.C is not None and len(bt) >= self.chunk:
+            self.Flush()
+
+    def Extend(self, t, x, y):
+        '''
+        Add arrays of gaze pupil center samples
+        '''
+
+        bt, bx, by = self._buf
+        bt.extend(t)
+        bx.extend(x)
+        by.extend(y)
+
+        if self.C is not None and len(bt) >= self.chunk:
+            self.Flush()
+
+    def Flush(self):
+        '''
+        Transform and write all buffered samples (if a model is set)
+        '''
+
+        if self.C is None or not self._buf[0]:
+            return
+
+        t, x, y = [np.array(v, dtype=float) for v in self._buf]
+        self._buf = [], [], []
+
+        if self._moco:
+            x, y, bx, by = self._moco.Apply(x, y)
+        else:
+            bx, by = np.zeros_like(x), np.zeros_like(y)
+
+        gaze_x, gaze_y = ApplyModel(self.C, x, y)
+
+        if self._stream is None:
+            self._stream = open(self.gaze_csv, 'w')
+
+        np.savetxt(self._stream, np.array((t, gaze_x, gaze_y, bx, by)).T, fmt='%0.3f', delimiter=',')
+        self._stream.flush()
+
+        self.heatmap.Add(gaze_x, gaze_y)
+
+        self.n_written += t.shape[0]
+
+    def Close(self):
+        '''
+        Write remaining samples and close the calibrated gaze CSV
+
+        Returns
+        ----
+        complete : boolean
+            True if every sample added has been calibrated and written
+        '''
+
+        self.Flush()
+
+        if self._stream is None and self.C is not None:
+            self._stream = open(self.gaze_csv, 'w')
+
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+        self.complete = self.C is not None and not self._buf[0]
+
+        if self.complete:
+            self.heatmap.Save(GazeHeatMapFile(self.gaze_csv))
+
+        return self.complete
+
+
+def GazeHeatMapFile(gaze_csv):
+    '''
+    Saved heatmap counts accompanying a calibrated gaze CSV file
+    '''
+
+    return os.path.splitext(gaze_csv)[0] + '_heatmap.npz'
+
+
 def CentralFixation(fixations, targets):
     '''
     Find video coordinate corresponding to gaze fixation at (0.5, 0.5)
@@ -486,6 +1265,31 @@ def WriteGaze(gaze_csv, t, gaze_x, gaze_y, bline_x, bline_y):
     return True
 
 
+def ReadCalibration(ss_res_dir):
+    '''
+    Read calibration matrix and central fixation written by WriteCalibration
+
+    Returns
+    ----
+    C : float array
+        Video-gaze transform matrix (empty if not found)
+    central_fix : float array
+        Central fixation in video space
+    '''
+
+    calmat_csv = os.path.join(ss_res_dir, 'calibration_matrix.csv')
+    ctrfix_csv = os.path.join(ss_res_dir, 'central_fixation.csv')
+
+    if not os.path.isfile(calmat_csv) or not os.path.isfile(ctrfix_csv):
+        print('* Calibration files not found - returning')
+        return np.array([]), (0.0, 0.0)
+
+    C = np.loadtxt(calmat_csv, delimiter=',', ndmin=2)
+    central_fix = np.loadtxt(ctrfix_csv, delimiter=',')
+
+    return C, central_fix
+
+
 def ReadGaze(gaze_csv):
     '''
     Read calibrated gaze timerseries from CSV file
@@ -505,6 +1309,8 @@ def PlotCalibration(res_dir, hmap, xedges, yedges, fixations):
     Plot the calibration heatmap and temporally sorted fixation labels
     '''
 
+    plt = utils._pyplot()
+
     # Create a new figure
     fig = plt.figure(figsize = (6,6))
 
@@ -564,3 +1370,268 @@ def WriteCalibration(ss_res_dir, fixations, C, central_fix):
         return False
 
     return True
+
+
+def WriteFixationStats(ss_res_dir, stats):
+    '''
+    Write per-fixation statistics from ClusterFixations to CSV in results subdirectory
+    '''
+
+    keys = ('t_start', 't_end', 'n', 'sd', 'purity', 'confidence')
+
+    stats_csv = os.path.join(ss_res_dir, 'calibration_fixation_stats.csv')
+
+    try:
+        np.savetxt(stats_csv, np.array([stats[k] for k in keys]).T, fmt='%0.3f',
+                   delimiter=',', header=','.join(keys))
+    except:
+        print('* Problem saving calibration fixation statistics to CSV file - skipping')
+        return False
+
+    return True
+
+def WriteModelErrors(ss_res_dir, errors):
+    '''
+    Write leave-one-out errors of the calibration models fitted by SelectModel
+    '''
+
+    errors_csv = os.path.join(ss_res_dir, 'calibration_model_errors.csv')
+
+    try:
+        with open(errors_csv, 'w') as errors_stream:
+            errors_stream.write('model,loo_rms,loo_max\n')
+            for model, (rms, emax) in errors.items():
+                errors_stream.write('%s,%0.6f,%0.6f\n' % (model, rms, emax))
+    except IOError:
+        print('* Problem saving calibration model errors to CSV file - skipping')
+        return False
+
+    return True
+
+
+class OnlineCalibrator(object):
+    '''
+    Incremental calibration from pupil centers as they are measured
+
+    Fixations are detected online by dispersion. A run of unblinked samples
+    staying within CALIBRATION.fixradius pixels of its running centroid for
+    CALIBRATION.fixdwell seconds becomes a fixation. A fixation within twice
+    the radius of the most recent cluster is merged into it, because the
+    gaze has returned after a brief excursion. Any other fixation starts a
+    new cluster, so a target presented twice gives two clusters. Clusters
+    are matched to the calibration targets in temporal order, as in
+    AutoCalibrate.
+
+    The biquadratic CalibrationModel is refitted once at least six clusters
+    are seen. It is refitted again whenever a cluster is added or has moved.
+    The final model in Finish uses the configured model family.
+    A fixation heatmap over the video frame is accumulated as samples arrive
+    for the calibration plot.
+
+    Arguments
+    ----
+    cfg : configuration object
+        Calibration targets, heatmap sigma and fixation parameters
+    '''
+
+    def __init__(self, cfg):
+
+        targetx = json.loads(cfg.get('CALIBRATION', 'targetx'))
+        targety = json.loads(cfg.get('CALIBRATION', 'targety'))
+        self.targets = np.array([targetx, targety]).transpose()
+
+        self.cfg = cfg
+        self.radius = cfg.getfloat('CALIBRATION', 'fixradius', fallback=3.0)
+        self.dwell = cfg.getfloat('CALIBRATION', 'fixdwell', fallback=0.5)
+        self.sigma = cfg.getfloat('CALIBRATION', 'heatsigma')
+
+        self.Reset()
+
+    def Reset(self):
+        '''
+        Discard all samples, clusters and the model (eg. repeated calibration)
+        '''
+
+        # Candidate fixation : running sums, sample count, start time, cluster index
+        self._cand = None
+
+        # Cluster running sums (x, y, n)
+        self._sums = []
+
+        # Fixation heatmap and samples not yet added to it
+        self._heat = None
+        self._heat_xy = [], []
+
+        self._dirty = False
+        self._warned = False
+
+        self.C = None
+
+    def Update(self, t, px, py, blink, nx, ny):
+        '''
+        Add one pupilometry sample
+
+        Arguments
+        ----
+        t : float
+            Sample time in seconds
+        px, py : float
+            Pupil center in video pixels
+        blink : boolean
+            Blink flag (blinks are skipped)
+        nx, ny : integer
+            Video frame size in pixels (sets the heatmap grid)
+
+        Returns
+        ----
+        changed : boolean
+            True if the calibration model C was refitted
+        '''
+
+        if blink or not (np.isfinite(px) and np.isfinite(py)):
+            return False
+
+        # One bin per video pixel, filled in chunks and blurred only when plotted
+        if self._heat is None:
+            self._heat = HeatMapAccumulator((0, nx), (0, ny), (ny, nx))
+        hx, hy = self._heat_xy
+        hx.append(px)
+        hy.append(py)
+        if len(hx) >= 256:
+            self._FlushHeat()
+
+        c = self._cand
+
+        if c is not None and np.hypot(px - c[0] / c[2], py - c[1] / c[2]) <= self.radius:
+
+            c[0] += px
+            c[1] += py
+            c[2] += 1
+
+            if c[4] is None:
+                if t - c[3] >= self.dwell:
+                    self._Commit(c)
+            else:
+                s = self._sums[c[4]]
+                s[0] += px
+                s[1] += py
+                s[2] += 1
+                self._dirty = True
+
+        else:
+
+            # Sample left the candidate - start a new one here
+            self._cand = [px, py, 1, t, None]
+
+        return self._Refit()
+
+    def _Commit(self, c):
+        '''
+        Add a candidate that has dwelt long enough to the clusters
+        '''
+
+        cx, cy = c[0] / c[2], c[1] / c[2]
+
+        s = self._sums[-1] if self._sums else None
+
+        if s is not None and np.hypot(cx - s[0] / s[2], cy - s[1] / s[2]) <= 2.0 * self.radius:
+            s[0] += c[0]
+            s[1] += c[1]
+            s[2] += c[2]
+        else:
+            self._sums.append([c[0], c[1], c[2]])
+
+        c[4] = len(self._sums) - 1
+
+        self._dirty = True
+
+    def Fixations(self):
+        '''
+        Cluster centroids in order of first appearance (n x 2)
+        '''
+
+        if not self._sums:
+            return np.zeros((0, 2))
+
+        s = np.array(self._sums)
+
+        return s[:, :2] / s[:, 2:3]
+
+    def _Refit(self):
+
+        if not self._dirty:
+            return False
+        self._dirty = False
+
+        fixations = self.Fixations()
+        n_fix, n_targets = fixations.shape[0], self.targets.shape[0]
+
+        if n_fix > n_targets:
+            if not self._warned:
+                print('* Online calibration : more fixations (%d) than targets (%d)' % (n_fix, n_targets))
+                self._warned = True
+            return False
+
+        if n_fix < 6:
+            return False
+
+        self.C = CalibrationModel(fixations, self.targets[:n_fix])
+
+        return True
+
+    def _FlushHeat(self):
+
+        self._heat.Add(*self._heat_xy)
+        self._heat_xy = [], []
+
+    def HeatMap(self):
+        '''
+        Blurred fixation heatmap with x and y bin edges in video pixels
+        '''
+
+        if self._heat is None:
+            return np.zeros((1, 1)), np.array([0.0, 1.0]), np.array([0.0, 1.0])
+
+        self._FlushHeat()
+
+        return self._heat.Read(self.sigma)
+
+    def Finish(self, ss_res_dir):
+        '''
+        Final calibration once the calibration run ends
+
+        Writes the calibration files and plot like AutoCalibrate.
+
+        Returns
+        ----
+        C : float array
+            Calibration matrix (empty if fixations and targets differ or the fit failed)
+        central_fix : float array
+            Central fixation in video space
+        '''
+
+        fixations = self.Fixations()
+
+        hmap, xedges, yedges = self.HeatMap()
+        PlotCalibration(ss_res_dir, hmap, xedges, yedges, fixations)
+
+        n_targets = self.targets.shape[0]
+        n_fixations = fixations.shape[0]
+
+        if n_fixations != n_targets:
+            print('* Online calibration : number of fixations (%d) and targets (%d) differ' % (n_fixations, n_targets))
+            return np.array([]), (0.0, 0.0)
+
+        C, errors = ConfiguredModel(fixations, self.targets, self.cfg)
+        WriteModelErrors(ss_res_dir, errors)
+
+        if not C.any():
+            return np.array([]), (0.0, 0.0)
+
+        central_fix = CentralFixation(fixations, self.targets)
+
+        WriteCalibration(ss_res_dir, fixations, C, central_fix)
+
+        self.C = C
+
+        return C, central_fix
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Calibration model store
+
+Each subject/session keeps its fitted calibration model in
+results/calibration_model.json, together with the key of the inputs it was
+fitted from (calibration video content and pupilometry and calibration
+config). A session whose calibration inputs are unchanged reuses its stored
+model and skips calibration pupilometry and model fitting entirely.
+
+When a session cannot be calibrated (no calibration video, or fixation
+detection fails), a model can be borrowed from another session in the same
+data directory. CALIBRATION.reusefrom names that session explicitly. If it
+is empty, the most recent model from the same subject is used. Session
+directories are assumed to be named <subject>_<session>.
+
+CALIBRATION.reuse controls borrowing :
+  never    : only this session's own stored model is used
+  fallback : borrow a model when calibration fails [default]
+  always   : borrow a model without calibrating this session
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import json
+import time
+import numpy as np
+
+# Stored model file name in each results directory
+MODEL_JSON = 'calibration_model.json'
+
+
+def SubjectID(subj_sess):
+    '''
+    Subject part of a <subject>_<session> directory name
+    '''
+
+    return subj_sess.split('_')[0]
+
+
+def SaveModel(ss_res_dir, C, central_fix, key=None, source='', fixations=None):
+    '''
+    Store a calibration model in a results directory
+
+    Arguments
+    ----
+    ss_res_dir : string
+        Results directory
+    C : float array
+        Calibration matrix (see calibrate.CalibrationModel)
+    central_fix : float pair
+        Central fixation in video space
+    key : string
+        Key of the calibration inputs the model was fitted from. None for
+        a model borrowed from another session, which is never treated as
+        this session's own cached model.
+    source : string
+        Subject/session the model was fitted in
+    fixations : n x 2 float array
+        Calibration fixations in video space. Read from
+        calibration_fixations.csv in the results directory if not given.
+    '''
+
+    if fixations is None:
+        calfix_csv = os.path.join(ss_res_dir, 'calibration_fixations.csv')
+        if os.path.isfile(calfix_csv):
+            fixations = np.loadtxt(calfix_csv, delimiter=',', ndmin=2)
+        else:
+            fixations = np.zeros((0, 2))
+
+    from mrgaze import calibrate
+
+    rec = {
+        'key'         : key,
+        'source'      : source,
+        'created'     : time.time(),
+        'model'       : calibrate.ModelName(np.asarray(C)),
+        'C'           : np.asarray(C).tolist(),
+        'central_fix' : np.asarray(central_fix, dtype=float).tolist(),
+        'fixations'   : np.asarray(fixations).tolist(),
+    }
+
+    model_json = os.path.join(ss_res_dir, MODEL_JSON)
+    tmp_json = model_json + '.tmp'
+
+    with open(tmp_json, 'w') as model_stream:
+        json.dump(rec, model_stream, indent=2)
+
+    os.replace(tmp_json, model_json)
+
+
+def LoadModel(ss_res_dir):
+    '''
+    Load the stored calibration model record for a results directory
+
+    Returns
+    ----
+    rec : dict or None
+        Record with C, central_fix and fixations as numpy arrays, or None if
+        missing or unreadable
+    '''
+
+    model_json = os.path.join(ss_res_dir, MODEL_JSON)
+
+    if not os.path.isfile(model_json):
+        return None
+
+    try:
+        with open(model_json, 'r') as model_stream:
+            rec = json.load(model_stream)
+    except ValueError:
+        print('* Stored calibration model is corrupt - ignoring')
+        return None
+
+    for k in ('C', 'central_fix', 'fixations'):
+        rec[k] = np.array(rec[k], dtype=float)
+
+    rec['fixations'] = rec['fixations'].reshape(-1, 2)
+
+    if rec['C'].ndim != 2 or not rec['C'].any():
+        return None
+
+    return rec
+
+
+def CachedModel(ss_res_dir, key):
+    '''
+    This session's own stored model if it was fitted from the same inputs
+    '''
+
+    rec = LoadModel(ss_res_dir)
+
+    if rec is None or rec['key'] is None or rec['key'] != key:
+        return None
+
+    return rec
+
+
+def FindModel(data_dir, subj_sess, reuse_from=''):
+    '''
+    Find a model to borrow from another session in the data directory
+
+    Arguments
+    ----
+    data_dir : string
+        Root data directory containing subject/session directories
+    subj_sess : string
+        Session needing a model (excluded from the search)
+    reuse_from : string
+        Session to take the model from. If empty, the most recently fitted
+        model from the same subject is used.
+
+    Returns
+    ----
+    rec : dict or None
+        Model record (see LoadModel), or None if nothing suitable is found
+    '''
+
+    if reuse_from:
+        candidates = [reuse_from]
+    else:
+        subject = SubjectID(subj_sess)
+        candidates = [d for d in sorted(os.listdir(data_dir))
+                      if d != subj_sess and SubjectID(d) == subject and
+                      os.path.isdir(os.path.join(data_dir, d))]
+
+    best = None
+
+    for ss in candidates:
+
+        rec = LoadModel(os.path.join(data_dir, ss, 'results'))
+
+        # Only models fitted in that session, not ones it borrowed
+        if rec is None or rec['key'] is None:
+            continue
+
+        if best is None or rec['created'] > best['created']:
+            best = rec
+
+    return best
+
+
+def BorrowModel(data_dir, subj_sess, cfg):
+    '''
+    Copy a model from another session into this session's results
+
+    The calibration files written by calibrate.WriteCalibration are replaced
+    by the borrowed model so that later stages use it unchanged.
+
+    Returns
+    ----
+    C : float array
+        Borrowed calibration matrix (empty if none found)
+    central_fix : float array
+        Borrowed central fixation in video space
+    '''
+
+    from mrgaze import calibrate
+
+    reuse_from = cfg.get('CALIBRATION', 'reusefrom', fallback='').strip()
+
+    rec = FindModel(data_dir, subj_sess, reuse_from)
+
+    if rec is None:
+        print('* No calibration model found to reuse')
+        return np.array([]), (0.0, 0.0)
+
+    print('+ Reusing calibration model from %s' % rec['source'])
+
+    ss_res_dir = os.path.join(data_dir, subj_sess, 'results')
+
+    calibrate.WriteCalibration(ss_res_dir, rec['fixations'], rec['C'], rec['central_fix'])
+    SaveModel(ss_res_dir, rec['C'], rec['central_fix'], None, rec['source'], rec['fixations'])
+
+    return rec['C'], rec['central_fix']
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Threaded camera capture with latest-frame semantics
+
+The camera is read continuously in a background thread which keeps only
+the newest frame. If the processing loop falls behind, older unprocessed
+frames are dropped rather than queued, so capture-to-result latency stays
+bounded by roughly one frame period plus processing time.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import time
+import threading
+
+
+class LatestFrameCapture(object):
+    '''
+    Wrap an opened cv2.VideoCapture with a capture thread
+
+    Provides the read(), isOpened(), set(), get() and release() methods
+    used by the pupilometry loops, so it can stand in for the stream.
+
+    Counters
+    ----
+    n_captured : frames read from the camera
+    n_delivered : frames returned by read()
+    n_dropped : frames overwritten before they were read
+    '''
+
+    def __init__(self, vin_stream):
+
+        self._stream = vin_stream
+        self._cond = threading.Condition()
+        self._frame = None
+        self._t_frame = 0.0
+        self._eof = False
+        self._running = False
+        self._thread = None
+
+        self.n_captured = 0
+        self.n_delivered = 0
+        self.n_dropped = 0
+
+        # Wall clock capture time of the frame last returned by read()
+        self.t_capture = 0.0
+
+    def start(self):
+        '''
+        Start the capture thread
+        '''
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='mrgaze-capture')
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def _run(self):
+
+        while self._running:
+
+            status, fr = self._stream.read()
+            t_frame = time.time()
+
+            with self._cond:
+
+                if not status:
+                    self._eof = True
+                    self._cond.notify_all()
+                    break
+
+                # Drop oldest - replace any frame not yet picked up
+                if self._frame is not None:
+                    self.n_dropped += 1
+
+                self._frame = fr
+                self._t_frame = t_frame
+                self.n_captured += 1
+                self._cond.notify_all()
+
+    def read(self, timeout=None):
+        '''
+        Return the newest captured frame, waiting for one if necessary
+
+        Returns
+        ----
+        status : boolean
+            False once the camera stops delivering frames
+        fr : numpy uint8 array
+            Newest frame
+        '''
+
+        with self._cond:
+
+            while self._frame is None and not self._eof:
+                if not self._cond.wait(timeout):
+                    return False, None
+
+            if self._frame is None:
+                return False, None
+
+            fr = self._frame
+            self.t_capture = self._t_frame
+            self._frame = None
+            self.n_delivered += 1
+
+        return True, fr
+
+    def isOpened(self):
+        return self._stream.isOpened()
+
+    def set(self, prop, value):
+        return self._stream.set(prop, value)
+
+    def get(self, prop):
+        return self._stream.get(prop)
+
+    def release(self):
+        '''
+        Stop the capture thread and release the camera
+        '''
+
+        self._running = False
+
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+        self._stream.release()
@@ -26,8 +26,17 @@ Copyright 2014-2016 California Institute of Technology.
 """
 
 import os
+import json
+import threading
 import configparser
 
+# Float options whose defaults are written as integers. ValidateConfig
+# otherwise infers option types from the defaults.
+FLOAT_OPTIONS = [
+    ('VIDEO', 'downsampling'),
+    ('CALIBRATION', 'heatpercmax'),
+]
+
 
 def InitConfig(config):
     '''
@@ -79,15 +88,63 @@ def InitConfig(config):
     config.set('CALIBRATION','heatpercmin','5.0')
     config.set('CALIBRATION','heatpercmax','95')
     config.set('CALIBRATION','heatsigma','2.0')
+    config.set('CALIBRATION','online','True')
+    config.set('CALIBRATION','fixmethod','heatmap')
+    config.set('CALIBRATION','fixradius','3.0')
+    config.set('CALIBRATION','fixdwell','0.5')
+    config.set('CALIBRATION','reuse','fallback')
+    config.set('CALIBRATION','reusefrom','')
+    config.set('CALIBRATION','model','auto')
+    config.set('CALIBRATION','robust','True')
+    config.set('CALIBRATION','tpssmooth','0.01')
+    config.set('CALIBRATION','maxlooerror','0.1')
+
+    config.add_section('EVENTS')
+    config.set('EVENTS','detect','True')
+    config.set('EVENTS','velthresh','1.0')
+    config.set('EVENTS','dispthresh','0.05')
+    config.set('EVENTS','mindur','0.1')
+    config.set('EVENTS','blinkmerge','0.1')
+
+    config.add_section('FILTER')
+    config.set('FILTER','enabled','True')
+    config.set('FILTER','areamedian','0.25')
+    config.set('FILTER','centermedian','0.1')
+    config.set('FILTER','blinkmedian','0.25')
+    config.set('FILTER','artmedian','1.0')
+    config.set('FILTER','maxgap','0.5')
+    config.set('FILTER','lowpass','0.0')
+
+    config.add_section('MRI')
+    config.set('MRI','tr','0.0')
+    config.set('MRI','trigger','artifact')
+    config.set('MRI','volumes','0')
 
     config.add_section('OUTPUT')
     config.set('OUTPUT','verbose','True')
     config.set('OUTPUT','graphics','True')
     config.set('OUTPUT','overwrite','True')
+    config.set('OUTPUT','incremental','True')
+    config.set('OUTPUT','checkpointinterval','1000')
+    config.set('OUTPUT','resume','True')
+    config.set('OUTPUT','metrics','False')
+    config.set('OUTPUT','binary','False')
+    config.set('OUTPUT','sharedmemory','')
+    config.set('OUTPUT','sharedmemorysize','1024')
+    config.set('OUTPUT','streamaddress','')
+    config.set('OUTPUT','streambuffer','256')
+    config.set('OUTPUT','displayfps','15.0')
+    config.set('OUTPUT','controlstdin','True')
+    config.set('OUTPUT','controladdress','')
+    config.set('OUTPUT','reportworkers','0')
 
     config.add_section('CAMERA')
-    config.set('CAMERA','fps','30')
+    config.set('CAMERA','fps','30.0')
     config.set('CAMERA','device','thorlabs')
+    config.set('CAMERA','width','320')
+    config.set('CAMERA','height','240')
+    config.set('CAMERA','adaptive','False')
+    config.set('CAMERA','deadline','0.0')
 
     return config
 
@@ -158,3 +215,194 @@ def SaveConfig(config, data_dir):
 
     with open(root_cfg_file,'w') as cfg_stream:
         config.write(cfg_stream)
+
+
+def ValidateConfig(config, reference=None):
+    """ Check configuration values parse and are in range
+
+    Option types are taken from the defaults in InitConfig. If a reference
+    configuration is given, every option it defines must also be present,
+    so a running pipeline can switch to the new configuration safely.
+
+    Arguments
+    ----
+    config : Configuration settings to check
+    reference : Optional configuration currently in use
+
+    Returns
+    ----
+    errors : list of strings
+        Problems found (empty if valid)
+    """
+
+    errors = []
+
+    defaults = InitConfig(configparser.ConfigParser())
+
+    for section in defaults.sections():
+
+        if not config.has_section(section):
+            continue
+
+        for option, default in defaults.items(section):
+
+            if not config.has_option(section, option):
+                continue
+
+            value = config.get(section, option)
+
+            try:
+                if default in ('True', 'False'):
+                    config.getboolean(section, option)
+                elif (section, option) in FLOAT_OPTIONS:
+                    config.getfloat(section, option)
+                elif default.startswith('['):
+                    json.loads(value)
+                elif default.lstrip('-').isdigit():
+                    config.getint(section, option)
+                else:
+                    try:
+                        float(default)
+                    except ValueError:
+                        continue
+                    config.getfloat(section, option)
+            except ValueError:
+                errors.append('%s.%s : cannot parse "%s"' % (section, option, value))
+
+    if reference is not None:
+        for section in reference.sections():
+            for option in reference.options(section):
+                if not config.has_option(section, option):
+                    errors.append('%s.%s : missing' % (section, option))
+
+    if errors:
+        return errors
+
+    # Ranges of values the engine cannot work with
+    checks = [
+        ('VIDEO', 'downsampling', lambda v: float(v) >= 1.0, 'must be >= 1'),
+        ('CAMERA', 'fps', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('PUPILDETECT', 'manualroi', lambda v: len(json.loads(v)) == 3, 'must be [x, y, width]'),
+        ('PUPILFIT', 'method', lambda v: v in ('RANSAC_SUPPORT', 'RANSAC', 'ROBUST_LSQ', 'LSQ'), 'unknown method'),
+        ('PUPILFIT', 'maxiterations', lambda v: int(v) >= 1, 'must be >= 1'),
+        ('PUPILFIT', 'maxrefinements', lambda v: int(v) >= 1, 'must be >= 1'),
+        ('CALIBRATION', 'fixmethod', lambda v: v in ('heatmap', 'cluster'), 'must be heatmap or cluster'),
+        ('CALIBRATION', 'fixradius', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('CALIBRATION', 'fixdwell', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('CALIBRATION', 'model', lambda v: v in ('auto', 'affine', 'biquadratic', 'bicubic', 'tps'), 'unknown model'),
+        ('CALIBRATION', 'tpssmooth', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('CALIBRATION', 'maxlooerror', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('EVENTS', 'velthresh', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('EVENTS', 'dispthresh', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('EVENTS', 'mindur', lambda v: float(v) > 0.0, 'must be > 0'),
+        ('FILTER', 'areamedian', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('FILTER', 'centermedian', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('FILTER', 'blinkmedian', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('FILTER', 'artmedian', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('FILTER', 'lowpass', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('MRI', 'tr', lambda v: float(v) >= 0.0, 'must be >= 0'),
+        ('MRI', 'trigger', lambda v: v.strip() == 'artifact' or v.strip().replace('.', '', 1).isdigit(),
+         'must be artifact or a time >= 0'),
+        ('MRI', 'volumes', lambda v: int(v) >= 0, 'must be >= 0'),
+        ('CALIBRATION', 'reuse', lambda v: v in ('never', 'fallback', 'always'), 'must be never, fallback or always'),
+        ('OUTPUT', 'reportworkers', lambda v: int(v) >= 0, 'must be >= 0'),
+    ]
+
+    for section, option, ok, msg in checks:
+        if config.has_option(section, option) and not ok(config.get(section, option)):
+            errors.append('%s.%s : %s' % (section, option, msg))
+
+    return errors
+
+
+class ConfigWatcher(object):
+    """ Watch the root configuration file from a background thread
+
+    The file is checked every interval seconds. A changed file is parsed
+    and validated on the watcher thread. Invalid edits are reported and
+    ignored. A valid new configuration is held until the processing loop
+    collects it with Poll at a frame boundary. After that the watcher never
+    touches it again, so the loop swaps one reference and never sees a
+    half-parsed configuration.
+
+    Arguments
+    ----
+    data_dir : Directory containing mrgaze.cfg
+    config : Configuration currently in use
+    interval : Polling interval in seconds
+    """
+
+    def __init__(self, data_dir, config, interval=0.5):
+
+        self._cfg_file = os.path.join(data_dir, 'mrgaze.cfg')
+        self._data_dir = data_dir
+        self._reference = config
+        self._interval = interval
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._mtime = self._Mtime()
+
+        self._thread = threading.Thread(target=self._Run, name='mrgaze-config')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _Mtime(self):
+
+        try:
+            return os.stat(self._cfg_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _Run(self):
+
+        while not self._stop.wait(self._interval):
+
+            mtime = self._Mtime()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+
+            try:
+                new_config = LoadConfig(self._data_dir)
+            except configparser.Error as err:
+                print('* Configuration edit rejected - %s' % str(err).splitlines()[0])
+                continue
+
+            errors = ValidateConfig(new_config, self._reference)
+            if errors:
+                print('* Configuration edit rejected - keeping current settings')
+                for err in errors:
+                    print('    %s' % err)
+                continue
+
+            # Carry over the live mode flag set on the configuration in use
+            if hasattr(self._reference, 'live_eyetracking'):
+                new_config.live_eyetracking = self._reference.live_eyetracking
+
+            with self._lock:
+                self._pending = new_config
+                self._reference = new_config
+
+    def Poll(self):
+        """ New validated configuration since the last call, or None
+        """
+
+        if self._pending is None:
+            return None
+
+        with self._lock:
+            new_config, self._pending = self._pending, None
+
+        if new_config is not None:
+            print('  Configuration updated')
+
+        return new_config
+
+    def Close(self):
+        """ Stop watching
+        """
+
+        self._stop.set()
+        self._thread.join(timeout=1.0)
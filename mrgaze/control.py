@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Non-blocking command channel for live pupilometry
+
+Commands arrive from background threads reading stdin and/or a control
+socket, and from key presses in the preview window when one is shown. They
+are queued and polled once per frame, so command handling never waits on
+the GUI event loop.
+
+Commands (one per line on stdin or the control socket)
+----
+c, cal, calibrate : start calibration
+v, stop           : stop calibration
+f, freeze         : toggle freeze frame
+q, quit, esc      : quit
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import sys
+import queue
+import socket
+import threading
+
+# Command words mapped to the key codes used by the live loops
+COMMANDS = {
+    'c'         : 'c',
+    'cal'       : 'c',
+    'calibrate' : 'c',
+    'v'         : 'v',
+    'stop'      : 'v',
+    'f'         : 'f',
+    'freeze'    : 'f',
+    'q'         : 'ESC',
+    'quit'      : 'ESC',
+    'esc'       : 'ESC',
+}
+
+
+class ControlChannel(object):
+    '''
+    Queue of operator commands from stdin, a control socket and key presses
+
+    Arguments
+    ----
+    use_stdin : boolean
+        Read commands from standard input in a background thread
+    address : string
+        Optional control socket address, 'unix:<path>' or '[tcp:]<host>:<port>'
+    '''
+
+    def __init__(self, use_stdin=True, address=''):
+
+        self._queue = queue.Queue()
+        self._sock = None
+        self._addr = None
+
+        if use_stdin and sys.stdin is not None and not sys.stdin.closed:
+            self._start(self._read_stream, sys.stdin)
+
+        if address:
+
+            # Same address forms as the result stream server
+            from mrgaze import publish
+            family, self._addr = publish.ParseAddress(address)
+
+            if family == socket.AF_UNIX and os.path.exists(self._addr):
+                os.unlink(self._addr)
+
+            self._sock = socket.socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_INET:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(self._addr)
+            self._sock.listen(4)
+
+            self._start(self._accept)
+
+            print('  Listening for control commands on %s' % address)
+
+    def _start(self, target, *args):
+
+        th = threading.Thread(target=target, args=args, name='mrgaze-control')
+        th.daemon = True
+        th.start()
+
+    def _read_stream(self, stream):
+
+        for line in stream:
+            self.Put(line.strip().lower())
+
+    def _accept(self):
+
+        while True:
+
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+
+            self._start(self._read_stream, conn.makefile('r'))
+
+    def Put(self, command):
+        '''
+        Queue a command word or key press (unknown input is ignored)
+        '''
+
+        if command in ('ESC', '\x1b'):
+            self._queue.put('ESC')
+        elif command in COMMANDS:
+            self._queue.put(COMMANDS[command])
+
+    def Poll(self):
+        '''
+        Next queued command, or an empty string without waiting
+        '''
+
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return ''
+
+    def Close(self):
+        '''
+        Stop listening on the control socket
+        '''
+
+        if self._sock is None:
+            return
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+
+        if self._addr and isinstance(self._addr, str) and os.path.exists(self._addr):
+            os.unlink(self._addr)
@@ -24,14 +24,13 @@
  Copyright 2014-2016 California Institute of Technology.
 '''
 
-import os
 import cv2
 import json
 import numpy as np
 from skimage import measure, morphology
-from mrgaze import utils, fitellipse, improc
+from mrgaze import utils, fitellipse, improc, metrics
 
-def PupilometryEngine(frame, cascade, cfg):
+def PupilometryEngine(frame, cascade, cfg, display=True, roi_hint=None):
     """
     Detection and ellipse fitting of pupil boundary
 
@@ -43,6 +42,11 @@ def PupilometryEngine(frame, cascade, cfg):
         Pupil classifier cascade
     cfg : configuration object
         Analysis pipeline configuration parameters
+    display : boolean
+        Update the preview window for this frame if graphics are enabled
+    roi_hint : integer tuple
+        Optional pupil ROI (x, y, w, h) from a recent detection. The cascade
+        detector is skipped when given.
 
     Returns
     ----
@@ -68,15 +72,22 @@ def PupilometryEngine(frame, cascade, cfg):
     x, y, w, h = 0, 0, frw, frh
 
     # Shall we use the classifier at all, or whole frame?
-    if cfg.getboolean('PUPILDETECT', 'enabled'):
+    if cfg.getboolean('PUPILDETECT', 'enabled') and roi_hint is not None:
+
+        # Reuse ROI from a recent cascade detection
+        x, y, w, h = roi_hint
+
+    elif cfg.getboolean('PUPILDETECT', 'enabled'):
 
         min_neighbors = cfg.getint('PUPILDETECT', 'specificity')
         scale_factor  = cfg.getfloat('PUPILDETECT', 'scalefactor')
 
         # Find pupils in frame
+        tm = metrics.Tic()
         pupils, num_detections = cascade.detectMultiScale2(image=frame,
                                             scaleFactor=scale_factor,
                                             minNeighbors=min_neighbors)
+        metrics.Toc('cascade', tm)
 
         # Count detected pupil candidates
         n_pupils = len(pupils)
@@ -144,18 +155,24 @@ def PupilometryEngine(frame, cascade, cfg):
         # BEGIN ENGINE CORE
 
         # Find and remove primary glint in ROI (assumes single illumination source)
+        tm = metrics.Tic()
         glint, glint_mask, roi_noglint = FindRemoveGlint(roi, cfg)
+        metrics.Toc('glint', tm)
 
         if np.isnan(glint[0]):
             blink = True
 
         # Segment pupil within ROI
+        tm = metrics.Tic()
         pupil_bw, pupil_labels, roi_rescaled = SegmentPupil(roi_noglint, cfg)
+        metrics.Toc('segment', tm)
 
         if pupil_bw.sum() > 0:
 
             # Fit ellipse to pupil boundary - returns ellipse parameter tuple
+            tm = metrics.Tic()
             ell = FitPupil(pupil_bw, roi, cfg)
+            metrics.Toc('fit', tm)
 
             # Add ROI offset to ellipse center and glint
             pupil_ellipse = (x + ell[0][0], y + ell[0][1]),ell[1], ell[2]
@@ -172,10 +189,11 @@ def PupilometryEngine(frame, cascade, cfg):
         #     blink = True
 
     # Overlay ROI, pupil ellipse and pseudo-glint on background RGB frame
+    tm = metrics.Tic()
     frame_rgb = OverlayPupil(frame_rgb, pupil_ellipse, roi_rect, glint_center)
 
 
-    if cfg.getboolean('OUTPUT', 'graphics'):
+    if display and cfg.getboolean('OUTPUT', 'graphics'):
 
         # Rescale and cast label images to uint8/ubyte
         pupil_labels = utils._touint8(pupil_labels)
@@ -208,6 +226,8 @@ def PupilometryEngine(frame, cascade, cfg):
         cv2.imshow('Pupilometry', montage_rgb)
         # cv2.waitKey(1)
 
+    metrics.Toc('overlay', tm)
+
 
     return pupil_ellipse, roi_rect, blink, glint_center, frame_rgb
 
@@ -372,7 +392,7 @@ def FindRemoveGlint(roi, cfg):
     bright_props = measure.regionprops(bright_labels)
 
     # Init glint parameters
-    r_min = np.Inf
+    r_min = np.inf
     glint_label = -1
     glint = (0, 0)
     glint_mask = np.zeros_like(roi, dtype="uint8")
@@ -536,8 +556,8 @@ def ReadPupilometry(pupils_csv):
         5 : MR artifact power
     '''
 
-    # Read time series in rows
-    return np.genfromtxt(pupils_csv, delimiter=',')
+    # Read time series in rows (keep 2D for single-sample files)
+    return np.atleast_2d(np.genfromtxt(pupils_csv, delimiter=','))
 
 
 def PupilometryPars(ellipse, glint, cfg):
@@ -577,41 +597,11 @@ def PupilometryPars(ellipse, glint, cfg):
     return px, py, area
 
 
-def FilterPupilometry(pupils_csv, pupils_filt_csv):
+def FilterPupilometry(pupils_csv, pupils_filt_csv, cfg=None):
     '''
-    DEPRECATED: Temporally filter all pupilometry timeseries
+    Temporally filter all pupilometry timeseries (see filtering module)
     '''
 
-    if not os.path.isfile(pupils_csv):
-        print('* Raw pupilometry CSV file missing - returning')
-        return False
-
-    # Read raw pupilometry data
-    p = ReadPupilometry(pupils_csv)
-
-    # Sampling time (s)
-    dt = p[1,0] - p[0,0]
-
-    # Kernel widths for each metric
-    k_area  = utils._forceodd(0.25 / dt)
-    k_pupil = 3
-    k_blink = utils._forceodd(0.25 / dt)
-    k_art   = utils._forceodd(1.0 / dt)
-
-    # Moving median filter
-    pf = p.copy()
-    pf[:,1] = utils._nanmedfilt(p[:,1], k_area)
-    pf[:,2] = utils._nanmedfilt(p[:,2], k_pupil) # Pupil x
-    pf[:,3] = utils._nanmedfilt(p[:,3], k_pupil) # Pupil y
-
-    # Blink filter
-    pf[:,4] = utils._nanmedfilt(p[:,8], k_blink)
-
-    # Artifact power
-    pf[:,5] = utils._nanmedfilt(pf[:,9], k_art)
-
-    # Write filtered timeseries to new CSV file in results directory
-    np.savetxt(pupils_filt_csv, pf, fmt='%.6f', delimiter=',')
+    from mrgaze import filtering
 
-    # Clean return
-    return True
+    return filtering.FilterPupilometry(pupils_csv, pupils_filt_csv, cfg)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+"""
+Fixation, saccade and blink detection in calibrated gaze
+
+Each calibrated gaze sample is labelled by two standard detectors:
+
+  ivt : velocity threshold (I-VT). Samples with gaze speed above
+        EVENTS.velthresh (gaze units per second) are saccades, the rest are
+        fixations.
+  idt : dispersion threshold (I-DT). Samples covered by a window of at least
+        EVENTS.mindur seconds with dispersion (x range + y range) below
+        EVENTS.dispthresh are fixations, the rest are saccades.
+
+Blinks come from the blink column of the gaze pupilometry and from missing
+gaze. Blinks separated by less than EVENTS.blinkmerge seconds are merged
+into one. Fixations shorter than EVENTS.mindur are labelled as other.
+
+All detectors run on whole timeseries with running filters and cumulative
+sums, without per-sample Python loops, so multi-hour recordings take
+seconds. Runs of equal labels are written as events to
+results/gaze_events.csv.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+# Sample labels
+FIXATION, SACCADE, BLINK, OTHER = 0, 1, 2, 3
+EVENT_NAMES = ('fixation', 'saccade', 'blink', 'other')
+
+# Detection methods
+METHODS = ('ivt', 'idt')
+
+# Events table columns after method and event name
+EVENT_COLUMNS = ('t_start', 't_end', 'duration', 'x', 'y', 'amplitude', 'peak_velocity')
+
+
+def DetectGazeEvents(ss_dir, cfg):
+    '''
+    Detect gaze events in calibrated gaze and write the events table
+
+    Arguments
+    ----
+    ss_dir : string
+        Subject/session directory containing results subdir
+    cfg : configuration object
+        EVENTS detection thresholds
+
+    Returns
+    ----
+    success : boolean
+        True if the events table was written
+    '''
+
+    ss_res_dir = os.path.join(ss_dir, 'results')
+    gaze_csv = os.path.join(ss_res_dir, 'gaze_calibrated.csv')
+    pupils_csv = os.path.join(ss_res_dir, 'gaze_pupils.csv')
+    events_csv = os.path.join(ss_res_dir, 'gaze_events.csv')
+
+    if not os.path.isfile(gaze_csv):
+        print('* Calibrated gaze not found - returning')
+        return False
+
+    vel_thresh = cfg.getfloat('EVENTS', 'velthresh', fallback=1.0)
+    disp_thresh = cfg.getfloat('EVENTS', 'dispthresh', fallback=0.05)
+    min_dur = cfg.getfloat('EVENTS', 'mindur', fallback=0.1)
+    blink_merge = cfg.getfloat('EVENTS', 'blinkmerge', fallback=0.1)
+
+    # Calibrated gaze : t, gaze x, gaze y (motion baselines not needed)
+    g = np.loadtxt(gaze_csv, delimiter=',', usecols=(0, 1, 2), ndmin=2)
+    t, gx, gy = g[:,0], g[:,1], g[:,2]
+
+    # Blink flags from the gaze pupilometry, matched by sample time
+    if os.path.isfile(pupils_csv):
+        p = np.loadtxt(pupils_csv, delimiter=',', usecols=(0, 4), ndmin=2)
+        idx = np.clip(np.searchsorted(p[:,0], t), 0, p.shape[0] - 1)
+        blink = p[idx, 1] > 0
+    else:
+        blink = np.zeros(t.shape[0], dtype=bool)
+
+    blinks = BlinkMask(t, gx, gy, blink, blink_merge)
+    speed = GazeSpeed(t, gx, gy)
+
+    print('  Detecting gaze events in %d samples (%0.1f s)' % (t.shape[0], t[-1] - t[0] if t.size else 0.0))
+
+    events = {}
+
+    for method in METHODS:
+
+        if method == 'ivt':
+            labels, breaks = VelocityThreshold(t, speed, blinks, vel_thresh, min_dur), None
+        else:
+            labels, breaks = DispersionThreshold(t, gx, gy, blinks, disp_thresh, min_dur)
+
+        events[method] = EventTable(t, gx, gy, speed, labels, breaks)
+
+        for name, stats in EventSummary(events[method], t).items():
+            print('  %s %-9s : %6d events  %6.1f /min  median %0.3f s' %
+                  (method, name, stats['count'], stats['rate'], stats['median_duration']))
+
+    WriteEvents(events_csv, events)
+
+    return True
+
+
+def RunLengths(labels, breaks=None):
+    '''
+    Starts and ends (exclusive) of runs of equal values in a 1D array
+
+    A run also starts wherever breaks is True.
+    '''
+
+    n = labels.shape[0]
+
+    if n == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    change = labels[1:] != labels[:-1]
+    if breaks is not None:
+        change |= breaks[1:]
+
+    starts = np.concatenate(([0], np.flatnonzero(change) + 1))
+    ends = np.concatenate((starts[1:], [n]))
+
+    return starts, ends
+
+
+def BlinkMask(t, gx, gy, blink, merge=0.1):
+    '''
+    Blink samples (flagged blinks and missing gaze), merging close blinks
+
+    Arguments
+    ----
+    t : 1D float array
+        Sample times in seconds
+    gx, gy : 1D float arrays
+        Calibrated gaze
+    blink : 1D boolean array
+        Blink flags from pupilometry
+    merge : float
+        Blinks separated by gaps shorter than this (seconds) are merged
+
+    Returns
+    ----
+    blinks : 1D boolean array
+    '''
+
+    blinks = blink | ~np.isfinite(gx) | ~np.isfinite(gy)
+
+    starts, ends = RunLengths(blinks)
+    on = blinks[starts]
+    b_start, b_end = starts[on], ends[on]
+
+    if b_start.shape[0] < 2:
+        return blinks
+
+    # Gap from the first open sample after a blink to the next blink onset
+    gap = t[b_start[1:]] - t[b_end[:-1]]
+    fill = gap < merge
+
+    # Mark filled gaps with +1/-1 steps and integrate
+    steps = np.zeros(t.shape[0] + 1, dtype=int)
+    np.add.at(steps, b_end[:-1][fill], 1)
+    np.add.at(steps, b_start[1:][fill], -1)
+
+    return blinks | (np.cumsum(steps[:-1]) > 0)
+
+
+def GazeSpeed(t, gx, gy):
+    '''
+    Gaze speed (gaze units per second) by central differences
+
+    NaN next to missing samples.
+    '''
+
+    if t.shape[0] < 2:
+        return np.full(t.shape[0], np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vx = np.gradient(gx, t)
+        vy = np.gradient(gy, t)
+
+    return np.hypot(vx, vy)
+
+
+def VelocityThreshold(t, speed, blinks, vel_thresh=1.0, min_dur=0.1):
+    '''
+    I-VT sample labels
+
+    Returns
+    ----
+    labels : 1D int8 array
+        FIXATION, SACCADE, BLINK or OTHER for each sample
+    '''
+
+    labels = np.full(t.shape[0], OTHER, dtype=np.int8)
+
+    labels[speed <= vel_thresh] = FIXATION
+    labels[speed > vel_thresh] = SACCADE
+    labels[blinks] = BLINK
+
+    return _DropShortFixations(t, labels, min_dur)
+
+
+def DispersionThreshold(t, gx, gy, blinks, disp_thresh=0.05, min_dur=0.1):
+    '''
+    I-DT sample labels
+
+    Every window of min_dur seconds (in samples at the median sample
+    interval) with dispersion below disp_thresh marks its samples as a
+    fixation. Windows containing blinks or missing gaze never qualify.
+    Neighbouring fixated samples that share no qualifying window belong to
+    different fixations, as when the greedy I-DT window restarts.
+
+    Returns
+    ----
+    labels : 1D int8 array
+        FIXATION, SACCADE or BLINK for each sample
+    breaks : 1D boolean array
+        True where a new fixation starts straight after another one
+    '''
+
+    n = t.shape[0]
+    labels = np.full(n, SACCADE, dtype=np.int8)
+    breaks = np.zeros(n, dtype=bool)
+
+    if n < 2:
+        labels[blinks] = BLINK
+        return labels, breaks
+
+    dt = np.median(np.diff(t))
+    w = int(max(2, min(n, np.round(min_dur / dt) + 1)))
+
+    # Blinks push the window range to infinity
+    ok = ~blinks & np.isfinite(gx) & np.isfinite(gy)
+    x_hi, x_lo = np.where(ok, gx, np.inf), np.where(ok, gx, -np.inf)
+    y_hi, y_lo = np.where(ok, gy, np.inf), np.where(ok, gy, -np.inf)
+
+    # Forward windows [s, s + w) via origin shift
+    origin = -(w // 2)
+    disp = (maximum_filter1d(x_hi, w, origin=origin, mode='nearest') -
+            minimum_filter1d(x_lo, w, origin=origin, mode='nearest') +
+            maximum_filter1d(y_hi, w, origin=origin, mode='nearest') -
+            minimum_filter1d(y_lo, w, origin=origin, mode='nearest'))
+
+    # Windows running off the end are incomplete
+    good = disp <= disp_thresh
+    good[n - w + 1:] = False
+
+    # Sample is fixated if any window starting in (i - w, i] qualifies
+    c = np.concatenate(([0], np.cumsum(good)))
+    i = np.arange(n)
+    covered = c[i + 1] - c[np.maximum(i - w + 1, 0)] > 0
+
+    # Samples i and i + 1 share a window if one starts in (i + 1 - w, i]
+    shared = c[i[:-1] + 1] - c[np.maximum(i[:-1] - w + 2, 0)] > 0
+    breaks[1:] = covered[:-1] & covered[1:] & ~shared
+
+    labels[covered] = FIXATION
+    labels[blinks] = BLINK
+
+    return labels, breaks
+
+
+def _DropShortFixations(t, labels, min_dur):
+    '''
+    Relabel fixation runs shorter than min_dur seconds as OTHER
+    '''
+
+    starts, ends = RunLengths(labels)
+
+    fix = labels[starts] == FIXATION
+    short = fix & (t[ends - 1] - t[starts] < min_dur)
+
+    if short.any():
+        steps = np.zeros(t.shape[0] + 1, dtype=int)
+        np.add.at(steps, starts[short], 1)
+        np.add.at(steps, ends[short], -1)
+        labels[np.cumsum(steps[:-1]) > 0] = OTHER
+
+    return labels
+
+
+def EventTable(t, gx, gy, speed, labels, breaks=None):
+    '''
+    Collapse sample labels into events (see RunLengths for breaks)
+
+    Returns
+    ----
+    events : dict of 1D arrays
+        event (label), t_start, t_end, duration, mean x and y (fixations),
+        amplitude (saccades, between flanking samples) and peak_velocity
+    '''
+
+    n = t.shape[0]
+    starts, ends = RunLengths(labels, breaks)
+
+    if n == 0:
+        empty = np.zeros(0)
+        return dict([('event', np.zeros(0, dtype=np.int8))] + [(k, empty) for k in EVENT_COLUMNS])
+
+    event = labels[starts]
+
+    # Events end where the next one starts
+    t_start = t[starts]
+    t_end = t[np.minimum(ends, n - 1)]
+
+    # Mean position over finite samples
+    ok = np.isfinite(gx) & np.isfinite(gy)
+    n_ok = np.add.reduceat(ok.astype(float), starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.add.reduceat(np.where(ok, gx, 0.0), starts) / n_ok
+        y = np.add.reduceat(np.where(ok, gy, 0.0), starts) / n_ok
+
+    # Saccade amplitude between the samples either side of the event
+    i0 = np.maximum(starts - 1, 0)
+    i1 = np.minimum(ends, n - 1)
+    amplitude = np.hypot(gx[i1] - gx[i0], gy[i1] - gy[i0])
+
+    peak = np.maximum.reduceat(np.where(np.isfinite(speed), speed, -np.inf), starts)
+    peak[~np.isfinite(peak)] = np.nan
+
+    fix = event == FIXATION
+    sac = event == SACCADE
+
+    return {
+        'event'         : event,
+        't_start'       : t_start,
+        't_end'         : t_end,
+        'duration'      : t_end - t_start,
+        'x'             : np.where(fix, x, np.nan),
+        'y'             : np.where(fix, y, np.nan),
+        'amplitude'     : np.where(sac, amplitude, np.nan),
+        'peak_velocity' : np.where(sac, peak, np.nan),
+    }
+
+
+def EventSummary(events, t=None):
+    '''
+    Count, rate and duration statistics for each event type
+
+    Arguments
+    ----
+    events : dict of 1D arrays
+        Events from EventTable or ReadEvents (one method)
+    t : 1D float array
+        Sample times, for the recording duration (defaults to event span)
+
+    Returns
+    ----
+    summary : dict
+        Per event name : count, rate (per minute), time fraction, mean and
+        median duration, mean amplitude and peak velocity
+    '''
+
+    if t is not None and t.shape[0] > 1:
+        total = t[-1] - t[0]
+    elif events['t_start'].shape[0]:
+        total = events['t_end'].max() - events['t_start'].min()
+    else:
+        total = 0.0
+
+    summary = {}
+
+    for code, name in enumerate(EVENT_NAMES):
+
+        sel = events['event'] == code
+        count = int(sel.sum())
+        if not count:
+            continue
+
+        dur = events['duration'][sel]
+
+        with np.errstate(invalid='ignore'):
+            summary[name] = {
+                'count'           : count,
+                'rate'            : 60.0 * count / total if total > 0 else np.nan,
+                'fraction'        : dur.sum() / total if total > 0 else np.nan,
+                'mean_duration'   : dur.mean(),
+                'median_duration' : np.median(dur),
+                'amplitude'       : np.nanmean(events['amplitude'][sel]) if name == 'saccade' else np.nan,
+                'peak_velocity'   : np.nanmean(events['peak_velocity'][sel]) if name == 'saccade' else np.nan,
+            }
+
+    return summary
+
+
+def WriteEvents(events_csv, events):
+    '''
+    Write events from each method to a CSV table with a header row
+    '''
+
+    rows = []
+
+    for method, ev in events.items():
+        names = np.array(EVENT_NAMES)[ev['event']]
+        vals = np.column_stack([ev[k] for k in EVENT_COLUMNS])
+        for name, v in zip(names, vals):
+            rows.append('%s,%s,%0.3f,%0.3f,%0.3f,%0.4f,%0.4f,%0.4f,%0.3f' % ((method, name) + tuple(v)))
+
+    try:
+        with open(events_csv, 'w') as events_stream:
+            events_stream.write(','.join(('method', 'event') + EVENT_COLUMNS) + '\n')
+            if rows:
+                events_stream.write('\n'.join(rows) + '\n')
+    except IOError:
+        print('* Problem saving gaze events to CSV file - skipping')
+        return False
+
+    return True
+
+
+def ReadEvents(events_csv):
+    '''
+    Read an events table written by WriteEvents
+
+    Returns
+    ----
+    events : dict
+        Per method dict of 1D arrays as returned by EventTable (empty if the
+        file is missing)
+    '''
+
+    if not os.path.isfile(events_csv):
+        return {}
+
+    # Header only
+    with open(events_csv, 'r') as events_stream:
+        events_stream.readline()
+        if not events_stream.readline():
+            return {}
+
+    method = np.loadtxt(events_csv, delimiter=',', skiprows=1, usecols=(0,), dtype=str, ndmin=1)
+    name = np.loadtxt(events_csv, delimiter=',', skiprows=1, usecols=(1,), dtype=str, ndmin=1)
+    vals = np.loadtxt(events_csv, delimiter=',', skiprows=1, ndmin=2,
+                      usecols=range(2, 2 + len(EVENT_COLUMNS)))
+
+    code = np.zeros(name.shape[0], dtype=np.int8)
+    for c, n in enumerate(EVENT_NAMES):
+        code[name == n] = c
+
+    events = {}
+
+    for m in METHODS:
+        sel = method == m
+        ev = dict((k, vals[sel, i]) for i, k in enumerate(EVENT_COLUMNS))
+        ev['event'] = code[sel]
+        events[m] = ev
+
+    return events
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+"""
+Temporal filtering of pupilometry timeseries
+
+Pupilometry CSV files (see engine.ReadPupilometry) are filtered in chunks
+so memory stays flat for long recordings. Each chunk passes through three
+stages, each holding back only the samples it needs from the next chunk:
+
+  median : centered NaN-aware running median of each column with its own
+           kernel in seconds (FILTER.areamedian, centermedian, blinkmedian,
+           artmedian). The blink flag median removes single-frame flicker.
+  blinks : pupil area and center during blinks (and missing fits) are
+           linearly interpolated between the samples either side, for gaps
+           up to FILTER.maxgap seconds. Longer gaps stay NaN. The blink flag
+           is kept.
+  lowpass : optional causal Butterworth low-pass of area and center at
+           FILTER.lowpass Hz (0 disables)
+
+The filtered timeseries are written in the same column format as the input.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import itertools
+import numpy as np
+from mrgaze import utils
+
+# Pupilometry columns (see engine.ReadPupilometry)
+T, AREA, PX, PY, BLINK, ART = range(6)
+
+# Output row format, as written by pupilometry
+FILT_FORMAT = '%0.3f,%0.3f,%0.3f,%0.3f,%d,%0.3f,'
+
+# Default median kernels in seconds for area, center, blink and artifact power
+DEFAULT_KERNELS = (0.25, 0.1, 0.25, 1.0)
+
+# Leading samples used to estimate the sample interval
+DT_SAMPLES = 64
+
+
+def FilterPupilometry(pupils_csv, pupils_filt_csv, cfg=None, chunk=65536):
+    '''
+    Filter a pupilometry CSV file in chunks
+
+    Arguments
+    ----
+    pupils_csv : string
+        Input pupilometry CSV file
+    pupils_filt_csv : string
+        Filtered output CSV file
+    cfg : configuration object
+        FILTER settings (defaults if None)
+    chunk : integer
+        Rows read and filtered at a time
+
+    Returns
+    ----
+    success : boolean
+        True if the filtered file was written
+    '''
+
+    if not os.path.isfile(pupils_csv):
+        print('* Raw pupilometry CSV file missing - returning')
+        return False
+
+    def Get(option, default):
+        if cfg is None:
+            return default
+        return cfg.getfloat('FILTER', option, fallback=default)
+
+    kernels = (Get('areamedian', DEFAULT_KERNELS[0]), Get('centermedian', DEFAULT_KERNELS[1]),
+               Get('blinkmedian', DEFAULT_KERNELS[2]), Get('artmedian', DEFAULT_KERNELS[3]))
+    max_gap = Get('maxgap', 0.5)
+    cutoff = Get('lowpass', 0.0)
+
+    def Start(p):
+        # Sample interval from the leading samples sets all kernels
+        t = p[:DT_SAMPLES, T]
+        dt = np.median(np.diff(t)) if t.shape[0] > 1 else 1.0
+        return PupilFilter(dt, kernels, max_gap, cutoff)
+
+    filt = None
+    pending = np.zeros((0, 6))
+    n_rows = 0
+
+    with open(pupils_csv, 'r') as in_stream, open(pupils_filt_csv, 'w') as out_stream:
+
+        while True:
+
+            lines = list(itertools.islice(in_stream, chunk))
+            if not lines:
+                break
+
+            p = np.loadtxt(lines, delimiter=',', usecols=range(6), ndmin=2)
+
+            # Hold rows until the sample interval can be estimated, so the
+            # kernels do not depend on the chunk size
+            if filt is None:
+                pending = np.concatenate((pending, p))
+                if pending.shape[0] < DT_SAMPLES:
+                    continue
+                filt, p = Start(pending), pending
+
+            n_rows += WriteFiltered(out_stream, filt.Push(p))
+
+        # Short files never fill the estimate
+        if filt is None and pending.shape[0]:
+            filt = Start(pending)
+            n_rows += WriteFiltered(out_stream, filt.Push(pending))
+
+        if filt is not None:
+            n_rows += WriteFiltered(out_stream, filt.Finish())
+
+    print('  Filtered %d samples to %s' % (n_rows, os.path.basename(pupils_filt_csv)))
+
+    return True
+
+
+def WriteFiltered(out_stream, p):
+    '''
+    Append filtered rows to an open CSV stream, returning the row count
+    '''
+
+    if p.shape[0]:
+        np.savetxt(out_stream, p, fmt=FILT_FORMAT)
+
+    return p.shape[0]
+
+
+class PupilFilter(object):
+    '''
+    Chunked median, blink interpolation and low-pass filter chain
+
+    Push returns filtered rows as they become final, and Finish returns
+    the rest. The concatenated output is independent of the chunk sizes.
+
+    Arguments
+    ----
+    dt : float
+        Sample interval in seconds
+    kernels : float tuple
+        Median kernels in seconds for area, center, blink and artifact power
+    max_gap : float
+        Longest blink gap interpolated in seconds
+    cutoff : float
+        Low-pass cutoff in Hz (0 disables)
+    '''
+
+    def __init__(self, dt, kernels, max_gap=0.5, cutoff=0.0):
+
+        k_area, k_center, k_blink, k_art = [max(utils._forceodd(k / dt), 1) for k in kernels]
+
+        self.stages = [
+            RunningMedian({AREA: k_area, PX: k_center, PY: k_center, BLINK: k_blink, ART: k_art}),
+            BlinkInterpolator(max_gap),
+        ]
+
+        if cutoff > 0.0:
+            if cutoff < 0.5 / dt:
+                self.stages.append(LowPass(cutoff, 1.0 / dt))
+            else:
+                print('* Low-pass cutoff above Nyquist frequency - skipping')
+
+    def Push(self, p):
+
+        for stage in self.stages:
+            p = stage.Push(p)
+
+        return p
+
+    def Finish(self):
+
+        p = np.zeros((0, 6))
+
+        # Flush each stage, passing its remainder through the stages after it
+        for stage in self.stages:
+            p = stage.Push(p) if p.shape[0] else p
+            p = np.concatenate((p, stage.Finish()))
+
+        return p
+
+
+class RunningMedian(object):
+    '''
+    Centered NaN-aware running median of selected columns over chunks
+
+    Output is delayed by the largest half-kernel so every window is complete.
+    Windows shrink at the start and end of the recording.
+
+    Arguments
+    ----
+    kernels : dict
+        Odd kernel width in samples for each filtered column
+    '''
+
+    def __init__(self, kernels):
+
+        self.kernels = kernels
+        self.delay = max(kernels.values()) // 2
+
+        # Already output samples (left context) followed by pending samples
+        self._buf = np.full((self.delay, 6), np.nan)
+
+    def Push(self, p):
+
+        buf = np.concatenate((self._buf, p))
+
+        # Samples with full right context
+        n_out = max(buf.shape[0] - 2 * self.delay, 0)
+
+        out = self._Filter(buf, n_out)
+
+        # Keep left context and pending samples for the next chunk
+        self._buf = buf[n_out:]
+
+        return out
+
+    def Finish(self):
+
+        # NaN right context completes the windows of the pending samples
+        return self.Push(np.full((self.delay, 6), np.nan))
+
+    def _Filter(self, buf, n_out):
+
+        i0 = self.delay
+        out = buf[i0:i0 + n_out].copy()
+
+        if n_out == 0:
+            return out
+
+        for col, k in self.kernels.items():
+            h = k // 2
+            win = np.lib.stride_tricks.sliding_window_view(buf[i0 - h:i0 + n_out + h, col], k)
+            out[:, col] = utils._nanmedian_rows(win)
+
+        return out
+
+
+class BlinkInterpolator(object):
+    '''
+    Linear interpolation of area and center across blinks over chunks
+
+    Samples after the last valid sample of a chunk are held until the next
+    valid sample arrives or the gap exceeds max_gap seconds.
+    '''
+
+    def __init__(self, max_gap=0.5):
+
+        self.max_gap = max_gap
+
+        # Last valid row already output, and rows held in an open gap
+        self._anchor = None
+        self._held = np.zeros((0, 6))
+
+    def Push(self, p):
+
+        buf = np.concatenate((self._held, p))
+
+        if buf.shape[0] == 0:
+            return buf
+
+        valid = self._Valid(buf)
+
+        if valid.any():
+            j = np.flatnonzero(valid)[-1] + 1
+        else:
+            j = 0
+
+        out, self._held = buf[:j], buf[j:]
+
+        # Give up on gaps already too long to interpolate
+        if self._held.shape[0] and not valid.any():
+            t_prev = self._anchor[T] if self._anchor is not None else -np.inf
+            if self._held[-1, T] - t_prev > self.max_gap:
+                out, self._held = self._held, np.zeros((0, 6))
+                return out
+
+        return self._Interpolate(out)
+
+    def Finish(self):
+
+        out, self._held = self._held, np.zeros((0, 6))
+
+        return out
+
+    def _Valid(self, p):
+
+        return (p[:, BLINK] < 0.5) & np.isfinite(p[:, AREA]) & np.isfinite(p[:, PX]) & np.isfinite(p[:, PY])
+
+    def _Interpolate(self, out):
+
+        if out.shape[0] == 0:
+            return out
+
+        # Prepend the anchor so gaps at the chunk start can be filled
+        if self._anchor is not None:
+            seg = np.concatenate((self._anchor[np.newaxis], out))
+        else:
+            seg = out
+
+        valid = self._Valid(seg)
+        self._anchor = out[np.flatnonzero(self._Valid(out))[-1]].copy()
+
+        if valid.all():
+            return out
+
+        n = seg.shape[0]
+        i = np.arange(n)
+        t = seg[:, T]
+
+        # Times of the valid samples either side of each sample
+        prev = np.maximum.accumulate(np.where(valid, i, -1))
+        nxt = np.minimum.accumulate(np.where(valid, i, n)[::-1])[::-1]
+
+        fill = ~valid & (prev >= 0) & (nxt < n)
+        fill[fill] = t[nxt[fill]] - t[prev[fill]] <= self.max_gap
+
+        seg = seg.copy()
+        tv = t[valid]
+        for col in (AREA, PX, PY):
+            seg[fill, col] = np.interp(t[fill], tv, seg[valid, col])
+
+        return seg[n - out.shape[0]:]
+
+
+class LowPass(object):
+    '''
+    Causal Butterworth low-pass of area and center with state kept over chunks
+
+    NaN samples are bridged by holding the last finite input, and stay NaN
+    in the output. Each column starts from steady state at its first finite
+    input, so leading NaNs (eg. a blink at the start of the recording) pass
+    through without disturbing the filter, whatever the chunk sizes.
+    '''
+
+    def __init__(self, cutoff, fs, order=2):
+
+        # Deferred import - scipy.signal is slow to load
+        from scipy.signal import butter
+
+        self.sos = butter(order, cutoff, btype='low', fs=fs, output='sos')
+
+        # Filter state and last finite input of each column
+        self._zi = None
+        self._last = None
+
+    def Push(self, p):
+
+        from scipy.signal import sosfilt, sosfilt_zi
+
+        if p.shape[0] == 0:
+            return p
+
+        cols = [AREA, PX, PY]
+        x = p[:, cols]
+        bad = ~np.isfinite(x)
+
+        if self._last is None:
+            self._last = np.full(len(cols), np.nan)
+            self._zi = np.zeros(sosfilt_zi(self.sos).shape + (len(cols),))
+
+        # Start from steady state at the first finite input of each column
+        for c in np.flatnonzero(np.isnan(self._last) & ~bad.all(axis=0)):
+            self._last[c] = x[np.argmax(~bad[:, c]), c]
+            self._zi[:, :, c] = sosfilt_zi(self.sos) * self._last[c]
+
+        # Columns with no finite input yet pass through unchanged
+        ready = np.isfinite(self._last)
+        if not ready.any():
+            return p
+
+        # Hold the last finite input over NaNs
+        if bad.any():
+            idx = np.maximum.accumulate(np.where(bad, -1, np.arange(x.shape[0])[:, np.newaxis]), axis=0)
+            x = np.where(idx >= 0, np.take_along_axis(x, np.maximum(idx, 0), axis=0), self._last)
+
+        y = np.full_like(x, np.nan)
+        y[:, ready], self._zi[:, :, ready] = sosfilt(self.sos, x[:, ready], axis=0, zi=self._zi[:, :, ready])
+        self._last[ready] = x[-1, ready]
+
+        out = p.copy()
+        out[:, cols] = np.where(bad, np.nan, y)
+
+        return out
+
+    def Finish(self):
+
+        return np.zeros((0, 6))
@@ -0,0 +1,653 @@
+#!/usr/bin/env python
+"""
+Frame pipeline shared by the live and offline pupilometry drivers
+
+A FramePipeline pulls one frame per Step from the source for the current
+mode ('cal', 'gaze' or a video stub), runs it through the stages and
+hands the result to every sink. The stages are preprocessing, the
+pupilometry engine, online calibration and calibrated gaze.
+
+Sinks are opened lazily per mode and stay open until the pipeline is
+closed, so switching between calibration and gaze modes costs no frames
+and never recreates writers.
+
+Example
+----
+>>> src = framepipeline.VideoSource(vin_stream, vin_fps, clock='video')
+>>> sinks = [framepipeline.CSVSink({'gaze': pupils_csv}), framepipeline.VideoSink({'gaze': vout_path})]
+>>> pipe = framepipeline.FramePipeline({'gaze': src}, cascade, cfg, sinks, 'gaze')
+>>> while pipe.Step() is not None:
+...     pass
+>>> pipe.Close()
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+from mrgaze import media, engine, metrics, calibrate
+
+# Pupilometry CSV line formats (live wall clock times need more precision)
+PUPILS_FORMAT = '%0.3f,%0.3f,%0.3f,%0.3f,%d,%0.3f,\n'
+PUPILS_FORMAT_LIVE = '%0.4f,%0.3f,%0.3f,%0.3f,%d,%0.3f,\n'
+
+
+class FrameResult(object):
+    '''
+    Everything known about one processed frame
+    '''
+
+    __slots__ = ('mode', 'index', 't', 't_cap', 't_read', 't_pre', 't_eng',
+                 'frame_orig', 'frame', 'art_power', 'display',
+                 'pupil_ellipse', 'roi_rect', 'blink', 'glint', 'frame_rgb',
+                 'px', 'py', 'area', 'gaze_x', 'gaze_y')
+
+
+class VideoSource(object):
+    '''
+    Frames from an opened video stream, camera or capture thread
+
+    Arguments
+    ----
+    v_in : video stream
+        cv2.VideoCapture or capture.LatestFrameCapture
+    fps : float
+        Frame rate used for the 'video' clock
+    clock : string
+        'video' : frame time is index / fps (offline videos)
+        'wall'  : frame time is the wall clock capture time (live)
+    index : integer
+        Index of the next frame (for resumed videos)
+    '''
+
+    def __init__(self, v_in, fps=30.0, clock='wall', index=0):
+
+        self.v_in = v_in
+        self.fps = fps
+        self.clock = clock
+        self.index = index
+
+    def Read(self, cfg):
+        '''
+        Next raw frame
+
+        Returns
+        ----
+        status : boolean
+            False when the stream is exhausted
+        fr : numpy uint8 array
+            Raw video frame
+        index : integer
+            Frame index in this source
+        t : float
+            Frame time in seconds
+        t_cap : float
+            Wall clock capture time in seconds
+        '''
+
+        t_cap = time.time()
+        status, fr = media.LoadVideoFrame(self.v_in, cfg)
+        t_cap = getattr(self.v_in, 't_capture', t_cap)
+
+        index = self.index
+        if status:
+            self.index += 1
+
+        t = index / self.fps if self.clock == 'video' else t_cap
+
+        return status, fr, index, t, t_cap
+
+
+#
+# Stages - called in order with the pipeline and the frame result
+#
+
+def PreprocStage(pipe, fr):
+    '''
+    Grayscale, artifact suppression, downsampling and intensity rescaling
+    '''
+
+    tm = metrics.Tic()
+    fr.frame, fr.art_power = media.Preproc(fr.frame_orig, pipe.cfg)
+    metrics.Toc('preproc', tm)
+
+    fr.t_pre = time.time()
+
+
+def EngineStage(pipe, fr):
+    '''
+    Pupil detection, segmentation and ellipse fit
+
+    Shows the preview at the display rate, and when adaptive quality
+    control is active, reuses the pupil ROI between scheduled cascade
+    detections and rescales results to full-quality pixels.
+    '''
+
+    # Only build and show the preview montage at the display rate
+    fr.display = pipe.graphics and time.time() - pipe.t_display >= pipe.display_period
+    if fr.display:
+        pipe.t_display = time.time()
+
+    # Reuse the last pupil ROI between scheduled cascade detections
+    adapt = pipe.adapt
+    roi_hint = pipe.roi_cache if adapt and not adapt.Detect(pipe.blink) else None
+
+    fr.pupil_ellipse, fr.roi_rect, fr.blink, fr.glint, fr.frame_rgb = \
+        engine.PupilometryEngine(fr.frame, pipe.cascade, pipe.cfg, fr.display, roi_hint)
+    fr.t_eng = time.time()
+
+    # Derive pupilometry parameters
+    fr.px, fr.py, fr.area = engine.PupilometryPars(fr.pupil_ellipse, fr.glint, pipe.cfg)
+
+    pipe.blink = fr.blink
+
+    if adapt:
+        (x0, y0), (x1, y1) = fr.roi_rect
+        pipe.roi_cache = None if fr.blink else (x0, y0, x1 - x0, y1 - y0)
+
+        # Report pupil center and area at full-quality resolution
+        s = adapt.Scale()
+        fr.px, fr.py, fr.area = fr.px * s, fr.py * s, fr.area * s * s
+
+
+def CalibrationStage(pipe, fr):
+    '''
+    Feed calibration mode samples to the online calibrator, if any
+
+    The calibrator's model is used for gaze as soon as it has been fitted.
+    '''
+
+    cal = pipe.calibrator
+
+    if cal is None or fr.mode != 'cal':
+        return
+
+    s = pipe.adapt.Scale() if pipe.adapt else 1.0
+    ny, nx = int(fr.frame.shape[0] * s), int(fr.frame.shape[1] * s)
+
+    if cal.Update(fr.t, fr.px, fr.py, fr.blink, nx, ny):
+        pipe.C = cal.C
+
+
+def GazeStage(pipe, fr):
+    '''
+    Calibrated gaze once a calibration model is available
+    '''
+
+    C = pipe.C
+
+    if C is not None and C.any():
+        px, py = fr.px, fr.py
+        gx, gy = calibrate.ApplyModel(C, px, py)
+        fr.gaze_x, fr.gaze_y = gx[0], gy[0]
+    else:
+        fr.gaze_x, fr.gaze_y = float('nan'), float('nan')
+
+
+STAGES = [PreprocStage, EngineStage, CalibrationStage, GazeStage]
+
+
+class FramePipeline(object):
+    '''
+    Source -> stages -> sinks frame loop core
+
+    Arguments
+    ----
+    sources : dict
+        Frame source for each mode (modes may share a source)
+    cascade : opencv LBP cascade object
+        Pupil classifier cascade
+    cfg : configuration object
+        Analysis configuration parameters
+    sinks : list
+        Result sinks, written in order for every frame
+    mode : string
+        Initial mode
+    adapt : adaptive.DeadlineController
+        Optional quality controller
+    graphics : boolean
+        Show the preview window
+    display_fps : float
+        Maximum preview refresh rate
+    '''
+
+    def __init__(self, sources, cascade, cfg, sinks, mode, adapt=None,
+                 graphics=False, display_fps=15.0):
+
+        self.sources = sources
+        self.cascade = cascade
+        self.cfg = cfg
+        self.sinks = sinks
+        self.mode = mode
+        self.adapt = adapt
+        self.stages = list(STAGES)
+
+        self.graphics = graphics
+        self.display_period = 1.0 / display_fps
+        self.t_display = 0.0
+
+        # Calibration model for gaze and optional online calibrator
+        self.C = None
+        self.calibrator = None
+
+        # Repeat the last raw frame instead of reading a new one
+        self.freeze = False
+        self._last = None
+
+        # Pupil ROI from the last detection and last blink state
+        self.roi_cache = None
+        self.blink = True
+
+    def SetConfig(self, cfg):
+        '''
+        Switch configuration at a frame boundary
+        '''
+
+        self.cfg = cfg
+
+        if self.adapt:
+            self.adapt.Rebase(cfg)
+
+    def SetMode(self, mode, restart=False):
+        '''
+        Switch mode without closing sinks
+
+        If restart is True, sinks discard anything already written for the
+        new mode (eg. a repeated calibration).
+        '''
+
+        self.mode = mode
+        self._last = None
+
+        if restart:
+            for sink in self.sinks:
+                sink.Restart(mode)
+
+    def Step(self):
+        '''
+        Process one frame
+
+        Returns
+        ----
+        fr : FrameResult
+            Results for this frame, or None if the current source is exhausted
+        '''
+
+        tf = metrics.Tic()
+
+        fr = FrameResult()
+        fr.mode = self.mode
+
+        if self.freeze and self._last is not None:
+
+            fr.frame_orig, fr.index, fr.t, fr.t_cap = self._last
+
+        else:
+
+            tm = metrics.Tic()
+            status, fr.frame_orig, fr.index, fr.t, fr.t_cap = self.sources[self.mode].Read(self.cfg)
+            metrics.Toc('decode', tm)
+
+            if not status:
+                return None
+
+            self._last = fr.frame_orig, fr.index, fr.t, fr.t_cap
+
+        fr.t_read = time.time()
+
+        for stage in self.stages:
+            stage(self, fr)
+
+        tm = metrics.Tic()
+        for sink in self.sinks:
+            sink.Write(fr)
+        metrics.Toc('write', tm)
+
+        # Adjust quality to the frame deadline (processing time, excluding the wait for a frame)
+        if self.adapt and self.adapt.Update(time.time() - fr.t_read, self.cfg):
+            self.roi_cache = None
+
+        metrics.Toc('frame', tf)
+        metrics.FrameDone()
+
+        return fr
+
+    def Flush(self):
+        '''
+        Push buffered sink output to disk (eg. before calibrating)
+        '''
+
+        for sink in self.sinks:
+            sink.Flush()
+
+    def Close(self):
+        '''
+        Close all sinks
+        '''
+
+        for sink in self.sinks:
+            sink.Close()
+
+
+#
+# Sinks
+#
+
+class Sink(object):
+    '''
+    Base result sink - per-mode outputs, no-op housekeeping by default
+    '''
+
+    def Write(self, fr):
+        pass
+
+    def Restart(self, mode):
+        pass
+
+    def Flush(self):
+        pass
+
+    def Close(self):
+        pass
+
+
+class CSVSink(Sink):
+    '''
+    Pupilometry CSV rows, one file per mode
+
+    Arguments
+    ----
+    paths : dict
+        CSV file path for each mode
+    fmt : string
+        Line format for (t, area, px, py, blink, art_power)
+    append : boolean
+        Append to existing files rather than overwriting (resumed runs)
+    '''
+
+    def __init__(self, paths, fmt=PUPILS_FORMAT, append=False):
+
+        self.paths = paths
+        self.fmt = fmt
+        self.append = append
+        self._streams = {}
+
+    def Stream(self, mode):
+        '''
+        Open file stream for a mode
+        '''
+
+        stream = self._streams.get(mode)
+
+        if stream is None:
+            stream = self._streams[mode] = open(self.paths[mode], 'a' if self.append else 'w')
+
+        return stream
+
+    def Write(self, fr):
+        self.Stream(fr.mode).write(self.fmt % (fr.t, fr.area, fr.px, fr.py, fr.blink, fr.art_power))
+
+    def Restart(self, mode):
+        if mode in self._streams:
+            self._streams[mode].seek(0)
+            self._streams[mode].truncate()
+
+    def Flush(self):
+        for stream in self._streams.values():
+            stream.flush()
+
+    def Close(self):
+        for stream in self._streams.values():
+            stream.close()
+        self._streams = {}
+
+
+class BinarySink(Sink):
+    '''
+    Pupilometry samples as fixed-size binary records, one file per mode
+
+    Records use the publish.SAMPLE_DTYPE layout shared with the shared
+    memory ring buffer and socket stream, with seq set to the frame index.
+    Read them back with ReadSamples.
+
+    Arguments
+    ----
+    paths : dict
+        Binary file path for each mode
+    n_keep : integer
+        Records to keep from existing files (resumed runs). None overwrites.
+    '''
+
+    def __init__(self, paths, n_keep=None):
+
+        from mrgaze import publish
+
+        self.paths = paths
+        self.n_keep = n_keep
+        self._rec = np.zeros(1, publish.SAMPLE_DTYPE)
+        self._streams = {}
+
+    def Stream(self, mode):
+        '''
+        Open file stream for a mode
+        '''
+
+        stream = self._streams.get(mode)
+
+        if stream is None:
+            if self.n_keep is None:
+                stream = open(self.paths[mode], 'wb')
+            else:
+                stream = open(self.paths[mode], 'r+b' if os.path.isfile(self.paths[mode]) else 'wb')
+                stream.truncate(self.n_keep * self._rec.itemsize)
+                stream.seek(0, os.SEEK_END)
+            self._streams[mode] = stream
+
+        return stream
+
+    def Write(self, fr):
+
+        rec = self._rec[0]
+        rec['seq'] = fr.index
+        rec['t'], rec['px'], rec['py'], rec['area'] = fr.t, fr.px, fr.py, fr.area
+        rec['gaze_x'], rec['gaze_y'] = fr.gaze_x, fr.gaze_y
+        rec['blink'], rec['art'] = fr.blink, fr.art_power
+
+        self.Stream(fr.mode).write(self._rec.tobytes())
+
+    def Restart(self, mode):
+        if mode in self._streams:
+            self._streams[mode].seek(0)
+            self._streams[mode].truncate()
+
+    def Flush(self):
+        for stream in self._streams.values():
+            stream.flush()
+
+    def Close(self):
+        for stream in self._streams.values():
+            stream.close()
+        self._streams = {}
+
+
+def ReadSamples(bin_path):
+    '''
+    Read binary pupilometry records written by BinarySink
+
+    Returns
+    ----
+    samples : numpy structured array (publish.SAMPLE_DTYPE)
+    '''
+
+    from mrgaze import publish
+
+    return np.fromfile(bin_path, publish.SAMPLE_DTYPE)
+
+
+class LatencySink(CSVSink):
+    '''
+    Capture-to-result latency timestamps, one file per mode
+
+    Columns are the wall clock capture time in seconds followed by the time
+    from capture to the end of preprocessing, engine and output in ms. The
+    output time is taken when this sink is written, so place it after the
+    sinks that deliver results. The total latency is also added to the
+    stage timing histograms.
+    '''
+
+    def __init__(self, paths):
+
+        CSVSink.__init__(self, paths)
+
+    def Write(self, fr):
+
+        t_out = time.time()
+
+        self.Stream(fr.mode).write('%0.4f,%0.3f,%0.3f,%0.3f,\n' % (
+            fr.t_cap, (fr.t_pre - fr.t_cap) * 1e3, (fr.t_eng - fr.t_cap) * 1e3, (t_out - fr.t_cap) * 1e3))
+
+        if metrics.Enabled():
+            metrics.Record('latency', t_out - fr.t_cap)
+
+
+class VideoSink(Sink):
+    '''
+    Video frames, one file per mode
+
+    Writers are opened on the first frame for each mode. Later frames of a
+    different size (adaptive downsampling) are resized to match, including
+    frames written to a new file after Split.
+
+    Arguments
+    ----
+    paths : dict
+        Video file path for each mode
+    fps : float
+        Output frame rate
+    field : string
+        FrameResult image to write ('frame_rgb' overlay or 'frame_orig' raw)
+    '''
+
+    def __init__(self, paths, fps=30.0, field='frame_rgb'):
+
+        self.paths = paths
+        self.fps = fps
+        self.field = field
+        self._writers = {}
+        self._sizes = {}
+        self.n_frames = dict((mode, 0) for mode in paths)
+
+    def Write(self, fr):
+
+        img = getattr(fr, self.field)
+
+        writer = self._writers.get(fr.mode)
+
+        if writer is None:
+
+            # Output video codec (MP4V - poor quality compression)
+            # TODO : Find a better multiplatform codec
+            fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
+
+            nx, ny = self._sizes.setdefault(fr.mode, (img.shape[1], img.shape[0]))
+            writer = cv2.VideoWriter(self.paths[fr.mode], fourcc, self.fps, (nx, ny), True)
+
+            if not writer.isOpened():
+                print('* Output video %s not opened - skipping video output' % self.paths[fr.mode])
+                writer = False
+
+            self._writers[fr.mode] = writer
+
+        if writer is False:
+            return
+
+        nx, ny = self._sizes[fr.mode]
+        if img.shape[0] != ny or img.shape[1] != nx:
+            img = cv2.resize(img, (nx, ny))
+
+        writer.write(img)
+        self.n_frames[fr.mode] += 1
+
+    def Split(self, mode, path):
+        '''
+        Close the current file for a mode and continue in a new file
+
+        The closed file is complete on disk and holds n_frames[mode] frames,
+        which are reset for the new file.
+        '''
+
+        writer = self._writers.pop(mode, None)
+        if writer:
+            writer.release()
+
+        self.paths[mode] = path
+        self.n_frames[mode] = 0
+
+    def Restart(self, mode):
+        '''
+        Start the file for a mode again (eg. a repeated calibration)
+
+        The writer is reopened on the next frame, overwriting the file, so
+        the video stays in step with the restarted CSV files.
+        '''
+
+        self.Split(mode, self.paths[mode])
+
+    def Close(self):
+        for writer in self._writers.values():
+            if writer:
+                writer.release()
+        self._writers = {}
+
+
+class CalibratedGazeSink(Sink):
+    '''
+    Calibrated gaze CSV for one mode (calibrate.StreamingCalibration)
+    '''
+
+    def __init__(self, calibration, mode='gaze'):
+        self.calibration = calibration
+        self.mode = mode
+        self.complete = False
+
+    def Write(self, fr):
+        if fr.mode == self.mode:
+            self.calibration.Add(fr.t, fr.px, fr.py)
+
+    def Flush(self):
+        self.calibration.Flush()
+
+    def Close(self):
+        self.complete = self.calibration.Close()
+
+
+class PublishSink(Sink):
+    '''
+    Live sample publisher (publish.GazePublisher or publish.GazeServer)
+    '''
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+
+    def Write(self, fr):
+        self.publisher.Publish(fr.t, fr.px, fr.py, fr.area, fr.blink, fr.art_power, fr.gaze_x, fr.gaze_y)
+
+    def Close(self):
+        self.publisher.Close()
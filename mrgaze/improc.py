@@ -21,9 +21,7 @@ Copyright 2014 California Institute of Technology.
 """
 
 import cv2
-import pywt
 import numpy as np
-from skimage import exposure
 from mrgaze import utils
 
 def EstimateBias(fr):
@@ -111,6 +109,7 @@ def RobustRescale(gray, perc_range=(5, 95)):
     if pB == pA:
         gray_rescale = gray
     else:
+        from skimage import exposure
         gray_rescale = exposure.rescale_intensity(gray, in_range=(pA, pB))
 
     return gray_rescale
@@ -129,6 +128,8 @@ def WaveletNoiseSD(x):
     Estimate noise SD from wavelet detail coefficients
     '''
 
+    import pywt
+
     # Wavelet decomposition
     cA, cD = pywt.dwt(x.flatten(), 'db1')
 
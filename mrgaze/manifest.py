@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Stage manifest for incremental pipeline runs
+
+Each pipeline stage records a key built from content hashes of its input
+files, the config sections it depends on and the package version. A stage
+is only rerun when its key changes or its outputs are missing. The manifest
+lives in results/manifest.json for each subject/session.
+
+File hashes are cached by size and modification time, so unchanged videos
+are not rehashed on every run.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import json
+import time
+import hashlib
+import mrgaze
+
+# Config sections each stage depends on
+STAGE_SECTIONS = {
+    'cal_pupilometry'   : ['VIDEO', 'PREPROC', 'PUPILDETECT', 'PUPILSEG', 'PUPILFIT', 'ARTIFACTS', 'CAMERA'],
+    'gaze_pupilometry'  : ['VIDEO', 'PREPROC', 'PUPILDETECT', 'PUPILSEG', 'PUPILFIT', 'ARTIFACTS', 'CAMERA'],
+    'calibration'       : ['CALIBRATION'],
+    'calibration_model' : ['VIDEO', 'PREPROC', 'PUPILDETECT', 'PUPILSEG', 'PUPILFIT', 'ARTIFACTS', 'CAMERA',
+                           'CALIBRATION'],
+    'apply_calibration' : ['CALIBRATION', 'ARTIFACTS'],
+    'filter'            : ['FILTER'],
+    'events'            : ['EVENTS'],
+    'volumes'           : ['MRI'],
+    'report'            : ['CALIBRATION'],
+    'summary'           : ['CALIBRATION'],
+}
+
+# Read block size for file hashing
+_BLOCK_SIZE = 1 << 20
+
+
+def LoadManifest(ss_dir):
+    '''
+    Load the stage manifest for a subject/session, or start a new one
+
+    Arguments
+    ----
+    ss_dir : string
+        Subject/session directory containing results subdir
+
+    Returns
+    ----
+    man : dict
+        Manifest with 'files' hash cache and 'stages' records
+    '''
+
+    man_json = os.path.join(ss_dir, 'results', 'manifest.json')
+
+    man = {'version': mrgaze.__version__, 'files': {}, 'stages': {}}
+
+    if os.path.isfile(man_json):
+        try:
+            with open(man_json, 'r') as man_stream:
+                man.update(json.load(man_stream))
+        except ValueError:
+            print('* Stage manifest is corrupt - rerunning all stages')
+
+    # Remember location for SaveManifest
+    man['ss_dir'] = ss_dir
+
+    return man
+
+
+def SaveManifest(man):
+    '''
+    Write manifest to results/manifest.json, replacing any existing file atomically
+    '''
+
+    res_dir = os.path.join(man['ss_dir'], 'results')
+    man_json = os.path.join(res_dir, 'manifest.json')
+    tmp_json = man_json + '.tmp'
+
+    # Session directory is implied by manifest location
+    out = dict((k, v) for k, v in man.items() if k != 'ss_dir')
+    out['version'] = mrgaze.__version__
+
+    with open(tmp_json, 'w') as man_stream:
+        json.dump(out, man_stream, indent=2, sort_keys=True)
+
+    os.replace(tmp_json, man_json)
+
+
+def FileHash(man, path):
+    '''
+    SHA1 content hash of a file, cached by size and modification time
+
+    Returns None for missing files
+    '''
+
+    if not os.path.isfile(path):
+        return None
+
+    st = os.stat(path)
+    rel_path = os.path.relpath(path, man['ss_dir'])
+
+    # Reuse cached hash if file is unchanged on disk
+    cached = man['files'].get(rel_path)
+    if cached and cached['size'] == st.st_size and cached['mtime_ns'] == st.st_mtime_ns:
+        return cached['sha1']
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            h.update(block)
+
+    man['files'][rel_path] = {
+        'size'     : st.st_size,
+        'mtime_ns' : st.st_mtime_ns,
+        'sha1'     : h.hexdigest()
+    }
+
+    return h.hexdigest()
+
+
+def ConfigDict(cfg, sections):
+    '''
+    Extract named config sections as a plain nested dictionary
+    '''
+
+    return dict((s, dict(cfg.items(s))) for s in sections if cfg.has_section(s))
+
+
+def ConfigHash(cfg, stage):
+    '''
+    SHA1 of the config sections a stage depends on and the package version
+    '''
+
+    desc = {
+        'version' : mrgaze.__version__,
+        'config'  : ConfigDict(cfg, STAGE_SECTIONS[stage]),
+    }
+
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def StageKey(man, cfg, stage, input_files):
+    '''
+    Construct the input key for a pipeline stage
+
+    Arguments
+    ----
+    man : dict
+        Stage manifest
+    cfg : configuration object
+        Pipeline configuration
+    stage : string
+        Stage name (see STAGE_SECTIONS)
+    input_files : list of strings
+        Input file paths for this stage
+
+    Returns
+    ----
+    key : string
+        SHA1 of stage inputs, config sections and package version
+    '''
+
+    inputs = dict((os.path.relpath(f, man['ss_dir']), FileHash(man, f)) for f in input_files)
+
+    desc = {
+        'config' : ConfigHash(cfg, stage),
+        'inputs' : inputs,
+    }
+
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def StageCurrent(man, stage, key, output_files):
+    '''
+    Check whether a stage's recorded key matches and all its outputs exist
+    '''
+
+    rec = man['stages'].get(stage)
+
+    if not rec or rec['key'] != key:
+        return False
+
+    return all(os.path.isfile(f) for f in output_files)
+
+
+def UpdateStage(man, stage, key):
+    '''
+    Record a completed stage and save the manifest
+    '''
+
+    man['stages'][stage] = {'key': key, 'completed': time.time()}
+
+    SaveManifest(man)
@@ -22,8 +22,7 @@ Copyright 2014 California Institute of Technology.
 
 import cv2
 import numpy as np
-from mrgaze import improc, mrclean
-from skimage.transform import rotate
+from mrgaze import improc, mrclean, metrics
 
 
 def LoadVideoFrame(v_in, cfg):
@@ -57,6 +56,93 @@ def LoadVideoFrame(v_in, cfg):
     return status, fr
 
 
+def SeekFrame(v_in, frame_idx):
+    """ Position video stream so the next read returns frame frame_idx
+
+    Tries a direct seek first. Some codecs seek inexactly, so if the reported
+    position differs the stream is rewound and frames are grabbed without
+    decoding until the target is reached.
+
+    Parameters
+    ----------
+    v_in : opencv video stream
+        video input stream
+    frame_idx : integer
+        zero-based index of next frame to read
+
+    Returns
+    ----
+    status : boolean
+        True if stream is positioned at frame_idx
+    """
+
+    v_in.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+
+    if int(v_in.get(cv2.CAP_PROP_POS_FRAMES)) == frame_idx:
+        return True
+
+    # Fall back to grabbing frames from the start
+    v_in.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for fc in range(frame_idx):
+        if not v_in.grab():
+            return False
+
+    return True
+
+
+def JoinVideos(part_paths, vout_path, fps=30.0):
+    """ Concatenate video files into one video
+
+    Missing or unreadable parts are skipped. Frames are resized to the
+    size of the first frame.
+
+    Parameters
+    ----------
+    part_paths : list of strings
+        Video files in playback order
+    vout_path : string
+        Output video file
+    fps : float
+        Output frame rate
+
+    Returns
+    ----
+    n_frames : integer
+        Number of frames written
+    """
+
+    vout_stream = None
+    n_frames = 0
+
+    for part_path in part_paths:
+
+        vin_stream = cv2.VideoCapture(part_path)
+
+        while True:
+
+            status, fr = vin_stream.read()
+            if not status:
+                break
+
+            if vout_stream is None:
+                ny, nx = fr.shape[0], fr.shape[1]
+                fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
+                vout_stream = cv2.VideoWriter(vout_path, fourcc, fps, (nx, ny), True)
+
+            if fr.shape[0] != ny or fr.shape[1] != nx:
+                fr = cv2.resize(fr, (nx, ny))
+
+            vout_stream.write(fr)
+            n_frames += 1
+
+        vin_stream.release()
+
+    if vout_stream is not None:
+        vout_stream.release()
+
+    return n_frames
+
+
 def Preproc(fr, cfg):
     """
     Preprocess a single frame
@@ -100,7 +186,9 @@ def Preproc(fr, cfg):
 
     # Apply optional MR artifact suppression
     if do_mrclean:
+        tm = metrics.Tic()
         fr, art_power = mrclean.MRClean(fr, z_thresh)
+        metrics.Toc('mrclean', tm)
 
     # Downsample
     if downsampling > 1:
@@ -261,6 +349,7 @@ def RotateFrame(frame, theta_deg):
 
     else: # Arbitrary rotation
 
+        from skimage.transform import rotate
         new_frame = rotate(frame, theta_deg, resize=True)
 
         # Scale and recast to uint8
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Lightweight per-stage timing instrumentation for the pupilometry engine
+
+Stage latencies are accumulated into fixed log-spaced histograms
+(10 bins per decade from 1 us to 100 s), so recording a sample is a
+couple of perf_counter calls and a list increment. When instrumentation
+is disabled Tic and Toc return immediately.
+
+Example
+----
+>>> t = metrics.Tic()
+>>> fr, art_power = media.Preproc(fr, cfg)
+>>> metrics.Toc('preproc', t)
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import json
+import math
+import time
+
+# Histogram layout : log10(seconds) from -6 to 2, 10 bins per decade
+_LOG_MIN = -6.0
+_BINS_PER_DECADE = 10
+_N_BINS = 80
+
+# Module state - one session is instrumented at a time
+_enabled = False
+_stages = {}
+_t_start = 0.0
+_n_frames = 0
+
+
+def Enable(on=True):
+    '''
+    Turn instrumentation on or off and clear any accumulated timings
+    '''
+
+    global _enabled
+
+    _enabled = bool(on)
+
+    Reset()
+
+
+def Enabled():
+    return _enabled
+
+
+def Reset():
+    '''
+    Clear accumulated timings and restart the session clock
+    '''
+
+    global _stages, _t_start, _n_frames
+
+    _stages = {}
+    _t_start = time.perf_counter()
+    _n_frames = 0
+
+
+def Tic():
+    '''
+    Start time for a stage measurement (0.0 when disabled)
+    '''
+
+    if _enabled:
+        return time.perf_counter()
+
+    return 0.0
+
+
+def Toc(stage, t0):
+    '''
+    Record elapsed time since Tic for a named stage
+    '''
+
+    if _enabled:
+        Record(stage, time.perf_counter() - t0)
+
+
+def Record(stage, dt):
+    '''
+    Add a latency sample in seconds to a stage histogram
+    '''
+
+    s = _stages.get(stage)
+    if s is None:
+        s = _stages[stage] = [0, 0.0, float('inf'), 0.0, [0] * _N_BINS]
+
+    s[0] += 1
+    s[1] += dt
+    if dt < s[2]:
+        s[2] = dt
+    if dt > s[3]:
+        s[3] = dt
+
+    if dt > 0.0:
+        b = int((math.log10(dt) - _LOG_MIN) * _BINS_PER_DECADE)
+        b = 0 if b < 0 else (_N_BINS - 1 if b >= _N_BINS else b)
+    else:
+        b = 0
+
+    s[4][b] += 1
+
+
+def FrameDone():
+    '''
+    Count a completed frame for session throughput
+    '''
+
+    global _n_frames
+
+    if _enabled:
+        _n_frames += 1
+
+
+def BinEdges():
+    '''
+    Histogram bin edges in seconds (N_BINS + 1 values)
+    '''
+
+    return [10.0 ** (_LOG_MIN + float(b) / _BINS_PER_DECADE) for b in range(_N_BINS + 1)]
+
+
+def Percentile(counts, perc):
+    '''
+    Estimate a latency percentile in seconds from histogram counts
+
+    Uses the geometric center of the bin containing the percentile.
+    '''
+
+    n = sum(counts)
+    if n == 0:
+        return float('nan')
+
+    target = perc / 100.0 * n
+    cum = 0
+    for b, c in enumerate(counts):
+        cum += c
+        if cum >= target:
+            return 10.0 ** (_LOG_MIN + (b + 0.5) / _BINS_PER_DECADE)
+
+    return 10.0 ** (_LOG_MIN + (_N_BINS - 0.5) / _BINS_PER_DECADE)
+
+
+def Summary():
+    '''
+    Summarize accumulated timings
+
+    Returns
+    ----
+    summary : dict
+        Session wall time, frame count, throughput and per-stage statistics
+        (count, total, mean, min, max, p50, p95, p99 in milliseconds plus
+        the raw histogram counts)
+    '''
+
+    t_wall = time.perf_counter() - _t_start
+
+    stages = {}
+    for stage, (n, total, t_min, t_max, counts) in _stages.items():
+        stages[stage] = {
+            'count'    : n,
+            'total_s'  : total,
+            'mean_ms'  : total / n * 1e3 if n else float('nan'),
+            'min_ms'   : t_min * 1e3,
+            'max_ms'   : t_max * 1e3,
+            'p50_ms'   : Percentile(counts, 50.0) * 1e3,
+            'p95_ms'   : Percentile(counts, 95.0) * 1e3,
+            'p99_ms'   : Percentile(counts, 99.0) * 1e3,
+            'hist'     : counts,
+        }
+
+    return {
+        'wall_s'       : t_wall,
+        'frames'       : _n_frames,
+        'fps'          : _n_frames / t_wall if t_wall > 0.0 else 0.0,
+        'hist_edges_s' : BinEdges(),
+        'stages'       : stages,
+    }
+
+
+def SaveMetrics(metrics_json):
+    '''
+    Write timing summary to a JSON file if instrumentation is enabled
+    '''
+
+    if not _enabled:
+        return False
+
+    with open(metrics_json, 'w') as metrics_stream:
+        json.dump(Summary(), metrics_stream, indent=2)
+
+    return True
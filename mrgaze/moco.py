@@ -26,6 +26,7 @@
 #
 # Copyright 2014 California Institute of Technology.
 
+import warnings
 import cv2
 import numpy as np
 from scipy.ndimage.measurements import center_of_mass
@@ -86,6 +87,65 @@ def HighPassFilter(t, px, py, moco_kernel, central_fix):
     return px_filt, py_filt, px_bline, py_bline
 
 
+class CausalHighPassFilter(object):
+    '''
+    Slow drift correction by a trailing moving median
+
+    Streaming counterpart of HighPassFilter. The baseline at each sample is
+    the median of that sample and the previous moco_kernel - 1 samples, so
+    chunks can be corrected as they are measured. The baseline lags a drift
+    by about half a kernel compared with the centered median filter. NaN
+    samples (blinks) are ignored in the baseline.
+
+    Arguments
+    ----
+    moco_kernel : integer
+        Temporal kernel width in samples
+    central_fix : float tuple
+        (x,y) coordinate in video space of central fixation
+    '''
+
+    def __init__(self, moco_kernel, central_fix):
+
+        self.kernel = utils._forceodd(moco_kernel)
+        self.central_fix = central_fix
+
+        # Samples preceding the next chunk (NaN before the first sample)
+        self._hx = np.full(self.kernel - 1, np.nan)
+        self._hy = np.full(self.kernel - 1, np.nan)
+
+    def Apply(self, px, py):
+        '''
+        Correct the next chunk of pupil centers
+
+        Returns
+        ----
+        px_filt, py_filt : 1D float arrays
+            Drift corrected video space pupil center
+        px_bline, py_bline : 1D float arrays
+            Estimated baselines
+        '''
+
+        px_bline = self._Baseline(px, '_hx')
+        py_bline = self._Baseline(py, '_hy')
+
+        px_filt = px - px_bline + self.central_fix[0]
+        py_filt = py - py_bline + self.central_fix[1]
+
+        return px_filt, py_filt, px_bline, py_bline
+
+    def _Baseline(self, v, hist):
+
+        vh = np.concatenate((getattr(self, hist), v))
+        setattr(self, hist, vh[vh.shape[0] - (self.kernel - 1):])
+
+        # Trailing windows (n x kernel), all-NaN windows give a NaN baseline
+        win = np.lib.stride_tricks.sliding_window_view(vh, self.kernel)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmedian(win, axis=1)
+
+
 def KnownFixations(t, px, py, fixations_txt, central_fix):
     '''
     t : 1D float array
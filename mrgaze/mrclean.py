@@ -41,7 +41,6 @@ Copyright
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.signal import medfilt
 from scipy.ndimage.morphology import binary_dilation
 from mrgaze import utils
@@ -101,7 +100,7 @@ def MRClean(frame, z_thresh=8.0):
     bad_rows = np.abs(z) > z_thresh
 
     # Median smooth the bad rows mask then dilate by 3 lines (kernel 2*3+1 = 7)
-    bad_rows = medfilt(bad_rows)
+    bad_rows = medfilt(bad_rows.astype(float)) > 0
     bad_rows = binary_dilation(bad_rows, structure=np.ones((7,)))
 
     # If an artifact is present
@@ -169,6 +168,8 @@ def MRClean(frame, z_thresh=8.0):
         # Display results
         if DEBUG:
 
+            import matplotlib.pyplot as plt
+
             ny = bad_rows.shape[0]
             y = np.arange(0,ny)
 
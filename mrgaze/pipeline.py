@@ -33,7 +33,7 @@ Copyright 2014 California Institute of Technology.
 
 import os
 import sys
-from mrgaze import utils, pupilometry, calibrate, report, config
+from mrgaze import utils, config, manifest
 
 def RunBatch(data_dir=[]):
     """
@@ -51,11 +51,15 @@ def RunBatch(data_dir=[]):
         sys.exit(1)
 
     # Loop over all subject subdirectories of the data directory
-    for subj_sess in os.walk(data_dir).next()[1]:
+    for subj_sess in sorted(next(os.walk(data_dir))[1]):
 
         # Run single-session pipeline
         RunSingle(data_dir, subj_sess)
 
+    # Batch QC dashboard from the session summaries
+    from mrgaze import summary
+    summary.WriteDashboard(data_dir)
+
     # Clean exit
     return True
 
@@ -89,6 +93,7 @@ def RunSingle(data_dir, subj_sess):
 
     # Extract operational flags from config
     do_cal = cfg.getboolean('CALIBRATION', 'calibrate')
+    incremental = cfg.getboolean('OUTPUT', 'incremental', fallback=True)
 
     # Run pipeline if video directory present
     if os.path.isdir(ss_vid_dir):
@@ -96,16 +101,86 @@ def RunSingle(data_dir, subj_sess):
         # Create results subj/sess dir
         utils._mkdir(ss_res_dir)
 
+        # Load stage manifest from results dir
+        man = manifest.LoadManifest(ss_dir)
+
+        # Stage input and output files
+        vin_ext = cfg.get('VIDEO', 'inputextension')
+        cal_video = os.path.join(ss_vid_dir, 'cal' + vin_ext)
+        gaze_video = os.path.join(ss_vid_dir, 'gaze' + vin_ext)
+        cal_csv = os.path.join(ss_res_dir, 'cal_pupils.csv')
+        gaze_csv = os.path.join(ss_res_dir, 'gaze_pupils.csv')
+        gaze_filt_csv = os.path.join(ss_res_dir, 'gaze_pupils_filt.csv')
+        gaze_cal_csv = os.path.join(ss_res_dir, 'gaze_calibrated.csv')
+        events_csv = os.path.join(ss_res_dir, 'gaze_events.csv')
+        volumes_csv = os.path.join(ss_res_dir, 'gaze_volumes.csv')
+        fixations_txt = os.path.join(ss_vid_dir, 'fixations.txt')
+        calib_files = [os.path.join(ss_res_dir, f) for f in
+                       ('calibration_matrix.csv', 'central_fixation.csv')]
+        report_html = os.path.join(ss_res_dir, 'index.html')
+        summary_json = os.path.join(ss_res_dir, 'summary.json')
+
+        # Stored calibration model fitted from the current calibration inputs
+        # or borrowed from another session makes calibration unnecessary
+        have_model = False
+
+        if do_cal:
+
+            from mrgaze import calstore
+            reuse = cfg.get('CALIBRATION', 'reuse', fallback='fallback')
+            model_key = manifest.StageKey(man, cfg, 'calibration_model', [cal_video])
+
+            model = calstore.CachedModel(ss_res_dir, model_key) if incremental else None
+
+            if model is not None:
+                print('+ Stored calibration model is current - skipping calibration')
+                C, central_fix = model['C'], model['central_fix']
+                if not all(os.path.isfile(f) for f in calib_files):
+                    from mrgaze import calibrate
+                    calibrate.WriteCalibration(ss_res_dir, model['fixations'], C, central_fix)
+                have_model = True
+
+            elif reuse == 'always':
+                C, central_fix = calstore.BorrowModel(data_dir, subj_sess, cfg)
+                have_model = C.any()
+
         print('')
         print('  Calibration Pupilometry')
         print('  -----------------------')
 
-        pupilometry.VideoPupilometry(data_dir, subj_sess, 'cal', cfg)
-
-        if do_cal:
-
-            print('  Create calibration model')
-            C, central_fix = calibrate.AutoCalibrate(ss_res_dir, cfg)
+        key = manifest.StageKey(man, cfg, 'cal_pupilometry', [cal_video])
+        if have_model:
+            print('+ Calibration model available - skipping')
+        elif incremental and manifest.StageCurrent(man, 'cal_pupilometry', key, [cal_csv]):
+            print('+ Calibration pupilometry inputs unchanged - skipping')
+        else:
+            # Stage modules are imported here rather than at module level so that
+            # the entry scripts start without loading OpenCV, scipy or matplotlib
+            from mrgaze import pupilometry
+            pupils = pupilometry.VideoPupilometry(data_dir, subj_sess, 'cal', cfg, force=incremental)
+            # True alone means existing output was kept (OUTPUT.overwrite)
+            if pupils and pupils is not True:
+                manifest.UpdateStage(man, 'cal_pupilometry', key)
+
+        if do_cal and not have_model:
+
+            from mrgaze import calibrate
+
+            key = manifest.StageKey(man, cfg, 'calibration', [cal_csv])
+            if incremental and manifest.StageCurrent(man, 'calibration', key, calib_files):
+                print('+ Calibration inputs unchanged - reading calibration model')
+                C, central_fix = calibrate.ReadCalibration(ss_res_dir)
+            else:
+                print('  Create calibration model')
+                C, central_fix = calibrate.AutoCalibrate(ss_res_dir, cfg)
+                if C.any():
+                    manifest.UpdateStage(man, 'calibration', key)
+
+            if C.any():
+                calstore.SaveModel(ss_res_dir, C, central_fix, model_key, subj_sess)
+            elif reuse != 'never':
+                print('* Calibration failed - looking for a model from another session')
+                C, central_fix = calstore.BorrowModel(data_dir, subj_sess, cfg)
 
             if not C.any():
                 print('* Empty calibration matrix detected - skipping')
@@ -115,18 +190,104 @@ def RunSingle(data_dir, subj_sess):
         print('  Gaze Pupilometry')
         print('  -----------------------')
 
-        pupilometry.VideoPupilometry(data_dir, subj_sess, 'gaze', cfg)
-
+        # Calibrated gaze is streamed during gaze pupilometry when the model is
+        # known and needs no offline motion correction (centered highpass)
+        gaze_cal = None
+
+        key = manifest.StageKey(man, cfg, 'gaze_pupilometry', [gaze_video])
+        if incremental and manifest.StageCurrent(man, 'gaze_pupilometry', key, [gaze_csv]):
+            print('+ Gaze pupilometry inputs unchanged - skipping')
+        else:
+            from mrgaze import pupilometry
+            if do_cal and cfg.get('ARTIFACTS', 'motioncorr') in ('none', 'glint'):
+                from mrgaze import calibrate
+                gaze_cal = calibrate.StreamingCalibration(gaze_cal_csv, cfg)
+                gaze_cal.SetModel(C, central_fix)
+            pupils = pupilometry.VideoPupilometry(data_dir, subj_sess, 'gaze', cfg, gaze_cal,
+                                                  force=incremental)
+            if pupils and pupils is not True:
+                manifest.UpdateStage(man, 'gaze_pupilometry', key)
+
+        # Only trust calibrated gaze from a run that actually processed frames
+        streamed = gaze_cal is not None and gaze_cal.complete and gaze_cal.n_written > 0
+
+        if cfg.getboolean('FILTER', 'enabled', fallback=True):
+
+            key = manifest.StageKey(man, cfg, 'filter', [gaze_csv])
+            if incremental and manifest.StageCurrent(man, 'filter', key, [gaze_filt_csv]):
+                print('+ Pupilometry filter inputs unchanged - skipping')
+            else:
+                print('  Filter gaze pupilometry')
+                from mrgaze import filtering
+                if filtering.FilterPupilometry(gaze_csv, gaze_filt_csv, cfg):
+                    manifest.UpdateStage(man, 'filter', key)
 
         if do_cal:
 
-            print('  Calibrate pupilometry')
-            calibrate.ApplyCalibration(ss_dir, C, central_fix, cfg)
+            from mrgaze import calibrate
+
+            key = manifest.StageKey(man, cfg, 'apply_calibration',
+                                    [gaze_csv, fixations_txt] + calib_files)
+            if incremental and manifest.StageCurrent(man, 'apply_calibration', key, [gaze_cal_csv]):
+                print('+ Calibrated gaze inputs unchanged - skipping')
+            elif streamed:
+                print('+ Calibrated gaze written during gaze pupilometry')
+                manifest.UpdateStage(man, 'apply_calibration', key)
+            else:
+                print('  Calibrate pupilometry')
+                if calibrate.ApplyCalibration(ss_dir, C, central_fix, cfg):
+                    manifest.UpdateStage(man, 'apply_calibration', key)
+
+        if do_cal and cfg.getboolean('EVENTS', 'detect', fallback=True):
+
+            print('')
+            print('  Gaze Events')
+            print('  -----------')
+
+            key = manifest.StageKey(man, cfg, 'events', [gaze_cal_csv, gaze_csv])
+            if incremental and manifest.StageCurrent(man, 'events', key, [events_csv]):
+                print('+ Gaze event inputs unchanged - skipping')
+            else:
+                from mrgaze import events
+                if events.DetectGazeEvents(ss_dir, cfg):
+                    manifest.UpdateStage(man, 'events', key)
+
+        if cfg.getfloat('MRI', 'tr', fallback=0.0) > 0.0:
+
+            print('')
+            print('  Volume Resampling')
+            print('  -----------------')
+
+            key = manifest.StageKey(man, cfg, 'volumes', [gaze_csv, gaze_cal_csv])
+            if incremental and manifest.StageCurrent(man, 'volumes', key, [volumes_csv]):
+                print('+ Volume resampling inputs unchanged - skipping')
+            else:
+                from mrgaze import volumes
+                if volumes.ResampleToVolumes(ss_dir, cfg):
+                    manifest.UpdateStage(man, 'volumes', key)
 
         print('')
         print('  Generate Report')
         print('  ---------------')
-        report.WriteReport(ss_dir, cfg)
+
+        key = manifest.StageKey(man, cfg, 'report', [cal_csv, gaze_csv, gaze_cal_csv, events_csv])
+        if incremental and manifest.StageCurrent(man, 'report', key, [report_html]):
+            print('+ Report inputs unchanged - skipping')
+        else:
+            from mrgaze import report
+            report.WriteReport(ss_dir, cfg)
+            manifest.UpdateStage(man, 'report', key)
+
+        key = manifest.StageKey(man, cfg, 'summary',
+                                [gaze_csv, gaze_cal_csv, events_csv, volumes_csv] +
+                                [os.path.join(ss_res_dir, f) for f in
+                                 ('calibration_model.json', 'gaze_throughput.json')])
+        if incremental and manifest.StageCurrent(man, 'summary', key, [summary_json]):
+            print('+ Session summary inputs unchanged - skipping')
+        else:
+            from mrgaze import summary
+            if summary.WriteSummary(ss_dir, cfg):
+                manifest.UpdateStage(man, 'summary', key)
 
     else:
 
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+"""
+Publish live pupilometry samples to local consumers
+
+GazePublisher writes samples to shared memory and GazeServer streams them
+over a UNIX-domain or localhost TCP socket. Both use the same binary
+record layout (SAMPLE_DTYPE).
+
+Samples are written into a fixed-size ring buffer in named shared memory
+(multiprocessing.shared_memory). There is one writer, the live
+pupilometry loop, and any number of readers. Nothing is locked: each slot
+carries the sequence number of the sample it holds. The writer invalidates
+a slot before filling it and stamps it afterwards, and readers discard
+slots that changed while being copied.
+
+Example reader
+----
+>>> from mrgaze import publish
+>>> reader = publish.GazeReader('mrgaze')
+>>> s = reader.Latest()
+>>> print(s['t'], s['px'], s['py'], s['gaze_x'], s['gaze_y'])
+
+Example subscriber
+----
+>>> client = publish.GazeClient('unix:/tmp/mrgaze.sock')
+>>> for s in client.Read(timeout=1.0):
+...     print(s['t'], s['px'], s['py'])
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import socket
+import struct
+import threading
+import collections
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Sample record layout (little-endian, 56 bytes)
+# seq is -1 while a slot is being written. Uncalibrated gaze is NaN
+SAMPLE_DTYPE = np.dtype([
+    ('seq',    '<i8'),
+    ('t',      '<f8'),
+    ('px',     '<f8'),
+    ('py',     '<f8'),
+    ('area',   '<f8'),
+    ('gaze_x', '<f4'),
+    ('gaze_y', '<f4'),
+    ('blink',  '<i4'),
+    ('art',    '<f4'),
+])
+
+# Same layout packed for socket streaming
+_RECORD = struct.Struct('<qddddffif')
+
+# Buffer header : magic, layout version, capacity, samples written
+HEADER_DTYPE = np.dtype([
+    ('magic',     'S8'),
+    ('version',   '<i4'),
+    ('capacity',  '<i4'),
+    ('n_written', '<i8'),
+])
+
+MAGIC = b'MRGAZE'
+VERSION = 1
+
+# Blocks created by publishers in this process
+_published = set()
+
+
+class GazePublisher(object):
+    '''
+    Single writer of pupilometry samples to a shared-memory ring buffer
+
+    Arguments
+    ----
+    name : string
+        Shared memory block name, used by readers to attach
+    capacity : integer
+        Number of samples held in the ring buffer
+    '''
+
+    def __init__(self, name='mrgaze', capacity=1024):
+
+        size = HEADER_DTYPE.itemsize + capacity * SAMPLE_DTYPE.itemsize
+
+        # Replace a block left behind by a crashed session
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = name
+        self.capacity = capacity
+
+        _published.add(name)
+
+        self._header = np.ndarray((1,), HEADER_DTYPE, self.shm.buf, 0)
+        self._ring = np.ndarray((capacity,), SAMPLE_DTYPE, self.shm.buf, HEADER_DTYPE.itemsize)
+
+        self._ring['seq'] = -1
+        self._header[0] = (MAGIC, VERSION, capacity, 0)
+
+        self._n = 0
+
+    def Publish(self, t, px, py, area, blink, art_power=0.0, gaze_x=np.nan, gaze_y=np.nan):
+        '''
+        Write one sample and advance the ring buffer
+        '''
+
+        # Record view into shared memory
+        slot = self._ring[self._n % self.capacity]
+
+        # Invalidate, fill, then stamp the slot with its sequence number
+        slot['seq'] = -1
+        slot['t'] = t
+        slot['px'] = px
+        slot['py'] = py
+        slot['area'] = area
+        slot['gaze_x'] = gaze_x
+        slot['gaze_y'] = gaze_y
+        slot['blink'] = blink
+        slot['art'] = art_power
+        slot['seq'] = self._n
+
+        self._n += 1
+        self._header['n_written'] = self._n
+
+    def Close(self):
+        '''
+        Detach and remove the shared memory block
+        '''
+
+        if self.shm is None:
+            return
+
+        # Release numpy views before closing the underlying buffer
+        self._header = self._ring = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+        _published.discard(self.name)
+
+
+class GazeReader(object):
+    '''
+    Attach to a GazePublisher ring buffer by name
+
+    Arguments
+    ----
+    name : string
+        Shared memory block name given to the publisher
+    '''
+
+    def __init__(self, name='mrgaze'):
+
+        self.shm = shared_memory.SharedMemory(name=name)
+
+        # Attaching registers the block with this process's resource tracker,
+        # which would unlink it at exit - only the publisher should do that
+        if name not in _published:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self._header = np.ndarray((1,), HEADER_DTYPE, self.shm.buf, 0)
+
+        if self._header['magic'][0] != MAGIC or self._header['version'][0] != VERSION:
+            self.shm.close()
+            raise ValueError('%s is not an mrgaze sample buffer' % name)
+
+        self.capacity = int(self._header['capacity'][0])
+        self._ring = np.ndarray((self.capacity,), SAMPLE_DTYPE, self.shm.buf, HEADER_DTYPE.itemsize)
+
+        # Start from the current write position
+        self._next = int(self._header['n_written'][0])
+
+        # Samples overwritten before they could be read
+        self.n_missed = 0
+
+    def Written(self):
+        '''
+        Total number of samples published so far
+        '''
+
+        return int(self._header['n_written'][0])
+
+    def Latest(self):
+        '''
+        Most recent complete sample, or None if nothing has been published
+        '''
+
+        n = self.Written()
+
+        while n > 0:
+
+            slot = (n - 1) % self.capacity
+            s = self._ring[slot].copy()
+
+            # Slot must still hold the same sample after the copy
+            if s['seq'] == n - 1 and self._ring['seq'][slot] == n - 1:
+                return s
+
+            # Writer lapped this slot while copying - try the newest again
+            n = self.Written()
+
+        return None
+
+    def ReadNew(self):
+        '''
+        All complete samples published since the previous call
+
+        Returns
+        ----
+        samples : numpy structured array (SAMPLE_DTYPE)
+            Samples in publication order. Samples overwritten before they
+            were read are skipped and counted in n_missed.
+        '''
+
+        n = self.Written()
+
+        # Oldest sample still held in the ring buffer
+        first = max(self._next, n - self.capacity)
+        self.n_missed += first - self._next
+
+        idx = np.arange(first, n)
+        samples = self._ring[idx % self.capacity].copy()
+
+        # Keep only slots still holding the expected sample after the copy
+        ok = (samples['seq'] == idx) & (self._ring['seq'][idx % self.capacity] == idx)
+        self.n_missed += int(np.sum(~ok))
+
+        self._next = n
+
+        return samples[ok]
+
+    def Close(self):
+        '''
+        Detach from the shared memory block
+        '''
+
+        if self.shm is None:
+            return
+
+        self._header = self._ring = None
+        self.shm.close()
+        self.shm = None
+
+
+def ParseAddress(address):
+    '''
+    Parse a stream address into a socket family and address
+
+    Accepts 'unix:<path>', 'tcp:<host>:<port>' or '<host>:<port>'
+    '''
+
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+
+    if address.startswith('tcp:'):
+        address = address[4:]
+
+    host, port = address.rsplit(':', 1)
+
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+class GazeServer(object):
+    '''
+    Stream pupilometry samples to socket subscribers
+
+    Each sample is sent as one SAMPLE_DTYPE record (56 bytes, little-endian).
+    Every client has its own bounded buffer drained by its own sender
+    thread. When a client falls behind, its oldest queued records are
+    dropped, so Publish never blocks on a slow consumer.
+
+    Arguments
+    ----
+    address : string
+        'unix:<path>' for a UNIX-domain socket or '[tcp:]<host>:<port>'
+    buffer_size : integer
+        Records queued per client before the oldest are dropped
+    '''
+
+    def __init__(self, address, buffer_size=256):
+
+        family, addr = ParseAddress(address)
+
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # Release the socket if the address cannot be bound
+        try:
+            self._sock.bind(addr)
+            self._sock.listen(8)
+        except OSError:
+            self._sock.close()
+            raise
+
+        self.address = address
+        self._family = family
+        self._addr = addr
+        self._buffer_size = buffer_size
+        self._clients = []
+        self._lock = threading.Lock()
+        self._running = True
+        self._n = 0
+
+        self._accept_thread = threading.Thread(target=self._accept, name='mrgaze-stream-accept')
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+
+    def _accept(self):
+
+        while self._running:
+
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+
+            if self._family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            client = _StreamClient(conn, self._buffer_size, self._remove)
+
+            with self._lock:
+                self._clients.append(client)
+
+    def _remove(self, client):
+
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def Clients(self):
+        '''
+        Number of connected subscribers
+        '''
+
+        with self._lock:
+            return len(self._clients)
+
+    def Dropped(self):
+        '''
+        Records dropped for slow subscribers (connected clients only)
+        '''
+
+        with self._lock:
+            return sum(c.n_dropped for c in self._clients)
+
+    def Publish(self, t, px, py, area, blink, art_power=0.0, gaze_x=np.nan, gaze_y=np.nan):
+        '''
+        Queue one sample for every connected subscriber
+        '''
+
+        rec = _RECORD.pack(self._n, t, px, py, area, gaze_x, gaze_y, blink, art_power)
+        self._n += 1
+
+        with self._lock:
+            clients = list(self._clients)
+
+        for client in clients:
+            client.Queue(rec)
+
+    def Close(self):
+        '''
+        Stop accepting, disconnect subscribers and remove any socket file
+        '''
+
+        if not self._running:
+            return
+
+        self._running = False
+
+        # Unblock accept()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._accept_thread.join(timeout=1.0)
+
+        with self._lock:
+            clients, self._clients = self._clients, []
+
+        for client in clients:
+            client.Close()
+
+        if self._family == socket.AF_UNIX and os.path.exists(self._addr):
+            os.unlink(self._addr)
+
+
+class _StreamClient(object):
+    '''
+    One subscriber connection with a bounded drop-oldest send buffer
+    '''
+
+    def __init__(self, conn, buffer_size, on_close):
+
+        self._conn = conn
+        self._queue = collections.deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._on_close = on_close
+        self._open = True
+        self.n_dropped = 0
+
+        self._thread = threading.Thread(target=self._send, name='mrgaze-stream-send')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Queue(self, rec):
+
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.n_dropped += 1
+            self._queue.append(rec)
+            self._cond.notify()
+
+    def _send(self):
+
+        while True:
+
+            with self._cond:
+                while self._open and not self._queue:
+                    self._cond.wait()
+                if not self._open:
+                    break
+                data = b''.join(self._queue)
+                self._queue.clear()
+
+            try:
+                self._conn.sendall(data)
+            except OSError:
+                break
+
+        self._conn.close()
+        self._on_close(self)
+
+    def Close(self):
+
+        with self._cond:
+            self._open = False
+            self._cond.notify()
+
+        try:
+            self._conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self._thread.join(timeout=1.0)
+
+
+class GazeClient(object):
+    '''
+    Subscribe to a GazeServer stream
+
+    Arguments
+    ----
+    address : string
+        Address given to the server
+    '''
+
+    def __init__(self, address):
+
+        family, addr = ParseAddress(address)
+
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.connect(addr)
+        self._partial = b''
+
+    def Read(self, timeout=None):
+        '''
+        Samples received since the previous call
+
+        Waits up to timeout seconds (None waits indefinitely) for data.
+
+        Returns
+        ----
+        samples : numpy structured array (SAMPLE_DTYPE)
+            Complete records received, empty on timeout or disconnect
+        '''
+
+        self._sock.settimeout(timeout)
+
+        try:
+            data = self._sock.recv(1 << 16)
+        except socket.timeout:
+            data = b''
+
+        data = self._partial + data
+
+        # Hold back any incomplete trailing record
+        n = len(data) // SAMPLE_DTYPE.itemsize * SAMPLE_DTYPE.itemsize
+        self._partial = data[n:]
+
+        return np.frombuffer(data[:n], SAMPLE_DTYPE).copy()
+
+    def Close(self):
+        self._sock.close()
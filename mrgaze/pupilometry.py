@@ -30,10 +30,12 @@
 
 import os
 import time
+import json
 import getpass
+import threading
 import cv2
-from mrgaze import media, utils, config, calibrate, report, engine
-import matplotlib as plt
+import numpy as np
+from mrgaze import media, utils, config, engine, manifest, metrics, capture, framepipeline
 
 def LivePupilometry(data_dir, live_eyetracking=False):
     """
@@ -67,7 +69,6 @@ def LivePupilometry(data_dir, live_eyetracking=False):
     # Load Configuration
     cfg = config.LoadConfig(data_dir)
     cfg.live_eyetracking = live_eyetracking
-    cfg_ts = time.time()
     
     # Output flags
     verbose   = cfg.getboolean('OUTPUT', 'verbose')
@@ -78,9 +79,6 @@ def LivePupilometry(data_dir, live_eyetracking=False):
     vout_ext = cfg.get('VIDEO' ,'outputextension')
     # vin_fps = cfg.getfloat('VIDEO', 'inputfps')
 
-    # Flag for freeze frame
-    freeze_frame = False
-
     vid_dir = os.path.join(ss_dir, 'videos')
     res_dir = os.path.join(ss_dir, 'results')
 
@@ -100,7 +98,13 @@ def LivePupilometry(data_dir, live_eyetracking=False):
     # Raw and filtered pupilometry CSV file paths
     cal_pupils_csv = os.path.join(res_dir, 'cal_pupils.csv')
     pupils_csv = os.path.join(res_dir, 'gaze_pupils.csv')
+    cal_pupils_bin = os.path.join(res_dir, 'cal_pupils.bin')
+    pupils_bin = os.path.join(res_dir, 'gaze_pupils.bin')
+    gaze_cal_csv = os.path.join(res_dir, 'gaze_calibrated.csv')
 
+    # Capture-to-result latency sidecar CSV file paths
+    cal_latency_csv = os.path.join(res_dir, 'cal_latency.csv')
+    latency_csv = os.path.join(res_dir, 'gaze_latency.csv')
 
     # Check that output directory exists
     if not os.path.isdir(res_dir):
@@ -131,6 +135,14 @@ def LivePupilometry(data_dir, live_eyetracking=False):
             print('+ Overwrite forbidden - skipping pupilometry')
             return True
 
+    # Operator commands from stdin or a control socket, polled without blocking
+    from mrgaze import control
+    ctrl = control.ControlChannel(cfg.getboolean('OUTPUT', 'controlstdin', fallback=True),
+                                  cfg.get('OUTPUT', 'controladdress', fallback=''))
+
+    # Preview window refresh (and key polling) at a capped rate
+    graphics = cfg.getboolean('OUTPUT', 'graphics')
+
     #
     # Camera Input
     #
@@ -146,303 +158,155 @@ def LivePupilometry(data_dir, live_eyetracking=False):
 
     except:
         print('* Problem opening input video stream - skipping pupilometry')
+        ctrl.Close()
         return False
 
 
+    # Retry opening the camera every half second until it appears or the user quits
     while not vin_stream.isOpened():
         print("Waiting for Camera.")
-        key = utils._waitKey(500)
-        if key == 'ESC':
+        time.sleep(0.5)
+        if ctrl.Poll() == 'ESC':
             print("User Abort.")
             break
+        vin_stream.open(vin_path)
 
     if not vin_stream.isOpened():
         print('* Video input stream not opened - skipping pupilometry')
+        ctrl.Close()
         return False
 
     if not cal_vin_stream.isOpened():
         print('* Calibration video input stream not opened - skipping pupilometry')
+        ctrl.Close()
         return False
 
-    # Video FPS from metadata
-    # TODO: may not work with Quicktime videos
-    # fps = vin_stream.get(cv2.cv.CV_CAP_PROP_FPS)
-    # fps = cfg.getfloat('CAMERA', 'fps')
-
-    # Desired time between frames in milliseconds
-    # time_bw_frames = 1000.0 / fps
-
-    vin_stream.set(cv2.CAP_PROP_FRAME_WIDTH, 320)
-    vin_stream.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
-    vin_stream.set(cv2.CAP_PROP_FPS, 30)
-
-    # Total number of frames in video file
-    # nf = vin_stream.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
-
-    # print('  Video has %d frames at %0.3f fps' % (nf, vin_fps))
+    cam_fps = cfg.getfloat('CAMERA', 'fps', fallback=30.0)
+    vin_stream.set(cv2.CAP_PROP_FRAME_WIDTH, cfg.getint('CAMERA', 'width', fallback=320))
+    vin_stream.set(cv2.CAP_PROP_FRAME_HEIGHT, cfg.getint('CAMERA', 'height', fallback=240))
+    vin_stream.set(cv2.CAP_PROP_FPS, cam_fps)
 
-    # Read first preprocessed video frame from stream
-    keep_going, frame_orig = media.LoadVideoFrame(vin_stream, cfg)
-    if keep_going:
-        frame, art_power = media.Preproc(frame_orig, cfg)
-    else:
-        art_power = 0.0
-
-    # Get size of preprocessed frame for output video setup
-    nx, ny = frame.shape[1], frame.shape[0]
+    # Read the camera in a background thread keeping only the newest frame,
+    # so slow frames drop stale input rather than queueing it
+    if live_eyetracking:
+        vin_stream = capture.LatestFrameCapture(vin_stream).start()
+        cal_vin_stream = vin_stream
 
-    # By default we start in non-calibration mode
-    # switch between gaze/cal modes by pressing key "c"
+    # Frame sources - the camera serves both modes, replays read the recorded videos
     if live_eyetracking:
-    	do_cal = False
+        cam_source = framepipeline.VideoSource(vin_stream)
+        sources = {'cal': cam_source, 'gaze': cam_source}
     else:
-    	do_cal = True
-    cal_keep_going = True
+        sources = {'cal': framepipeline.VideoSource(cal_vin_stream),
+                   'gaze': framepipeline.VideoSource(vin_stream)}
+
+    # Publishers, sinks and the control channel are closed even if a frame
+    # raises, so shared memory blocks and sockets are not left behind
+    publishers = []
+    pipe = None
+    cfg_watcher = None
+    try:
 
+        # Publish live samples to local consumers through shared memory and/or a socket
+        shm_name = cfg.get('OUTPUT', 'sharedmemory', fallback='')
+        if shm_name:
+            from mrgaze import publish
+            publishers.append(publish.GazePublisher(shm_name, cfg.getint('OUTPUT', 'sharedmemorysize', fallback=1024)))
+            print('  Publishing samples to shared memory block %s' % shm_name)
+
+        stream_address = cfg.get('OUTPUT', 'streamaddress', fallback='')
+        if stream_address:
+            from mrgaze import publish
+            publishers.append(publish.GazeServer(stream_address, cfg.getint('OUTPUT', 'streambuffer', fallback=256)))
+            print('  Streaming samples on %s' % stream_address)
+
+        # Result sinks stay open across calibration/gaze mode switches
+        sinks = [framepipeline.CSVSink({'cal': cal_pupils_csv, 'gaze': pupils_csv},
+                                       framepipeline.PUPILS_FORMAT_LIVE)]
+        if cfg.getboolean('OUTPUT', 'binary', fallback=False):
+            sinks.append(framepipeline.BinarySink({'cal': cal_pupils_bin, 'gaze': pupils_bin}))
+        sinks += [framepipeline.PublishSink(pub) for pub in publishers]
+        sinks.append(framepipeline.LatencySink({'cal': cal_latency_csv, 'gaze': latency_csv}))
+        sinks.append(framepipeline.VideoSink({'cal': cal_vout_path, 'gaze': vout_path}, cam_fps))
+        if live_eyetracking:
+            sinks.append(framepipeline.VideoSink({'cal': raw_cal_vout_path, 'gaze': raw_vout_path},
+                                                 cam_fps, field='frame_orig'))
+
+        # Calibrated gaze is written as samples arrive once a model is available
+        from mrgaze import calibrate
+        gaze_cal_sink = framepipeline.CalibratedGazeSink(calibrate.StreamingCalibration(gaze_cal_csv, cfg))
+        sinks.append(gaze_cal_sink)
+
+        if graphics:
+            cv2.namedWindow('Pupilometry')
+
+        # Per-stage timing instrumentation (no cost when disabled)
+        metrics.Enable(cfg.getboolean('OUTPUT', 'metrics', fallback=False))
+
+        # Deadline-driven quality control (defaults to the camera frame period)
+        if cfg.getboolean('CAMERA', 'adaptive', fallback=False):
+            from mrgaze import adaptive
+            deadline = cfg.getfloat('CAMERA', 'deadline', fallback=0.0) / 1e3 or 1.0 / cam_fps
+            adapt = adaptive.DeadlineController(cfg, deadline)
+        else:
+            adapt = None
 
+        # Configuration edits are parsed and validated off the processing thread
+        cfg_watcher = config.ConfigWatcher(data_dir, cfg)
 
-    if cfg.getboolean('OUTPUT', 'graphics'):
-        cv2.namedWindow('Pupilometry')
-
-    while keep_going or cal_keep_going:
-        if do_cal == False:
-            #
-            # Output video
-            #
-            # Output video codec (MP4V - poor quality compression)
-            # TODO : Find a better multiplatform codec
-            fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
-
-            try:
-                vout_stream = cv2.VideoWriter(vout_path, fourcc, 30, (nx, ny), True)
-            except:
-                print('* Problem creating output video stream - skipping pupilometry')
-                return False
-
-            if not vout_stream.isOpened():
-                print('* Output video not opened - skipping pupilometry')
-                return False
-
-
-            if live_eyetracking:
-                print('  Opening output video stream')
-
-                try:
-                    raw_vout_stream = cv2.VideoWriter(raw_vout_path, fourcc, 30, (nx, ny), True)
-                except:
-                    print('* Problem creating raw output video stream - skipping pupilometry')
-                    return False
-
-                if not raw_vout_stream.isOpened():
-                    print('* Raw output video not opened - skipping pupilometry')
-                    return False
-
-            # Open pupilometry CSV file to write
-            try:
-                pupils_stream = open(pupils_csv, 'w')
-            except:
-                print('* Problem opening pupilometry CSV file - skipping pupilometry')
-                return False
-
-
-            #
-            # Main Video Frame Loop
-            #
-
-            # Print verbose column headers
-            if verbose:
-                print('')
-                print('  %10s %10s %10s %10s %10s' % (
-                    'Time (s)', 'Area', 'Blink', 'Artifact', 'FPS'))
-
-            # Init frame counter
-            fc = 0
-
-            # Init processing timer
-            t0 = time.time()
-            t = t0
-
-            while keep_going:
-
-                # check whether config file has been updated, reload of that is the case
-                if fc % 30 == 0:
-                    cfg_mtime = os.path.getmtime(os.path.join(data_dir, 'mrgaze.cfg'))
-                    if cfg_mtime > cfg_ts:
-                        print("Updating Configuration")
-                        cfg = config.LoadConfig(data_dir)
-                        cfg_ts = time.time()
-
-                # Current video time in seconds
-                t = time.time()
-
-                # -------------------------------------
-                # Pass this frame to pupilometry engine
-                # -------------------------------------
-                # b4_engine = time.time()
-                pupil_ellipse, roi_rect, blink, glint, frame_rgb = engine.PupilometryEngine(frame, cascade, cfg)
-                # print "Enging took %s ms" % (time.time() - b4_engine)
-
-                # Derive pupilometry parameters
-                px, py, area = engine.PupilometryPars(pupil_ellipse, glint, cfg)
-
-                # Write data line to pupilometry CSV file
-                pupils_stream.write(
-                    '%0.4f,%0.3f,%0.3f,%0.3f,%d,%0.3f,\n' %
-                    (t, area, px, py, blink, art_power)
-                )
-
-                # Write output video frame
-                vout_stream.write(frame_rgb)
-
-                # Write raw output video frame
-                if live_eyetracking:
-                    raw_vout_stream.write(frame_orig)
-
-                # Read next frame, unless we want to figure out the correct settings for this frame
-                if not freeze_frame:
-                    keep_going, frame_orig = media.LoadVideoFrame(vin_stream, cfg)
-
-                if keep_going:
-                    frame, art_power = media.Preproc(frame_orig, cfg)
-                else:
-                    art_power = 0.0
+        # By default we start in non-calibration mode
+        # switch between gaze/cal modes by pressing key "c"
+        pipe = framepipeline.FramePipeline(sources, cascade, cfg, sinks,
+                                           'gaze' if live_eyetracking else 'cal', adapt, graphics,
+                                           cfg.getfloat('OUTPUT', 'displayfps', fallback=15.0))
 
-                # Increment frame counter
-                fc = fc + 1
+        # Calibrate online from calibration samples as they arrive
+        if cfg.getboolean('CALIBRATION', 'online', fallback=True):
+            pipe.calibrator = calibrate.OnlineCalibrator(cfg)
 
-                # Report processing FPS
-                if verbose:
-                    if fc % 100 == 0:
-                        pfps = fc / (time.time() - t0)
-                        print('  %10.1f %10.1f %10d %10.3f %10.1f' % (
-                            t, area, blink, art_power, pfps))
-                        t0 = time.time()
-                        fc = 0
+        # Calibration model fit running in the background, if any
+        cal_thread, cal_result = None, None
+        central_fix = None
 
-                # wait whether user pressed esc to exit the experiment
-                key = utils._waitKey(5)
-                if key == 'ESC' or not keep_going:
-                    keep_going = False
-                    cal_keep_going = False
-                    if live_eyetracking:
-                        raw_vout_stream.release()
-                    vout_stream.release()
-                    pupils_stream.close()
-                elif key == 'c':
-                    if live_eyetracking:
-                        raw_vout_stream.release()
-                    vout_stream.release()
-                    pupils_stream.close()
-                    do_cal = True
-                    print("Starting calibration.")
-                    break
-
-                elif key == 'f':
-                    freeze_frame = not freeze_frame
-        else: # do calibration
-            #
-            # Output video
-            #
-            print('  Opening output video stream')
-            
-            # Output video codec (MP4V - poor quality compression)
-            # TODO : Find a better multiplatform codec
-            fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
-            
-            try:
-                cal_vout_stream = cv2.VideoWriter(cal_vout_path, fourcc, 30, (nx, ny), True)
-            except:
-                print('* Problem creating output video stream - skipping pupilometry')
-                return False
-
-            if not cal_vout_stream.isOpened():
-                print('* Output video not opened - skipping pupilometry')
-                return False
-
-            if live_eyetracking:
-                try:
-                    raw_cal_vout_stream = cv2.VideoWriter(raw_cal_vout_path, fourcc, 30, (nx, ny), True)
-                except:
-                    print('* Problem creating output video stream - skipping pupilometry')
-                    return False
-
-
-                if not raw_cal_vout_stream.isOpened():
-                    print('* Raw output video not opened - skipping pupilometry')
-                    return False
-
-            # Open pupilometry CSV file to write
-            try:
-                cal_pupils_stream = open(cal_pupils_csv, 'w')
-            except:
-                print('* Problem opening pupilometry CSV file - skipping pupilometry')
-                return False
-
-            #
-            # Main Video Frame Loop
-            #
-
-            # Print verbose column headers
-            if verbose:
-                print('')
-                print('  %10s %10s %10s %10s %10s' % (
-                    'Time (s)', 'Area', 'Blink', 'Artifact', 'FPS'))
-
-            # Init frame counter
-            fc = 0
-
-            # Init processing timer
-            t0 = time.time()
-            t = t0
-            while cal_keep_going:
-                # check whether config file has been updated, reload of that is the case
-                if fc % 30 == 0:
-                    cfg_mtime = os.path.getmtime(os.path.join(data_dir, 'mrgaze.cfg'))
-                    if cfg_mtime > cfg_ts:
-                        print("Updating Configuration")
-                        cfg = config.LoadConfig(data_dir)
-                        cfg_ts = time.time()
-
-                # Current video time in seconds
-                t = time.time()
-
-                # -------------------------------------
-                # Pass this frame to pupilometry engine
-                # -------------------------------------
-                # b4_engine = time.time()
-                pupil_ellipse, roi_rect, blink, glint, frame_rgb = engine.PupilometryEngine(frame, cascade, cfg)
-                # print "Engine took %s ms" % (time.time() - b4_engine)
-
-                # Derive pupilometry parameters
-                px, py, area = engine.PupilometryPars(pupil_ellipse, glint, cfg)
-
-                # Write data line to pupilometry CSV file
-                cal_pupils_stream.write(
-                    '%0.4f,%0.3f,%0.3f,%0.3f,%d,%0.3f,\n' %
-                    (t, area, px, py, blink, art_power)
-                )
-
-                # Write output video frame
-                cal_vout_stream.write(frame_rgb)
-
-                # Write output video frame
-                if live_eyetracking:
-                    raw_cal_vout_stream.write(frame_orig)
-
-                # Read next frame, unless we want to figure out the correct settings for this frame
-                if not freeze_frame:
-                    cal_keep_going, frame_orig = media.LoadVideoFrame(cal_vin_stream, cfg)
-                
-                # Read next frame (if available)
-                # if verbose:
-                #     b4_frame = time.time()
-                if cal_keep_going:
-                    frame, art_power = media.Preproc(frame_orig, cfg)
+        # Print verbose column headers
+        if verbose:
+            print('')
+            print('  %10s %10s %10s %10s %10s' % (
+                'Time (s)', 'Area', 'Blink', 'Artifact', 'FPS'))
+
+        # Init frame counter and processing timer
+        fc = 0
+        t0 = time.time()
+        last = None
+
+        #
+        # Main Video Frame Loop
+        #
+        while True:
+
+            # Switch to a new validated configuration at the frame boundary
+            new_cfg = cfg_watcher.Poll()
+            if new_cfg is not None:
+                cfg = new_cfg
+                pipe.SetConfig(cfg)
+
+            # Install the calibration model once the background fit is done
+            if cal_thread is not None and not cal_thread.is_alive():
+                pipe.C, central_fix = cal_result['C'], cal_result['central_fix']
+                if pipe.C is not None and pipe.C.any():
+                    gaze_cal_sink.calibration.SetModel(pipe.C, central_fix)
+                cal_thread, cal_result = None, None
+
+            fr = pipe.Step()
+
+            if fr is None:
+                # End of recorded calibration video - continue with gaze video
+                if pipe.mode == 'cal' and not live_eyetracking:
+                    key = 'v'
                 else:
-                    art_power = 0.0
-
-                #if verbose:
-                # print "Time to load frame: %s" % (time.time() - b4_frame)
+                    break
+            else:
+                last = fr
 
                 # Increment frame counter
                 fc = fc + 1
@@ -452,66 +316,157 @@ def LivePupilometry(data_dir, live_eyetracking=False):
                     if fc % 100 == 0:
                         pfps = fc / (time.time() - t0)
                         print('  %10.1f %10.1f %10d %10.3f %10.1f' % (
-                            t, area, blink, art_power, pfps))
+                            fr.t, fr.area, fr.blink, fr.art_power, pfps))
                         t0 = time.time()
                         fc = 0
 
-                # wait whether user pressed esc to exit the experiment
-                key = utils._waitKey(1)
-                if key == 'ESC':
-                    keep_going = False
-                    cal_keep_going = False
-                    # Clean up
-                    if live_eyetracking:
-                        raw_cal_vout_stream.release()
-                    cal_vout_stream.release()
-                    cal_pupils_stream.close()
-                elif key == 'v' or not cal_keep_going:
-                    do_cal = False
-                    print("Stopping calibration.")
-                    # Clean up
-                    if live_eyetracking:
-                        raw_cal_vout_stream.release()
-                    cal_vout_stream.release()
-                    cal_pupils_stream.close()
-                    break
-                elif key == 'f':
-                    freeze_frame = not freeze_frame
-            print('  Create calibration model')
-            C, central_fix = calibrate.AutoCalibrate(res_dir, cfg)
-	
+                # Preview window keys are only polled when the preview was refreshed
+                if fr.display:
+                    ctrl.Put(utils._waitKey(1))
+
+                # Next operator command, if any
+                key = ctrl.Poll()
 
-    if not C.any():
+            if key == 'ESC':
+                break
+
+            elif key == 'c' and pipe.mode == 'gaze':
+                if cal_thread is not None:
+                    print('* Calibration model fit still running - ignoring')
+                else:
+                    print("Starting calibration.")
+                    pipe.SetMode('cal', restart=True)
+                    if pipe.calibrator:
+                        pipe.calibrator.Reset()
+
+            elif key == 'v' and pipe.mode == 'cal':
+                print("Stopping calibration.")
+                pipe.Flush()
+                pipe.SetMode('gaze')
+                print('  Create calibration model')
+
+                # Fall back to fitting from the calibration CSV if online calibration fails
+                C = np.array([])
+                if pipe.calibrator:
+                    C, central_fix = pipe.calibrator.Finish(res_dir)
+                if C.any():
+                    pipe.C = C
+                    gaze_cal_sink.calibration.SetModel(C, central_fix)
+                else:
+                    if pipe.calibrator:
+                        pipe.C = None
+                    cal_thread, cal_result = CalibrateInBackground(res_dir, cfg)
+
+            elif key == 'f':
+                pipe.freeze = not pipe.freeze
+
+        # Wait for a calibration fit still in progress
+        if cal_thread is not None:
+            cal_thread.join()
+            pipe.C, central_fix = cal_result['C'], cal_result['central_fix']
+            if pipe.C is not None and pipe.C.any():
+                gaze_cal_sink.calibration.SetModel(pipe.C, central_fix)
+
+    finally:
+        try:
+            if pipe is not None:
+                pipe.Close()
+        finally:
+            # Stop the stream server threads and remove its socket file even
+            # if another sink fails to close
+            for pub in publishers:
+                pub.Close()
+            ctrl.Close()
+            if cfg_watcher is not None:
+                cfg_watcher.Close()
+
+    if pipe.C is None or not pipe.C.any():
         print('* Empty calibration matrix detected - skipping')
+    elif gaze_cal_sink.complete:
+        print('  Calibrated gaze written during pupilometry')
     else:
         print('  Calibrate pupilometry')
-        calibrate.ApplyCalibration(ss_dir, C, central_fix, cfg)
-    # except UnboundLocalError:
-    #     print('  No calibration data found')
+        calibrate.ApplyCalibration(ss_dir, pipe.C, central_fix, cfg)
+
+    if pipe.C is not None and pipe.C.any() and cfg.getboolean('EVENTS', 'detect', fallback=True):
+        from mrgaze import events
+        events.DetectGazeEvents(ss_dir, cfg)
 
-    cv2.destroyAllWindows()
+    if graphics:
+        cv2.destroyAllWindows()
     vin_stream.release()
-    # Clean up
     if live_eyetracking:
-        raw_vout_stream.release()
-    vout_stream.release()
-    pupils_stream.close()
-    if not live_eyetracking:
+        print('  Camera frames captured : %d  processed : %d  dropped : %d' %
+              (vin_stream.n_captured, vin_stream.n_delivered, vin_stream.n_dropped))
+    else:
         cal_vin_stream.release()
 
+    # Write per-stage timing histograms
+    metrics_json = os.path.join(res_dir, 'live_metrics.json')
+    if metrics.SaveMetrics(metrics_json):
+        print('  Stage timing metrics written to %s' % metrics_json)
+
     print('')
     print('  Generate Report')
     print('  ---------------')
+    from mrgaze import report
     report.WriteReport(ss_dir, cfg)
 
+    from mrgaze import summary
+    summary.WriteSummary(ss_dir, cfg)
+
+    if last is None:
+        return False
+
     # Return pupilometry timeseries
-    return t, px, py, area, blink, art_power
+    return last.t, last.px, last.py, last.area, last.blink, last.art_power
 
 
-def VideoPupilometry(data_dir, subj_sess, v_stub, cfg):
+def CalibrateInBackground(res_dir, cfg):
+    """
+    Fit the calibration model from cal_pupils.csv in a background thread
+
+    The live loop keeps processing gaze frames while the model is fitted.
+
+    Returns
+    ----
+    thread : threading.Thread
+        Started fitting thread
+    result : dict
+        Filled with 'C' and 'central_fix' when the thread finishes
+    """
+
+    from mrgaze import calibrate
+
+    result = {'C': None, 'central_fix': None}
+
+    def _fit():
+        result['C'], result['central_fix'] = calibrate.AutoCalibrate(res_dir, cfg)
+
+    thread = threading.Thread(target=_fit, name='mrgaze-calibrate')
+    thread.daemon = True
+    thread.start()
+
+    return thread, result
+
+def VideoPupilometry(data_dir, subj_sess, v_stub, cfg, calibration=None, force=False):
     """
     Perform pupil boundary ellipse fitting on entire video
 
+    Progress is checkpointed every OUTPUT.checkpointinterval frames. If a
+    valid checkpoint is found for the same video and config, processing
+    resumes from the last committed frame and appends to the existing CSV.
+    The overlay video cannot be appended, so it is written in
+    <v_stub>_pupils_partNN segments, one per checkpoint interval. Each
+    checkpoint closes the current segment, so every segment it lists is
+    complete, and frames written after it are discarded on resume. The
+    segments are joined into the overlay video when the run completes.
+
+    If a streaming calibration is given, calibrated gaze is written
+    through it as frames are processed. Its complete flag is only set
+    once this run has processed the video (see
+    calibrate.StreamingCalibration).
+
     Arguments
     ----
     data_dir : string
@@ -522,17 +477,28 @@ def VideoPupilometry(data_dir, subj_sess, v_stub, cfg):
         Video filename stub, eg 'cal' or 'gaze'
     cfg :
         Analysis configuration parameters
+    calibration : calibrate.StreamingCalibration
+        Optional calibrated gaze writer with its model already set
+    force : boolean
+        Replace existing output regardless of OUTPUT.overwrite, for callers
+        that have already decided the output is stale (see manifest)
 
     Returns
     ----
-    pupils : boolean
-        Completion status (True = successful)
+    pupils : boolean or tuple
+        False on failure, True if existing output was kept because
+        OUTPUT.overwrite is False, otherwise the last sample's t, px, py,
+        area, blink and artifact power
     """
 
     # Output flags
     verbose   = cfg.getboolean('OUTPUT', 'verbose')
     overwrite = cfg.getboolean('OUTPUT','overwrite')
 
+    # Checkpoint flags
+    ckpt_every = cfg.getint('OUTPUT', 'checkpointinterval', fallback=1000)
+    do_resume  = cfg.getboolean('OUTPUT', 'resume', fallback=True)
+
     # Video information
     vin_ext = cfg.get('VIDEO', 'inputextension')
     vout_ext = cfg.get('VIDEO' ,'outputextension')
@@ -547,26 +513,46 @@ def VideoPupilometry(data_dir, subj_sess, v_stub, cfg):
 
     # Raw and filtered pupilometry CSV file paths
     pupils_csv = os.path.join(res_dir, v_stub + '_pupils.csv')
+    pupils_bin = os.path.join(res_dir, v_stub + '_pupils.bin')
+
+    # Checkpoint file path
+    ckpt_json = os.path.join(res_dir, v_stub + '_checkpoint.json')
+
+    # Per-stage timing metrics file path
+    metrics_json = os.path.join(res_dir, v_stub + '_metrics.json')
+
+    # Processing rate record for the session summary
+    throughput_json = os.path.join(res_dir, v_stub + '_throughput.json')
 
     # Check that input video file exists
     if not os.path.isfile(vin_path):
         print('* %s does not exist - returning' % vin_path)
         return False
 
+    camera_device = cfg.get('CAMERA', 'device')
+
     # Set up the LBP cascade classifier
-    LBP_path = os.path.join(utils._package_root(), 'Cascade/cascade.xml')
+    LBP_path = os.path.join(utils._package_root(), ('Cascade_%s/cascade.xml' % camera_device))
 
-    print('  Loading LBP cascade')
+    print('  Loading LBP cascade for %s camera' % camera_device)
     cascade = cv2.CascadeClassifier(LBP_path)
 
     if cascade.empty():
         print('* LBP cascade is empty - mrgaze installation problem')
         return False
 
+    # Look for a checkpoint from an interrupted run on the same inputs
+    ckpt_key = CheckpointKey(vin_path, cfg, v_stub)
+    ckpt = ReadCheckpoint(ckpt_json, ckpt_key, pupils_csv) if do_resume else None
+
     # Check for output CSV existance and overwrite flag
-    if os.path.isfile(pupils_csv):
+    if ckpt:
+        print('+ Checkpoint found - resuming pupilometry at frame %d' % ckpt['frame'])
+    elif os.path.isfile(pupils_csv):
         print('+ Pupilometry output already exists - checking overwrite flag')
-        if overwrite:
+        if force:
+            print('+ Pupilometry inputs changed - overwriting')
+        elif overwrite:
             print('+ Overwrite allowed - continuing')
         else:
             print('+ Overwrite forbidden - skipping pupilometry')
@@ -596,41 +582,69 @@ def VideoPupilometry(data_dir, subj_sess, v_stub, cfg):
 
     print('  Video has %d frames at %0.3f fps' % (nf, vin_fps))
 
-    # Read first preprocessed video frame from stream
-    keep_going, frame_orig = media.LoadVideoFrame(vin_stream, cfg)
-    if keep_going:
-        frame, art_power = media.Preproc(frame_orig, cfg)
-    else:
-        art_power = 0.0
-
-    # Get size of preprocessed frame for output video setup
-    nx, ny = frame.shape[1], frame.shape[0]
+    # Seek input to checkpointed frame
+    if ckpt and not media.SeekFrame(vin_stream, ckpt['frame']):
+        print('* Could not seek to checkpoint frame - starting from first frame')
+        vin_stream.release()
+        vin_stream = cv2.VideoCapture(vin_path)
+        ckpt = None
 
     #
     # Output video
     #
     print('  Opening output video stream')
 
-    # Output video codec (MP4V - poor quality compression)
-    fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
-
-    try:
-        vout_stream = cv2.VideoWriter(vout_path, fourcc, 30, (nx, ny), True)
-    except:
-        print('* Problem creating output video stream - skipping pupilometry')
-        return False
+    # Overlay video segment file for each checkpoint interval
+    def SegmentPath(i):
+        return os.path.join(res_dir, '%s_pupils_part%02d%s' % (v_stub, i, vout_ext))
 
-    if not vout_stream.isOpened():
-        print('* Output video not opened - skipping pupilometry')
-        return False
+    # Completed segments, closed at each checkpoint. A resumed run rewrites
+    # the segment in progress when it was interrupted.
+    if ckpt:
+        segments = ckpt['segments']
+    else:
+        segments = []
+        RemoveSegments(res_dir, v_stub, vout_ext)
 
-    # Open pupilometry CSV file to write
+    # Open pupilometry CSV file to write, or truncate to the
+    # last checkpoint and append
     try:
-        pupils_stream = open(pupils_csv, 'w')
+        if ckpt:
+            os.truncate(pupils_csv, ckpt['csv_offset'])
+        pupils_sink = framepipeline.CSVSink({v_stub: pupils_csv}, append=bool(ckpt))
+        pupils_stream = pupils_sink.Stream(v_stub)
     except:
         print('* Problem opening pupilometry CSV file - skipping pupilometry')
         return False
 
+    vout_sink = framepipeline.VideoSink({v_stub: SegmentPath(len(segments))}, 30)
+
+    sinks = [pupils_sink, vout_sink]
+
+    # Binary records, truncated to the checkpointed frame on resume
+    if cfg.getboolean('OUTPUT', 'binary', fallback=False):
+        bin_sink = framepipeline.BinarySink({v_stub: pupils_bin}, ckpt['frame'] if ckpt else None)
+        sinks.append(bin_sink)
+    else:
+        bin_sink = None
+
+    # Stream calibrated gaze, recalibrating rows committed before a resume
+    if calibration is not None:
+        if ckpt:
+            p = engine.ReadPupilometry(pupils_csv)
+            calibration.Extend(p[:,0], p[:,2], p[:,3])
+        sinks.append(framepipeline.CalibratedGazeSink(calibration, v_stub))
+
+    # Init frame counter, starting from checkpoint if resuming
+    fc = ckpt['frame'] if ckpt else 0
+    fc0 = fc
+
+    source = framepipeline.VideoSource(vin_stream, vin_fps, clock='video', index=fc)
+
+    pipe = framepipeline.FramePipeline({v_stub: source}, cascade, cfg, sinks, v_stub,
+                                       graphics=cfg.getboolean('OUTPUT', 'graphics'),
+                                       display_fps=cfg.getfloat('OUTPUT', 'displayfps', fallback=15.0))
+
     #
     # Main Video Frame Loop
     #
@@ -641,58 +655,177 @@ def VideoPupilometry(data_dir, subj_sess, v_stub, cfg):
         print('  %10s %10s %10s %10s %10s %10s' % (
             'Time (s)', '% Done', 'Area', 'Blink', 'Artifact', 'FPS'))
 
-    # Init frame counter
-    fc = 0
+    # Per-stage timing instrumentation (no cost when disabled)
+    metrics.Enable(cfg.getboolean('OUTPUT', 'metrics', fallback=False))
 
     # Init processing timer
     t0 = time.time()
+    last = None
 
-    while keep_going:
-
-        # Current video time in seconds
-        t = fc / vin_fps
-
-        # -------------------------------------
-        # Pass this frame to pupilometry engine
-        # -------------------------------------
-        pupil_ellipse, roi_rect, blink, glint, frame_rgb = engine.PupilometryEngine(frame, cascade, cfg)
-
-        # Derive pupilometry parameters
-        px, py, area = engine.PupilometryPars(pupil_ellipse, glint, cfg)
-
-        # Write data line to pupilometry CSV file
-        pupils_stream.write(
-            '%0.3f,%0.3f,%0.3f,%0.3f,%d,%0.3f,\n' %
-            (t, area, px, py, blink, art_power)
-        )
-
-        # Write output video frame
-        vout_stream.write(frame_rgb)
-
-        # Read next frame (if available)
-        keep_going, frame_orig = media.LoadVideoFrame(vin_stream, cfg)
-        if keep_going:
-            frame, art_power = media.Preproc(frame_orig, cfg)
-        else:
-            art_power = 0.0
+    while True:
 
-        # Increment frame counter
-        fc = fc + 1
+        fr = pipe.Step()
+        if fr is None:
+            break
+        last = fr
+
+        # Frames committed so far
+        fc = fr.index + 1
+
+        # Commit progress, closing the video segment first
+        if ckpt_every > 0 and fc % ckpt_every == 0:
+            segments.append([os.path.basename(SegmentPath(len(segments))), vout_sink.n_frames[v_stub]])
+            vout_sink.Split(v_stub, SegmentPath(len(segments)))
+            if bin_sink is not None:
+                bin_sink.Flush()
+                os.fsync(bin_sink.Stream(v_stub).fileno())
+            WriteCheckpoint(ckpt_json, pupils_stream, {
+                'key'      : ckpt_key,
+                'frame'    : fc,
+                'segments' : segments,
+            })
 
         # Report processing FPS
         if verbose:
             if fc % 100 == 0:
                 perc_done = fc / float(nf) * 100.0
-                pfps = fc / (time.time() - t0)
+                pfps = (fc - fc0) / (time.time() - t0)
                 print('  %10.1f %10.1f %10.1f %10d %10.3f %10.1f' % (
-                    t, perc_done, area, blink, art_power, pfps))
+                    fr.t, perc_done, fr.area, fr.blink, fr.art_power, pfps))
 
 
     # Clean up
-    cv2.destroyAllWindows()
+    if cfg.getboolean('OUTPUT', 'graphics'):
+        cv2.destroyAllWindows()
     vin_stream.release()
-    vout_stream.release()
-    pupils_stream.close()
+    pipe.Close()
+
+    # Join the overlay video segments
+    segments.append([os.path.basename(SegmentPath(len(segments))), vout_sink.n_frames[v_stub]])
+    JoinSegments(res_dir, segments, vout_path)
+
+    # Completed run - checkpoint no longer needed
+    if os.path.isfile(ckpt_json):
+        os.remove(ckpt_json)
+
+    # Write per-stage timing histograms
+    if metrics.SaveMetrics(metrics_json):
+        print('  Stage timing metrics written to %s' % metrics_json)
+
+    if last is None:
+        return False
+
+    WriteThroughput(throughput_json, last.index + 1 - fc0, time.time() - t0)
 
     # Return pupilometry timeseries
-    return t, px, py, area, blink, art_power
+    return last.t, last.px, last.py, last.area, last.blink, last.art_power
+
+
+def CheckpointKey(vin_path, cfg, v_stub):
+    '''
+    Identify the inputs a checkpoint is valid for
+
+    Combines input video size and modification time with a hash of the
+    pupilometry config sections, so edits to either invalidate the checkpoint.
+    '''
+
+    st = os.stat(vin_path)
+
+    return '%d:%d:%s' % (st.st_size, st.st_mtime_ns,
+                         manifest.ConfigHash(cfg, v_stub + '_pupilometry'))
+
+
+def ReadCheckpoint(ckpt_json, ckpt_key, pupils_csv):
+    '''
+    Load a pupilometry checkpoint if it matches the current inputs
+
+    Returns
+    ----
+    ckpt : dict or None
+        Checkpoint state, or None if missing, stale or inconsistent
+    '''
+
+    if not os.path.isfile(ckpt_json):
+        return None
+
+    try:
+        with open(ckpt_json, 'r') as ckpt_stream:
+            ckpt = json.load(ckpt_stream)
+    except ValueError:
+        print('* Checkpoint file is corrupt - ignoring')
+        return None
+
+    if ckpt.get('key') != ckpt_key:
+        print('+ Checkpoint is for different video or config - ignoring')
+        return None
+
+    # Committed CSV rows must still be present
+    if not os.path.isfile(pupils_csv) or os.path.getsize(pupils_csv) < ckpt['csv_offset']:
+        print('* Pupilometry CSV shorter than checkpoint - ignoring checkpoint')
+        return None
+
+    return ckpt
+
+
+def JoinSegments(res_dir, segments, vout_path):
+    '''
+    Join overlay video segments into one video and remove them
+    '''
+
+    part_paths = [os.path.join(res_dir, name) for name, n in segments if n > 0]
+
+    if len(part_paths) == 1:
+        os.replace(part_paths[0], vout_path)
+    elif part_paths:
+        print('  Joining %d overlay video segments' % len(part_paths))
+        media.JoinVideos(part_paths, vout_path)
+
+    for name, _ in segments:
+        if os.path.isfile(os.path.join(res_dir, name)):
+            os.remove(os.path.join(res_dir, name))
+
+
+def RemoveSegments(res_dir, v_stub, vout_ext):
+    '''
+    Remove overlay video segments left by an earlier interrupted run
+    '''
+
+    prefix = v_stub + '_pupils_part'
+
+    for name in os.listdir(res_dir):
+        if name.startswith(prefix) and name.endswith(vout_ext):
+            os.remove(os.path.join(res_dir, name))
+
+
+def WriteThroughput(throughput_json, n_frames, wall_s):
+    '''
+    Record frames processed in this run and the processing rate
+    '''
+
+    try:
+        with open(throughput_json, 'w') as throughput_stream:
+            json.dump({
+                'frames' : n_frames,
+                'wall_s' : wall_s,
+                'fps'    : n_frames / wall_s if wall_s > 0.0 else 0.0,
+            }, throughput_stream, indent=2)
+    except IOError:
+        print('* Problem saving processing rate - skipping')
+
+
+def WriteCheckpoint(ckpt_json, pupils_stream, state):
+    '''
+    Flush pupilometry CSV to disk and atomically record checkpoint state
+    '''
+
+    # Make sure all rows up to this frame are on disk before committing
+    pupils_stream.flush()
+    os.fsync(pupils_stream.fileno())
+
+    state['csv_offset'] = pupils_stream.tell()
+
+    tmp_json = ckpt_json + '.tmp'
+    with open(tmp_json, 'w') as ckpt_stream:
+        json.dump(state, ckpt_stream)
+
+    os.replace(tmp_json, ckpt_json)
@@ -27,9 +27,14 @@
 
 import os
 import string
-import pylab as plt
 import numpy as np
-from mrgaze import calibrate, engine
+from mrgaze import calibrate, engine, utils
+
+# Time bins for min/max decimation of plotted timeseries
+MAX_PLOT_BINS = 1000
+
+# Pupilometry columns plotted (area, center x and y, blink, artifact power)
+PUPIL_COLUMNS = (1, 2, 3, 4, 5)
 
 # Define template
 TEMPLATE_FORMAT = """
@@ -64,12 +69,16 @@ td {
   <tr><td><b>Artifact Start Time</b> <td>$art_t0 seconds</tr>
 </table>
 
+<!-- Live capture-to-result latency -->
+$latency
+
 <!-- Plotted timeseries -->
 <p>
 <table>
 
   <tr><td><h2>Calibrated Gaze Results</h2></tr>
   <tr><td valign="top">$cal_gaze_res</tr>
+  <tr><td valign="top">$events</tr>
 
   <tr><td><h2>Calibration</h2></tr>
   <tr><td valign="top">$cal_heatmap</tr>
@@ -99,25 +108,49 @@ def WriteReport(ss_dir, cfg):
     # Extract subj/sess name
     subj_sess = os.path.basename(ss_dir)
 
-    # Create timeseries plots
-    print('  Plot calibration video pupilometry')
     cal_csv = os.path.join(ss_res_dir, 'cal_pupils.csv')
     cal_png = os.path.join(ss_res_dir, 'cal_pupils.png')
-    PlotPupilometry(cal_csv, cal_png)
-
-    print('  Plot gaze video pupilometry')
     gaze_pupils_csv = os.path.join(ss_res_dir, 'gaze_pupils.csv')
     gaze_pupils_png = os.path.join(ss_res_dir, 'gaze_pupils.png')
-    PlotPupilometry(gaze_pupils_csv, gaze_pupils_png)
-
-    print('  Plot calibrated gaze results')
     gaze_csv = os.path.join(ss_res_dir, 'gaze_calibrated.csv')
     gaze_png = os.path.join(ss_res_dir, 'gaze_calibrated.png')
-    PlotGaze(gaze_csv, gaze_png)
+
+    # Read each result file once. Timeseries are decimated here, keeping the
+    # extremes in MAX_PLOT_BINS time bins, so worker processes receive small
+    # arrays. The plot functions draw the rows they are given.
+    jobs = []
+
+    print('  Plot calibration video pupilometry')
+    cal_p = ReadResults(cal_csv, engine.ReadPupilometry)
+    if cal_p is not None:
+        jobs.append((PlotPupilometry, (cal_csv, cal_png, DecimateRows(cal_p, PUPIL_COLUMNS))))
+
+    print('  Plot gaze video pupilometry')
+    gaze_p = ReadResults(gaze_pupils_csv, engine.ReadPupilometry)
+    if gaze_p is not None:
+        jobs.append((PlotPupilometry, (gaze_pupils_csv, gaze_pupils_png, DecimateRows(gaze_p, PUPIL_COLUMNS))))
+
+    print('  Plot calibrated gaze results')
+    gaze = ReadResults(gaze_csv, lambda f: np.column_stack(calibrate.ReadGaze(f)))
+    if gaze is not None:
+        jobs.append((PlotGaze, (gaze_csv, gaze_png, DecimateRows(gaze, (1, 2)),
+                                GazeScatter(gaze), GazeHeatMap(gaze_csv, gaze))))
+
+    RenderFigures(jobs, cfg.getint('OUTPUT', 'reportworkers', fallback=0))
 
     # Estimate time of first artifact
     print('  Locating artifact start time')
-    art_t0 = ArtifactStartTime(gaze_pupils_csv)
+    if gaze_p is not None:
+        art_t0 = ArtifactOnset(gaze_p[:,0], gaze_p[:,5])
+    else:
+        print('* Pupilometry file not found - returning')
+        art_t0 = False
+
+    # Summarize live capture-to-result latency if recorded
+    latency = LatencyTable(ss_res_dir)
+
+    # Summarize gaze events if detected
+    events_table = EventsTable(ss_res_dir)
 
     # Handle disabled calibration
     if cfg.getboolean('CALIBRATION','calibrate'):
@@ -138,7 +171,9 @@ def WriteReport(ss_dir, cfg):
         ('subj_sess',    "%s"    % (subj_sess)),
         ('art_t0',       "%0.1f" % (art_t0)),
         ('cal_gaze_res', "%s"    % (cal_gaze_res)),
-        ('cal_heatmap', "%s"     % (cal_heatmap))
+        ('cal_heatmap', "%s"     % (cal_heatmap)),
+        ('latency',     "%s"     % (latency)),
+        ('events',      "%s"     % (events_table))
     ])
 
     # Generate HTML report from template (see above)
@@ -150,17 +185,31 @@ def WriteReport(ss_dir, cfg):
     open(report_index, "w").write(html_data)
 
 
-def PlotPupilometry(csv_file, plot_png):
+def PlotPupilometry(csv_file, plot_png, p=None):
     '''
     Read pupilometry CSV and plot timeseries
+
+    Arguments
+    ----
+    csv_file : string
+        Pupilometry CSV file (read only if p is None)
+    plot_png : string
+        Figure file
+    p : 2D float array
+        Already loaded pupilometry (see engine.ReadPupilometry), plotted as
+        given. WriteReport passes rows decimated by DecimateRows.
     '''
 
-    if not os.path.isfile(csv_file):
-        print('* Pupilometry file not found - returning')
-        return False
+    plt = utils._pyplot()
 
-    # Load pupilometry data from CSV file
-    p = engine.ReadPupilometry(csv_file)
+    if p is None:
+
+        if not os.path.isfile(csv_file):
+            print('* Pupilometry file not found - returning')
+            return False
+
+        # Load pupilometry data from CSV file
+        p = engine.ReadPupilometry(csv_file)
 
     # Extract timeseries
     t        = p[:,0]
@@ -169,13 +218,6 @@ def PlotPupilometry(csv_file, plot_png):
     blink    = p[:,4]
     art      = p[:,5]
 
-    # Downsample if total samples > 2000
-    nt = p.shape[0]
-    if nt > 2000:
-        dt = int(nt / 2000.0)
-        inds = np.arange(0, nt, dt)
-        p = p[inds,:]
-
     # Create figure, plot all timeseries in subplots
     fig = plt.figure(figsize = (6,8))
 
@@ -212,6 +254,87 @@ def PlotPupilometry(csv_file, plot_png):
     plt.close(fig)
 
 
+def LatencySummary(csv_file):
+    '''
+    Capture-to-result latency percentiles from a live latency CSV file
+
+    Returns
+    ----
+    summary : dict
+        p50, p95 and p99 in ms for the preproc, engine and output
+        timestamps keyed by stage name (empty if no data)
+    '''
+
+    if not os.path.isfile(csv_file):
+        return {}
+
+    lat = np.genfromtxt(csv_file, delimiter=',', usecols=(1, 2, 3), ndmin=2)
+    if lat.size == 0:
+        return {}
+
+    perc = np.percentile(lat, [50.0, 95.0, 99.0], axis=0)
+
+    return dict((stage, perc[:, c]) for c, stage in enumerate(['preproc', 'engine', 'output']))
+
+
+def LatencyTable(ss_res_dir):
+    '''
+    HTML table of live capture-to-result latency percentiles
+    '''
+
+    rows = []
+
+    for v_stub in ['cal', 'gaze']:
+
+        summary = LatencySummary(os.path.join(ss_res_dir, v_stub + '_latency.csv'))
+
+        for stage in ['preproc', 'engine', 'output']:
+            if stage in summary:
+                p50, p95, p99 = summary[stage]
+                rows.append('  <tr><td>%s<td>%s<td>%0.1f<td>%0.1f<td>%0.1f</tr>' % (
+                    v_stub, stage, p50, p95, p99))
+
+    if not rows:
+        return ''
+
+    return '\n'.join([
+        '<p>',
+        '<table>',
+        '  <tr><td><h2>Capture-to-Result Latency</h2><td></tr>',
+        '  <tr><td><b>Video</b><td><b>Stage</b><td><b>p50 (ms)</b><td><b>p95 (ms)</b><td><b>p99 (ms)</b></tr>',
+        ] + rows + ['</table>'])
+
+
+def EventsTable(ss_res_dir):
+    '''
+    HTML table of gaze event statistics from the events table
+    '''
+
+    from mrgaze import events
+
+    rows = []
+
+    for method, ev in events.ReadEvents(os.path.join(ss_res_dir, 'gaze_events.csv')).items():
+
+        for name, s in events.EventSummary(ev).items():
+            rows.append('  <tr><td>%s<td>%s<td>%d<td>%0.1f<td>%0.1f<td>%0.3f<td>%0.3f<td>%s<td>%s</tr>' % (
+                method, name, s['count'], s['rate'], 100.0 * s['fraction'],
+                s['mean_duration'], s['median_duration'],
+                '%0.3f' % s['amplitude'] if np.isfinite(s['amplitude']) else '',
+                '%0.2f' % s['peak_velocity'] if np.isfinite(s['peak_velocity']) else ''))
+
+    if not rows:
+        return ''
+
+    return '\n'.join([
+        '<table>',
+        '  <tr><td><h2>Gaze Events</h2><td></tr>',
+        '  <tr><td><b>Method</b><td><b>Event</b><td><b>Count</b><td><b>Rate (/min)</b>'
+        '<td><b>Time (%)</b><td><b>Mean (s)</b><td><b>Median (s)</b>'
+        '<td><b>Amplitude</b><td><b>Peak Velocity (/s)</b></tr>',
+        ] + rows + ['</table>'])
+
+
 def ArtifactStartTime(csv_file):
     '''
     Estimate the time of the first artifact
@@ -227,6 +350,14 @@ def ArtifactStartTime(csv_file):
     # Extract time and artifact power vectors
     t, art   = p[:,0], p[:,5]
 
+    return ArtifactOnset(t, art)
+
+
+def ArtifactOnset(t, art):
+    '''
+    Time of the first sample with artifact power above its median
+    '''
+
     # Threshold at median artifact power distribution
     art_on = art > np.median(art)
 
@@ -236,20 +367,45 @@ def ArtifactStartTime(csv_file):
     return art_t0
 
 
-def PlotGaze(csv_file, plot_png):
+def PlotGaze(csv_file, plot_png, gaze=None, scatter=None, heatmap=None):
     '''
     Plot calibrated gaze results in a single figure
+
+    Arguments
+    ----
+    csv_file : string
+        Calibrated gaze CSV file (read only if gaze is None)
+    plot_png : string
+        Figure file
+    gaze : n x 3 float array
+        Already loaded t, gaze x, gaze y, plotted as given. WriteReport
+        passes rows decimated by DecimateRows.
+    scatter : m x 3 float array
+        Gaze samples for the scatter plot (see GazeScatter)
+    heatmap : tuple
+        Gaze heatmap with bin edges (see GazeHeatMap)
     '''
 
-    if not os.path.isfile(csv_file):
-        print('* Calibrated gaze file not found - returning')
-        return False
+    plt = utils._pyplot()
+
+    if gaze is None:
+
+        if not os.path.isfile(csv_file):
+            print('* Calibrated gaze file not found - returning')
+            return False
+
+        # Load calibrated gaze timeseries from CSV file
+        gaze = np.column_stack(calibrate.ReadGaze(csv_file))
+
+    if scatter is None:
+        scatter = GazeScatter(gaze)
 
-    # Load calibrated gaze timeseries from CSV file
-    t, gaze_x, gaze_y = calibrate.ReadGaze(csv_file)
+    if heatmap is None:
+        heatmap = GazeHeatMap(csv_file, gaze)
 
-    # Create heatmap of calibrated gaze
-    hmap, xedges, yedges = calibrate.HeatMap(gaze_x, gaze_y, (0.0, 1.0), (0.0,1.0), sigma=1.0)
+    hmap, xedges, yedges = heatmap
+
+    t, gaze_x, gaze_y = gaze.T
 
     # Create figure, plot timeseries and heatmaps in subplots
     fig = plt.figure(figsize = (6,6))
@@ -263,7 +419,7 @@ def PlotGaze(csv_file, plot_png):
     ax.legend(shadow=False, prop={'size':6}, labelspacing=0.25)
 
     ax = fig.add_subplot(223)
-    ax.scatter(gaze_x, gaze_y, s=1)
+    ax.scatter(scatter[:,1], scatter[:,2], s=1)
     ax.tick_params(axis='both', labelsize=8)
     ax.set_xlim((-0.1, 1.1))
     ax.set_ylim((-0.1, 1.1))
@@ -283,3 +439,124 @@ def PlotGaze(csv_file, plot_png):
 
     # Close figure without showinging it
     plt.close(fig)
+
+
+def GazeHeatMap(csv_file, gaze):
+    '''
+    Gaze heatmap with bin edges, reusing the counts saved with the calibrated
+    gaze if they are current
+    '''
+
+    heatmap_npz = calibrate.GazeHeatMapFile(csv_file)
+    if os.path.isfile(heatmap_npz) and os.path.getmtime(heatmap_npz) >= os.path.getmtime(csv_file):
+        return calibrate.HeatMapAccumulator.Load(heatmap_npz).Read(sigma=1.0)
+
+    return calibrate.HeatMap(gaze[:,1], gaze[:,2], (0.0, 1.0), (0.0, 1.0), sigma=1.0)
+
+
+def GazeScatter(gaze, max_points=20000):
+    '''
+    Evenly spaced subset of gaze samples for the scatter plot
+    '''
+
+    step = max(int(np.ceil(gaze.shape[0] / float(max_points))), 1)
+
+    return gaze[::step]
+
+
+def DecimateRows(p, cols, n_bins=MAX_PLOT_BINS):
+    '''
+    Min/max envelope decimation of timeseries in rows
+
+    Rows are split into n_bins equal time-ordered bins. The rows holding the
+    minimum and maximum of each column in each bin are kept in their
+    original order, so single-sample spikes survive decimation while a plot
+    of the kept rows needs at most 2 x n_bins x len(cols) points.
+
+    Arguments
+    ----
+    p : 2D float array
+        Timeseries in columns, samples in rows
+    cols : integer tuple
+        Columns whose extremes are kept
+    n_bins : integer
+        Number of time bins
+
+    Returns
+    ----
+    p_dec : 2D float array
+        Subset of rows of p
+    '''
+
+    n = p.shape[0]
+
+    if n <= 2 * n_bins * len(cols):
+        return p
+
+    # Equal bins over the leading rows, plus a short last bin for the rest
+    size = n // n_bins
+    n_even = size * n_bins
+
+    keep = np.zeros(n, dtype=bool)
+
+    for c in cols:
+
+        v = p[:, c]
+
+        # NaNs never win the min or max unless the whole bin is NaN
+        lo = np.where(np.isnan(v), np.inf, v)
+        hi = np.where(np.isnan(v), -np.inf, v)
+
+        base = np.arange(n_bins) * size
+        keep[base + lo[:n_even].reshape(n_bins, size).argmin(axis=1)] = True
+        keep[base + hi[:n_even].reshape(n_bins, size).argmax(axis=1)] = True
+
+        if n_even < n:
+            keep[n_even + lo[n_even:].argmin()] = True
+            keep[n_even + hi[n_even:].argmax()] = True
+
+    return p[keep]
+
+
+def ReadResults(csv_file, reader):
+    '''
+    Read a results file with reader, or None if missing or empty
+    '''
+
+    if not os.path.isfile(csv_file) or os.path.getsize(csv_file) == 0:
+        print('* %s not found - skipping' % os.path.basename(csv_file))
+        return None
+
+    return reader(csv_file)
+
+
+def RenderFigures(jobs, workers=0):
+    '''
+    Render report figures, in parallel worker processes if available
+
+    Arguments
+    ----
+    jobs : list of (function, args) tuples
+        Plot calls, each writing its own figure file
+    workers : integer
+        Worker processes (0 : one per CPU). With one worker, or a single
+        figure, figures are rendered in this process.
+    '''
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    workers = min(workers, len(jobs))
+
+    if workers <= 1:
+        for func, args in jobs:
+            func(*args)
+        return
+
+    # Each worker imports pyplot with the Agg backend (see utils._pyplot)
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(func, *args) for func, args in jobs]
+        for future in futures:
+            future.result()
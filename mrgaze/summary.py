@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+"""
+Session summaries and the batch QC dashboard
+
+At the end of each session a compact summary of its results is written to
+results/summary.json : recording length and sample rate, blink fraction,
+artifact onset, processing frame rate, calibration model and residuals,
+gaze event rates and a few short binned timeseries for sparklines. The
+summary is a few kilobytes however long the recording.
+
+WriteDashboard collects the summaries of every session in a data directory
+into a single HTML page (mrgaze_dashboard.html) with a sortable table and a
+row of sparklines per session. Only the summary files are read, so the
+dashboard for hundreds of sessions is built in well under a second.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import json
+import time
+import string
+import numpy as np
+
+# Summary file name in each results directory
+SUMMARY_JSON = 'summary.json'
+
+# Dashboard file name in the data directory
+DASHBOARD_HTML = 'mrgaze_dashboard.html'
+
+# Points in each summary sparkline
+SPARK_POINTS = 60
+
+# Dashboard table columns : summary key, heading, number format
+SUMMARY_COLUMNS = [
+    ('n_samples',      'Samples',           '%d'),
+    ('duration',       'Duration (s)',      '%0.1f'),
+    ('sample_rate',    'Sample Rate (Hz)',  '%0.1f'),
+    ('proc_fps',       'Processing (fps)',  '%0.1f'),
+    ('blink_frac',     'Blinks (%)',        '%0.1f'),
+    ('art_onset',      'Artifact Onset (s)', '%0.2f'),
+    ('area_median',    'Pupil Area',        '%0.1f'),
+    ('cal_model',      'Model',             '%s'),
+    ('cal_source',     'Model Source',      '%s'),
+    ('cal_rms',        'Cal RMS',           '%0.4f'),
+    ('cal_max',        'Cal Max',           '%0.4f'),
+    ('cal_loo_rms',    'LOO RMS',           '%0.4f'),
+    ('cal_loo_max',    'LOO Max',           '%0.4f'),
+    ('fixation_rate',  'Fixations (/min)',  '%0.1f'),
+    ('saccade_rate',   'Saccades (/min)',   '%0.1f'),
+    ('n_volumes',      'Volumes',           '%d'),
+]
+
+# Dashboard sparklines : summary series key, heading
+SPARK_SERIES = [
+    ('area',  'Area Trace'),
+    ('blink', 'Blink Trace'),
+    ('art',   'Artifact Trace'),
+]
+
+# Define template
+DASHBOARD_FORMAT = """
+<html>
+
+<head>
+<STYLE TYPE="text/css">
+BODY {
+  font-family    : sans-serif;
+}
+td {
+  padding-left   : 10px;
+  padding-right  : 10px;
+  padding-top    : 0px;
+  padding-bottom : 0px;
+  vertical-align : middle;
+  text-align     : right;
+}
+th {
+  padding-left   : 10px;
+  padding-right  : 10px;
+  cursor         : pointer;
+}
+tr:nth-child(even) {
+  background     : #f0f0f0;
+}
+</STYLE>
+<script>
+function sortTable(col) {
+  var table = document.getElementById("sessions");
+  var rows = Array.prototype.slice.call(table.tBodies[0].rows);
+  var dir = table.getAttribute("data-col") == col && table.getAttribute("data-dir") == "1" ? -1 : 1;
+  rows.sort(function(a, b) {
+    var x = a.cells[col].getAttribute("data-v"), y = b.cells[col].getAttribute("data-v");
+    var fx = parseFloat(x), fy = parseFloat(y);
+    if (x === "" && y === "") return 0;
+    if (x === "") return 1;
+    if (y === "") return -1;
+    if (!isNaN(fx) && !isNaN(fy)) return dir * (fx - fy);
+    return dir * x.localeCompare(y);
+  });
+  rows.forEach(function(r) { table.tBodies[0].appendChild(r); });
+  table.setAttribute("data-col", col);
+  table.setAttribute("data-dir", dir);
+}
+</script>
+</head>
+
+<body>
+
+<h1 style="background-color:#E0E0FF">MRGAZE Batch Dashboard</h1>
+
+<p>Data directory : $data_dir<br>
+Sessions : $n_sessions<br>
+Created : $created<br>
+Click a column heading to sort.</p>
+
+<table id="sessions">
+<thead>
+$heading
+</thead>
+<tbody>
+$rows
+</tbody>
+</table>
+
+</body>
+
+</html>
+"""
+
+# Use string.Template for $ substitution
+DASHBOARD = string.Template(DASHBOARD_FORMAT)
+
+
+def WriteSummary(ss_dir, cfg):
+    '''
+    Write the summary of one subject/session's results
+
+    Arguments
+    ----
+    ss_dir : string
+        Subject/session directory containing results subdir
+    cfg : configuration object
+        Calibration targets
+
+    Returns
+    ----
+    success : boolean
+        True if the summary was written
+    '''
+
+    ss_res_dir = os.path.join(ss_dir, 'results')
+    summary_json = os.path.join(ss_res_dir, SUMMARY_JSON)
+
+    summ = SessionSummary(ss_dir, cfg)
+
+    tmp_json = summary_json + '.tmp'
+
+    try:
+        with open(tmp_json, 'w') as summary_stream:
+            json.dump(summ, summary_stream, indent=2)
+    except IOError:
+        print('* Problem saving session summary - skipping')
+        return False
+
+    os.replace(tmp_json, summary_json)
+
+    print('  Session summary written to %s' % SUMMARY_JSON)
+
+    return True
+
+
+def SessionSummary(ss_dir, cfg):
+    '''
+    Compact summary of one subject/session's results
+
+    Missing results (no calibration, events or volumes) give None values.
+
+    Returns
+    ----
+    summ : dict
+        Scalar QC values keyed as in SUMMARY_COLUMNS, plus 'series', a dict
+        of SPARK_POINTS-point binned timeseries keyed as in SPARK_SERIES
+    '''
+
+    from mrgaze import engine, report
+
+    ss_res_dir = os.path.join(ss_dir, 'results')
+
+    summ = dict((key, None) for key, _, _ in SUMMARY_COLUMNS)
+    summ['session'] = os.path.basename(os.path.normpath(ss_dir))
+    summ['created'] = time.time()
+    summ['series'] = {}
+
+    # Gaze pupilometry : t, area, px, py, blink, artifact power
+    pupils_csv = os.path.join(ss_res_dir, 'gaze_pupils.csv')
+
+    if os.path.isfile(pupils_csv) and os.path.getsize(pupils_csv) > 0:
+
+        p = engine.ReadPupilometry(pupils_csv)
+        t, area, blink, art = p[:,0], p[:,1], p[:,4] > 0, p[:,5]
+
+        summ['n_samples'] = int(t.shape[0])
+        summ['duration'] = t[-1] - t[0]
+        if t.shape[0] > 1:
+            summ['sample_rate'] = 1.0 / np.median(np.diff(t))
+        summ['blink_frac'] = 100.0 * blink.mean()
+        summ['art_onset'] = report.ArtifactOnset(t, art)
+
+        area_ok = np.where(blink, np.nan, area)
+        if np.isfinite(area_ok).any():
+            summ['area_median'] = np.nanmedian(area_ok)
+
+        summ['series'] = {
+            'area'  : BinnedSeries(area_ok),
+            'blink' : BinnedSeries(blink.astype(float)),
+            'art'   : BinnedSeries(art),
+        }
+
+    summ['proc_fps'] = ProcessingRate(ss_res_dir)
+
+    summ.update(CalibrationSummary(ss_res_dir, cfg))
+    summ.update(EventRates(ss_res_dir))
+
+    from mrgaze import volumes
+    vols = volumes.ReadVolumes(os.path.join(ss_res_dir, 'gaze_volumes.csv'))
+    if vols:
+        summ['n_volumes'] = int(vols['volume'].shape[0])
+
+    return dict((k, _JSONValue(v)) for k, v in summ.items())
+
+
+def BinnedSeries(v, n_points=SPARK_POINTS):
+    '''
+    NaN-aware means of v in n_points consecutive equal bins
+    '''
+
+    n = v.shape[0]
+
+    if n == 0:
+        return []
+
+    bounds = np.linspace(0, n, min(n_points, n) + 1).astype(int)[:-1]
+
+    ok = np.isfinite(v)
+    sums = np.add.reduceat(np.where(ok, v, 0.0), bounds)
+    counts = np.add.reduceat(ok.astype(float), bounds)
+
+    with np.errstate(invalid='ignore'):
+        return sums / counts
+
+
+def ProcessingRate(ss_res_dir):
+    '''
+    Gaze pupilometry processing rate in frames per second, or None
+
+    Taken from the throughput record written by pupilometry, or the stage
+    timing metrics if instrumentation was enabled.
+    '''
+
+    for stub in ('gaze_throughput.json', 'gaze_metrics.json', 'live_metrics.json'):
+
+        rec_json = os.path.join(ss_res_dir, stub)
+
+        if not os.path.isfile(rec_json):
+            continue
+
+        try:
+            with open(rec_json, 'r') as rec_stream:
+                fps = json.load(rec_stream).get('fps')
+        except ValueError:
+            continue
+
+        if fps:
+            return fps
+
+    return None
+
+
+def CalibrationSummary(ss_res_dir, cfg):
+    '''
+    Calibration model name, source and residuals
+
+    cal_rms and cal_max are gaze space distances between the calibration
+    targets and the calibrated fixations. cal_loo_rms and cal_loo_max are
+    the leave-one-out errors of the chosen model (see calibrate.SelectModel).
+    '''
+
+    from mrgaze import calibrate, calstore
+
+    summ = {}
+
+    rec = calstore.LoadModel(ss_res_dir)
+
+    if rec is None:
+        return summ
+
+    summ['cal_model'] = calibrate.ModelName(rec['C'])
+    summ['cal_source'] = rec['source'] if rec['key'] is None else 'own'
+
+    targets = np.array([json.loads(cfg.get('CALIBRATION', 'targetx')),
+                        json.loads(cfg.get('CALIBRATION', 'targety'))]).transpose()
+
+    fixations = rec['fixations']
+
+    if fixations.shape[0] == targets.shape[0]:
+        gx, gy = calibrate.ApplyModel(rec['C'], fixations[:,0], fixations[:,1])
+        err = np.hypot(gx - targets[:,0], gy - targets[:,1])
+        summ['cal_rms'] = np.sqrt(np.mean(err**2))
+        summ['cal_max'] = err.max()
+
+    # Leave-one-out errors are only known for models fitted in this session
+    errors_csv = os.path.join(ss_res_dir, 'calibration_model_errors.csv')
+
+    if rec['key'] is not None and os.path.isfile(errors_csv):
+        with open(errors_csv, 'r') as errors_stream:
+            errors_stream.readline()
+            for line in errors_stream:
+                model, rms, emax = line.strip().split(',')
+                if model == summ['cal_model']:
+                    summ['cal_loo_rms'], summ['cal_loo_max'] = float(rms), float(emax)
+
+    return summ
+
+
+def EventRates(ss_res_dir):
+    '''
+    Fixation and saccade rates per minute (I-VT if available)
+    '''
+
+    from mrgaze import events
+
+    summ = {}
+
+    ev = events.ReadEvents(os.path.join(ss_res_dir, 'gaze_events.csv'))
+
+    if not ev:
+        return summ
+
+    method = 'ivt' if 'ivt' in ev else sorted(ev)[0]
+    stats = events.EventSummary(ev[method])
+
+    for name in ('fixation', 'saccade'):
+        summ[name + '_rate'] = stats[name]['rate'] if name in stats else 0.0
+
+    return summ
+
+
+def ReadSummary(ss_res_dir):
+    '''
+    Load a session summary, or None if missing or unreadable
+    '''
+
+    summary_json = os.path.join(ss_res_dir, SUMMARY_JSON)
+
+    if not os.path.isfile(summary_json):
+        return None
+
+    try:
+        with open(summary_json, 'r') as summary_stream:
+            return json.load(summary_stream)
+    except ValueError:
+        print('* Session summary %s is corrupt - ignoring' % summary_json)
+        return None
+
+
+def WriteDashboard(data_dir):
+    '''
+    Write the batch QC dashboard from the session summaries in a data directory
+
+    Arguments
+    ----
+    data_dir : string
+        Root data directory containing subject/session directories
+
+    Returns
+    ----
+    n_sessions : integer
+        Number of sessions in the dashboard
+    '''
+
+    summaries = []
+
+    for subj_sess in sorted(next(os.walk(data_dir))[1]):
+        summ = ReadSummary(os.path.join(data_dir, subj_sess, 'results'))
+        if summ is not None:
+            summ['session'] = subj_sess
+            summaries.append(summ)
+
+    # Common sparkline scale for each series across sessions
+    limits = {}
+    for key, _ in SPARK_SERIES:
+        vals = [v for s in summaries for v in s['series'].get(key, []) if v is not None]
+        limits[key] = (min(vals), max(vals)) if vals else (0.0, 1.0)
+
+    cols = ['Session'] + [head for _, head, _ in SUMMARY_COLUMNS] + [head for _, head in SPARK_SERIES]
+    heading = '<tr>' + ''.join('<th onclick="sortTable(%d)">%s</th>' % (i, head)
+                               for i, head in enumerate(cols)) + '</tr>'
+
+    rows = []
+
+    for summ in summaries:
+
+        ss_link = '<a href="%s/results/index.html">%s</a>' % (summ['session'], summ['session'])
+        cells = ['<td data-v="%s" style="text-align:left">%s</td>' % (summ['session'], ss_link)]
+
+        for key, _, fmt in SUMMARY_COLUMNS:
+            v = summ.get(key)
+            if v is None:
+                cells.append('<td data-v=""></td>')
+            else:
+                cells.append('<td data-v="%s">%s</td>' % (v, fmt % v))
+
+        for key, _ in SPARK_SERIES:
+            vals = summ['series'].get(key, [])
+            cells.append('<td data-v="">%s</td>' % Sparkline(vals, limits[key]))
+
+        rows.append('<tr>' + ''.join(cells) + '</tr>')
+
+    qc_dict = dict(
+        data_dir   = os.path.abspath(data_dir),
+        n_sessions = len(summaries),
+        created    = time.strftime('%Y-%m-%d %H:%M:%S'),
+        heading    = heading,
+        rows       = '\n'.join(rows),
+    )
+
+    dashboard_html = os.path.join(data_dir, DASHBOARD_HTML)
+
+    with open(dashboard_html, 'w') as dashboard_stream:
+        dashboard_stream.write(DASHBOARD.substitute(qc_dict))
+
+    print('  Dashboard of %d sessions written to %s' % (len(summaries), dashboard_html))
+
+    return len(summaries)
+
+
+def Sparkline(vals, lims, width=120, height=24):
+    '''
+    Inline SVG polyline of a short series, scaled to lims
+
+    None values break the line.
+    '''
+
+    n = len(vals)
+
+    if n < 2:
+        return ''
+
+    v0, v1 = lims
+    scale = (height - 2) / (v1 - v0) if v1 > v0 else 0.0
+
+    lines, pts = [], []
+
+    for i, v in enumerate(vals):
+        if v is None:
+            if pts:
+                lines.append(pts)
+            pts = []
+            continue
+        x = i * (width - 1.0) / (n - 1)
+        y = height - 1 - (v - v0) * scale
+        pts.append('%0.1f,%0.1f' % (x, y))
+
+    if pts:
+        lines.append(pts)
+
+    polylines = ''.join('<polyline points="%s" fill="none" stroke="#3050c0" stroke-width="1"/>' % ' '.join(pts)
+                        for pts in lines)
+
+    return '<svg width="%d" height="%d">%s</svg>' % (width, height, polylines)
+
+
+def _JSONValue(v):
+    '''
+    Convert numpy scalars and arrays to JSON types, with NaN as None
+    '''
+
+    if isinstance(v, dict):
+        return dict((k, _JSONValue(x)) for k, x in v.items())
+
+    if isinstance(v, (list, tuple, np.ndarray)):
+        return [_JSONValue(x) for x in v]
+
+    if isinstance(v, (np.integer, int)) and not isinstance(v, bool):
+        return int(v)
+
+    if isinstance(v, (np.floating, float)):
+        return float(v) if np.isfinite(v) else None
+
+    return v
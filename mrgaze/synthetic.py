@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Synthetic eye video generator with known ground truth
+
+Renders dark-pupil infrared-style eye video with:
+- an elliptical pupil following a fixation/saccade trajectory over a
+  calibration target grid, with slow pupil size changes
+- a single saturated corneal glint
+- blinks (eyelid closure)
+- MR-style interlaced scanline artifacts
+
+The per-frame ground truth is returned and optionally written to CSV,
+for reproducible throughput and accuracy benchmarks of the pipeline.
+
+Example
+----
+>>> gt = synthetic.EyeVideo('videos/gaze.avi', 'videos/gaze_truth.csv', n_frames=900)
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import cv2
+import numpy as np
+
+# Default calibration target grid (normalized gaze space, same as config defaults)
+TARGETX = [0.5, 0.1, 0.9, 0.1, 0.1, 0.5, 0.1, 0.9, 0.5]
+TARGETY = [0.5, 0.9, 0.9, 0.1, 0.9, 0.9, 0.5, 0.5, 0.1]
+
+# Gray levels
+SKIN, SCLERA, IRIS, PUPIL, GLINT = 150, 200, 110, 20, 255
+
+
+def EyeVideo(vout_path, gt_csv=None, n_frames=900, fps=30.0, size=(320, 240),
+             targets=None, fix_dur=1.0, pupil_radius=14.0, blink_rate=0.2,
+             artifact_rate=0.1, noise_sd=3.0, seed=0):
+    '''
+    Render a synthetic eye video and its ground truth
+
+    Arguments
+    ----
+    vout_path : string
+        Output video file path
+    gt_csv : string
+        Optional ground truth CSV file path
+    n_frames : integer
+        Number of frames to render
+    fps : float
+        Frame rate in frames per second
+    size : integer tuple
+        Frame (width, height) in pixels
+    targets : n x 2 float array
+        Fixation targets in normalized gaze space [default 9-point grid]
+    fix_dur : float
+        Duration of each fixation in seconds
+    pupil_radius : float
+        Mean pupil semi-major axis in pixels
+    blink_rate : float
+        Mean blinks per second
+    artifact_rate : float
+        Fraction of frames with MR scanline artifacts
+    noise_sd : float
+        Gaussian pixel noise SD
+    seed : integer
+        Random seed
+
+    Returns
+    ----
+    gt : n x 9 float array
+        Ground truth timeseries in columns:
+        0 : Time (s)
+        1 : Pupil center x (pixels)
+        2 : Pupil center y (pixels)
+        3 : Pupil semi-major axis (pixels)
+        4 : Pupil semi-minor axis (pixels)
+        5 : Pupil ellipse angle (degrees)
+        6 : Pupil area (pixels^2)
+        7 : Blink flag
+        8 : Artifact flag
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    if targets is None:
+        targets = np.array([TARGETX, TARGETY]).T
+
+    gt = Trajectory(n_frames, fps, size, targets, fix_dur, pupil_radius,
+                    blink_rate, artifact_rate, rng)
+
+    nx, ny = size
+
+    fourcc = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
+    vout_stream = cv2.VideoWriter(vout_path, fourcc, fps, (nx, ny), True)
+
+    if not vout_stream.isOpened():
+        print('* Synthetic video output not opened - returning')
+        return np.array([])
+
+    for fc in range(n_frames):
+        frame = RenderFrame(gt[fc, :], size, noise_sd, rng)
+        vout_stream.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+
+    vout_stream.release()
+
+    if gt_csv:
+        np.savetxt(gt_csv, gt, fmt='%0.4f', delimiter=',')
+
+    return gt
+
+
+def Trajectory(n_frames, fps, size, targets, fix_dur, pupil_radius,
+               blink_rate, artifact_rate, rng):
+    '''
+    Generate ground truth pupil trajectory, blinks and artifacts
+
+    Fixations cycle through the targets in order with short saccades
+    between them and small fixational jitter. See EyeVideo for columns.
+    '''
+
+    nx, ny = size
+    t = np.arange(n_frames) / float(fps)
+
+    # Gaze range maps normalized targets to pupil center excursion
+    x0, y0 = nx * 0.5, ny * 0.5
+    gx, gy = nx * 0.18, ny * 0.16
+
+    # Target index for each frame and saccade blending over ~50 ms
+    n_fix = int(fix_dur * fps)
+    k = np.arange(n_frames) // n_fix
+    f = (np.arange(n_frames) % n_fix) / max(0.05 * fps, 1.0)
+    f = np.clip(f, 0.0, 1.0)
+
+    nt = targets.shape[0]
+    cur = targets[k % nt, :]
+    prev = targets[(k - 1) % nt, :]
+    prev[k == 0, :] = cur[k == 0, :]
+    tgt = prev + (cur - prev) * f[:, np.newaxis]
+
+    # Fixational jitter (0.3 pixel SD)
+    cx = x0 + (tgt[:, 0] - 0.5) * 2.0 * gx + rng.randn(n_frames) * 0.3
+    cy = y0 + (tgt[:, 1] - 0.5) * 2.0 * gy + rng.randn(n_frames) * 0.3
+
+    # Slow pupil size change and foreshortening with eccentric gaze
+    a = pupil_radius * (1.0 + 0.15 * np.sin(2.0 * np.pi * t / 7.0))
+    ecc = np.hypot(tgt[:, 0] - 0.5, tgt[:, 1] - 0.5)
+    b = a * np.cos(ecc * 0.8)
+    phi = np.degrees(np.arctan2(tgt[:, 1] - 0.5, tgt[:, 0] - 0.5))
+    area = np.pi * a * b
+
+    # Blinks of 150-300 ms starting at random times
+    blink = np.zeros(n_frames)
+    n_blinks = rng.poisson(blink_rate * n_frames / float(fps))
+    for b0 in rng.randint(0, n_frames, n_blinks):
+        blink[b0:b0 + rng.randint(int(0.15 * fps), int(0.3 * fps) + 1)] = 1.0
+
+    # Scanline artifacts in random frames
+    artifact = np.float64(rng.rand(n_frames) < artifact_rate)
+
+    return np.array([t, cx, cy, a, b, phi, area, blink, artifact]).T
+
+
+def RenderFrame(g, size, noise_sd, rng):
+    '''
+    Render a single grayscale frame from one row of ground truth
+    '''
+
+    nx, ny = size
+    t, cx, cy, a, b, phi, area, blink, artifact = g
+
+    frame = np.full((ny, nx), SKIN, np.uint8)
+
+    # Eye opening and sclera - fixed in the camera frame
+    eye_c = (int(nx * 0.5), int(ny * 0.5))
+    eye_ax = (int(nx * 0.36), int(ny * 0.32))
+    cv2.ellipse(frame, eye_c, eye_ax, 0, 0, 360, SCLERA, -1)
+
+    if blink > 0:
+
+        # Closed eyelid covers the eye opening. The lid crease is kept faint
+        # and thin so nothing pupil-like remains for the engine to fit.
+        cv2.ellipse(frame, eye_c, eye_ax, 0, 0, 360, SKIN - 10, -1)
+        cv2.line(frame, (eye_c[0] - eye_ax[0], eye_c[1]), (eye_c[0] + eye_ax[0], eye_c[1]), SKIN - 40, 1)
+
+    else:
+
+        # Iris, pupil and glint move with gaze, clipped by the eye opening
+        eye = np.zeros_like(frame)
+        cv2.ellipse(eye, eye_c, eye_ax, 0, 0, 360, 1, -1)
+
+        layer = frame.copy()
+        cv2.circle(layer, (int(round(cx)), int(round(cy))), int(a * 2.6), IRIS, -1)
+        cv2.ellipse(layer, ((cx, cy), (2.0 * a, 2.0 * b), phi), PUPIL, -1)
+        frame[eye > 0] = layer[eye > 0]
+
+        # Glint from a fixed illuminator, slightly offset from pupil center
+        gx, gy = cx + 0.4 * a + (cx - eye_c[0]) * 0.1, cy - 0.4 * a
+        cv2.circle(frame, (int(round(gx)), int(round(gy))), 2, GLINT, -1)
+
+    # Light blur and sensor noise
+    frame = cv2.GaussianBlur(frame, (3, 3), 0)
+    frame = np.clip(frame + rng.randn(ny, nx) * noise_sd, 0, 255).astype(np.uint8)
+
+    if artifact > 0:
+
+        # RF spike corrupts a block of odd scanlines
+        r0 = rng.randint(0, ny // 2 - 10)
+        rows = np.arange(2 * r0 + 1, min(2 * r0 + 41, ny), 2)
+        frame[rows, :] = np.clip(frame[rows, :].astype(int) + rng.choice([-80, 80]), 0, 255)
+
+    return frame
+
+
+def ReadTruth(gt_csv):
+    '''
+    Read ground truth CSV written by EyeVideo (see EyeVideo for columns)
+    '''
+
+    return np.genfromtxt(gt_csv, delimiter=',')
@@ -22,11 +22,8 @@ Copyright 2014 California Institute of Technology.
 
 import os
 import sys
-import cv2
 import numpy as np
 import time
-from scipy.ndimage import generic_filter
-from scipy.stats import nanmedian
 
 def mktimestamp():
     """
@@ -129,9 +126,36 @@ def _mad(x):
 def _nanmedfilt(x, k):
     '''
     1D moving median filter with NaN masking
+
+    Windows are centered on each sample and shrink at the ends. All-NaN
+    windows give NaN.
+    '''
+
+    h = k // 2
+    xp = np.concatenate((np.full(h, np.nan), np.asarray(x, dtype=float), np.full(h, np.nan)))
+
+    return _nanmedian_rows(np.lib.stride_tricks.sliding_window_view(xp, 2 * h + 1))
+
+
+def _nanmedian_rows(w):
+    '''
+    Median of each row of a 2D array ignoring NaNs
+
+    One sort along the rows moves NaNs to the end, so the median is picked
+    by index from the count of finite values, without a per-row loop.
     '''
 
-    return generic_filter(x, nanmedian, k)
+    ws = np.sort(w, axis=1)
+    n_ok = w.shape[1] - np.isnan(w).sum(axis=1)
+
+    lo = np.maximum((n_ok - 1) // 2, 0)
+    hi = np.maximum(n_ok // 2, 0)
+    rows = np.arange(w.shape[0])
+
+    med = 0.5 * (ws[rows, lo] + ws[rows, hi])
+    med[n_ok == 0] = np.nan
+
+    return med
 
 
 def _touint8(x):
@@ -148,11 +172,28 @@ def _touint8(x):
     return np.uint8(y)
 
 
+def _pyplot():
+    '''
+    Import pyplot with the non-interactive Agg backend forced
+
+    Deferred until a figure is actually needed, since matplotlib
+    dominates package import time.
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
 def _waitKey(delay=1):
     '''
     Wait for key press and recast return code as human readable string
     '''
 
+    import cv2
+
     keyChar = chr(cv2.waitKey(delay) & 255)
 
     # Decode special keys
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Resample pupilometry and gaze to the MRI volume timebase
+
+Samples are binned into consecutive MRI volumes of MRI.tr seconds starting
+at the trigger onset. MRI.trigger is either a time in seconds on the video
+clock or 'artifact' to use the onset of MR artifact power in the gaze
+pupilometry (see report.ArtifactOnset). MRI.volumes fixes the number of
+volumes (0 : all volumes starting before the last sample).
+
+For each volume the mean and median of pupil area, pupil center and
+calibrated gaze over unblinked samples, the blink fraction and the sample
+count are written to results/gaze_volumes.csv. Binning uses one sorted
+search for the volume boundaries and np.add.reduceat sums, so each run
+costs little more than reading its CSV files.
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import numpy as np
+from mrgaze import calibrate, report
+
+# Per-volume timeseries in column order
+VOLUME_SERIES = ('area', 'px', 'py', 'gx', 'gy')
+
+
+def ResampleToVolumes(ss_dir, cfg):
+    '''
+    Write per-volume pupilometry and gaze for one subject/session
+
+    Arguments
+    ----
+    ss_dir : string
+        Subject/session directory containing results subdir
+    cfg : configuration object
+        MRI timing (tr, trigger, volumes)
+
+    Returns
+    ----
+    success : boolean
+        True if the volume table was written
+    '''
+
+    ss_res_dir = os.path.join(ss_dir, 'results')
+    pupils_csv = os.path.join(ss_res_dir, 'gaze_pupils.csv')
+    gaze_csv = os.path.join(ss_res_dir, 'gaze_calibrated.csv')
+    volumes_csv = os.path.join(ss_res_dir, 'gaze_volumes.csv')
+
+    tr = cfg.getfloat('MRI', 'tr', fallback=0.0)
+    trigger = cfg.get('MRI', 'trigger', fallback='artifact').strip()
+    n_vol = cfg.getint('MRI', 'volumes', fallback=0)
+
+    if tr <= 0.0:
+        print('* MRI TR not set - skipping volume resampling')
+        return False
+
+    if not os.path.isfile(pupils_csv):
+        print('* Gaze pupilometry not found - returning')
+        return False
+
+    # Gaze pupilometry : t, area, px, py, blink, artifact power
+    p = np.loadtxt(pupils_csv, delimiter=',', usecols=range(6), ndmin=2)
+    t = p[:,0]
+
+    if t.shape[0] == 0:
+        print('* Gaze pupilometry is empty - returning')
+        return False
+
+    series = {'area': p[:,1], 'px': p[:,2], 'py': p[:,3]}
+
+    # Calibrated gaze, matched to pupilometry samples by time
+    if os.path.isfile(gaze_csv):
+        g = np.loadtxt(gaze_csv, delimiter=',', usecols=(0, 1, 2), ndmin=2)
+        idx = np.clip(np.searchsorted(g[:,0], t), 0, max(g.shape[0] - 1, 0))
+        series['gx'], series['gy'] = g[idx, 1], g[idx, 2]
+    else:
+        series['gx'] = series['gy'] = np.full(t.shape[0], np.nan)
+
+    if trigger == 'artifact':
+        t0 = report.ArtifactOnset(t, p[:,5])
+        print('  First volume at artifact onset %0.3f s' % t0)
+    else:
+        t0 = float(trigger)
+        print('  First volume at trigger %0.3f s' % t0)
+
+    if n_vol <= 0:
+        n_vol = max(int(np.ceil((t[-1] - t0) / tr)), 0)
+
+    print('  Resampling %d samples to %d volumes (TR %0.3f s)' % (t.shape[0], n_vol, tr))
+
+    vols = VolumeStats(t, series, p[:,4] > 0, t0, tr, n_vol)
+
+    return WriteVolumes(volumes_csv, vols)
+
+
+def VolumeStats(t, series, blink, t0, tr, n_vol):
+    '''
+    Per-volume means, medians and blink fraction
+
+    Arguments
+    ----
+    t : 1D float array
+        Sample times in seconds (ascending)
+    series : dict of 1D float arrays
+        Timeseries to resample, keyed by name
+    blink : 1D boolean array
+        Blink flags (blink samples are excluded from means and medians)
+    t0 : float
+        Start time of the first volume in seconds
+    tr : float
+        Volume repetition time in seconds
+    n_vol : integer
+        Number of volumes
+
+    Returns
+    ----
+    vols : dict of 1D arrays
+        t_start, n_samples, blink_frac and <name>_mean, <name>_median for
+        each series
+    '''
+
+    # Sample index range [start, stop) of each volume
+    edges = t0 + tr * np.arange(n_vol + 1)
+    bounds = np.searchsorted(t, edges)
+    count = np.diff(bounds)
+
+    # reduceat sums between consecutive bounds. The padded sample at n keeps
+    # every bound a valid index, and empty volumes are zeroed.
+    empty = count == 0
+
+    def VolumeSums(v):
+        s = np.add.reduceat(np.append(v, 0.0), bounds)[:-1]
+        s[empty] = 0.0
+        return s
+
+    vols = {
+        't_start'   : edges[:-1],
+        'n_samples' : count,
+    }
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vols['blink_frac'] = VolumeSums(blink.astype(float)) / count
+
+    # Volume of each sample (-1 before the first, n_vol after the last)
+    vol = np.searchsorted(edges, t, side='right') - 1
+    inside = (vol >= 0) & (vol < n_vol)
+
+    for name, v in series.items():
+
+        ok = ~blink & np.isfinite(v)
+        n_ok = VolumeSums(ok.astype(float))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vols[name + '_mean'] = VolumeSums(np.where(ok, v, 0.0)) / n_ok
+
+        sel = ok & inside
+        vols[name + '_median'] = calibrate.GroupedMedian(v[sel], vol[sel], n_vol)
+
+    return vols
+
+
+def WriteVolumes(volumes_csv, vols):
+    '''
+    Write per-volume table with a header row
+    '''
+
+    cols = ['t_start']
+    for name in VOLUME_SERIES:
+        cols += [name + '_mean', name + '_median']
+    cols += ['blink_frac', 'n_samples']
+
+    n_vol = vols['t_start'].shape[0]
+    table = np.column_stack([np.arange(n_vol)] + [vols[c] for c in cols])
+
+    try:
+        np.savetxt(volumes_csv, table, delimiter=',', comments='',
+                   header=','.join(['volume'] + cols),
+                   fmt=['%d', '%0.3f'] + ['%0.3f'] * 2 * len(VOLUME_SERIES) + ['%0.3f', '%d'])
+    except IOError:
+        print('* Problem saving volume table to CSV file - skipping')
+        return False
+
+    return True
+
+
+def ReadVolumes(volumes_csv):
+    '''
+    Read a per-volume table written by WriteVolumes
+
+    Returns
+    ----
+    vols : dict of 1D arrays keyed by column name (empty if missing)
+    '''
+
+    if not os.path.isfile(volumes_csv):
+        return {}
+
+    with open(volumes_csv, 'r') as volumes_stream:
+        cols = volumes_stream.readline().strip().split(',')
+        if not volumes_stream.readline():
+            return dict((c, np.zeros(0)) for c in cols)
+
+    table = np.loadtxt(volumes_csv, delimiter=',', skiprows=1, ndmin=2)
+
+    return dict((c, table[:, i]) for i, c in enumerate(cols))
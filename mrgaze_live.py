@@ -47,8 +47,6 @@ import os
 import datetime as dt
 import argparse
 
-from mrgaze import pupilometry
-
 
 def main():
 
@@ -75,6 +73,9 @@ def main():
     print('Date      : %s' % dt.datetime.now())
     print('Data dir  : %s' % data_dir)
 
+    # Deferred until after argument parsing - loads OpenCV, scipy and skimage
+    from mrgaze import pupilometry
+
     # Run single-session pipeline
     pupilometry.LivePupilometry(data_dir, not args.p)
 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Calibration fixation assignment benchmark
+
+Times nearest-fixation assignment and temporal fixation sorting
+(calibrate.NearestFixation, calibrate.SortFixations) on a synthetic
+calibration timeseries with a square target grid. Results are checked
+against the original per-fixation loop implementations, which are also
+timed for comparison.
+
+Example
+----
+>>> python testing/bench_calibrate.py -n 1000000 -g 5
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+# Run from a source checkout without installing mrgaze
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mrgaze import calibrate
+
+
+def SyntheticCalibration(n_samples, n_grid, seed=0):
+    '''
+    Pupil centers fixating each point of an n_grid x n_grid target grid in turn
+
+    Returns
+    ----
+    t, x, y : float arrays
+        Sample times (s) and pupil centers (pixels)
+    fixations : n_grid**2 x 2 float array
+        Fixation centers in shuffled (non-temporal) order
+    order : integer array
+        Temporal order of the shuffled fixations
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    g = np.linspace(40.0, 120.0, n_grid)
+    gx, gy = np.meshgrid(g, g)
+    centers = np.column_stack((gx.ravel(), gy.ravel()))
+    nf = centers.shape[0]
+
+    # Equal dwell on each target, 30 fps
+    t = np.arange(n_samples) / 30.0
+    k = np.arange(n_samples) * nf // n_samples
+
+    x = centers[k, 0] + rng.normal(0.0, 1.0, n_samples)
+    y = centers[k, 1] + rng.normal(0.0, 1.0, n_samples)
+
+    # Detected fixations are not time ordered
+    perm = rng.permutation(nf)
+    fixations = centers[perm] + rng.normal(0.0, 0.2, (nf, 2))
+
+    return t, x, y, fixations, np.argsort(perm)
+
+
+def NearestFixationLoop(X, fixations):
+    '''
+    Original column-by-column distance matrix implementation
+    '''
+
+    nt = X.shape[0]
+    nf = fixations.shape[0]
+
+    dist2fix = np.zeros((nt, nf))
+
+    for (fix_i, fix) in enumerate(fixations):
+        dx, dy = X[:,0] - fix[0], X[:,1] - fix[1]
+        dist2fix[:, fix_i] = np.sqrt(dx**2 + dy**2)
+
+    return np.argmin(dist2fix, axis=1)
+
+
+def MedianTimesLoop(t, idx, nf):
+    '''
+    Original per-fixation median implementation
+    '''
+
+    t_fix = np.zeros(nf)
+    for fc in np.arange(0,nf):
+        t_fix[fc] = np.median(t[idx==fc])
+
+    return t_fix
+
+
+def Best(func, n_reps):
+    '''
+    Minimum wall time and result over repeated calls
+    '''
+
+    dt = []
+    for rep in range(n_reps):
+        t0 = time.time()
+        res = func()
+        dt.append(time.time() - t0)
+
+    return min(dt), res
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Calibration fixation assignment benchmark')
+    parser.add_argument('-n', '--nsamples', type=int, default=1000000, help='Samples [1000000]')
+    parser.add_argument('-g', '--grid', type=int, default=5, help='Target grid size per side [5]')
+    parser.add_argument('-r', '--nreps', type=int, default=3, help='Repetitions [3]')
+    parser.add_argument('--max_time', type=float, default=0.0,
+                        help='Fail if SortFixations takes longer than this many seconds')
+    args = parser.parse_args()
+
+    t, x, y, fixations, order = SyntheticCalibration(args.nsamples, args.grid)
+    X = np.column_stack((x, y))
+    nf = fixations.shape[0]
+
+    print('')
+    print('  %d samples, %d fixations' % (args.nsamples, nf))
+    print('')
+
+    dt_old, idx_old = Best(lambda: NearestFixationLoop(X, fixations), args.nreps)
+    dt_new, idx_new = Best(lambda: calibrate.NearestFixation(X, fixations), args.nreps)
+    print('  NearestFixation   : %8.1f ms (loop %8.1f ms, %0.1fx)' % (dt_new * 1e3, dt_old * 1e3, dt_old / dt_new))
+
+    dt_old_m, t_old = Best(lambda: MedianTimesLoop(t, idx_old, nf), args.nreps)
+    dt_new_m, t_new = Best(lambda: calibrate.GroupedMedian(t, idx_new, nf), args.nreps)
+    print('  Fixation medians  : %8.1f ms (loop %8.1f ms, %0.1fx)' % (dt_new_m * 1e3, dt_old_m * 1e3, dt_old_m / dt_new_m))
+
+    dt_sort, fix_sorted = Best(lambda: calibrate.SortFixations(t, x, y, fixations), args.nreps)
+    print('  SortFixations     : %8.1f ms' % (dt_sort * 1e3))
+
+    ok = True
+
+    if not np.array_equal(idx_old, idx_new):
+        print('* FAIL : nearest fixation assignments differ')
+        ok = False
+    if not np.allclose(t_old, t_new):
+        print('* FAIL : fixation median times differ')
+        ok = False
+    if not np.array_equal(fix_sorted, fixations[order]):
+        print('* FAIL : fixations not in temporal order')
+        ok = False
+    if args.max_time > 0.0 and dt_sort > args.max_time:
+        print('* FAIL : SortFixations %0.3f s > %0.3f s' % (dt_sort, args.max_time))
+        ok = False
+
+    sys.exit(0 if ok else 1)
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
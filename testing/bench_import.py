@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Import-time benchmark for the mrgaze command line entry scripts
+
+Each entry script is loaded in a fresh interpreter without calling main(),
+so the timing covers interpreter startup plus all module-level imports.
+Heavy optional modules still loaded at startup are listed for each script.
+
+Example
+----
+>>> python testing/bench_import.py -n 10
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# Entry scripts in the repository root
+SCRIPTS = ['mrgaze_single.py', 'mrgaze_batch.py', 'mrgaze_live.py']
+
+# Modules that should only be loaded by the stage that needs them
+HEAVY = ['matplotlib', 'pylab', 'skimage', 'scipy.ndimage', 'scipy.stats',
+         'scipy.signal', 'pywt']
+
+# Loader run in the child interpreter - runpy skips the __main__ block
+LOADER = """
+import sys, time, json, runpy
+t0 = time.time()
+runpy.run_path(sys.argv[1], run_name='mrgaze_bench')
+dt = time.time() - t0
+heavy = [m for m in json.loads(sys.argv[2]) if m in sys.modules]
+print(json.dumps({'t': dt, 'heavy': heavy}))
+"""
+
+
+def TimeScript(script, n_reps):
+    '''
+    Time module-level imports of an entry script over repeated fresh runs
+
+    Returns
+    ----
+    t_import : float array
+        Import times in seconds for each repetition
+    t_total : float array
+        Wall time including interpreter startup for each repetition
+    heavy : list of strings
+        Heavy modules present after import
+    '''
+
+    t_import, t_total = [], []
+    heavy = []
+
+    for rep in range(n_reps):
+
+        t0 = time.time()
+        out = subprocess.check_output(
+            [sys.executable, '-c', LOADER, script, json.dumps(HEAVY)])
+        t_total.append(time.time() - t0)
+
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        t_import.append(res['t'])
+        heavy = res['heavy']
+
+    return np.array(t_import), np.array(t_total), heavy
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark entry script import time')
+    parser.add_argument('-n', '--nreps', type=int, default=5, help='Repetitions per script [5]')
+    parser.add_argument('--max_import', type=float, default=0.0,
+                        help='Fail if any median import time exceeds this many seconds')
+    args = parser.parse_args()
+
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    print('')
+    print('  %-18s %12s %12s   %s' % ('Script', 'Import (ms)', 'Total (ms)', 'Heavy modules loaded'))
+
+    ok = True
+
+    for script in SCRIPTS:
+
+        t_import, t_total, heavy = TimeScript(os.path.join(root_dir, script), args.nreps)
+
+        t_imp_med = np.median(t_import)
+
+        print('  %-18s %12.1f %12.1f   %s' % (
+            script, t_imp_med * 1e3, np.median(t_total) * 1e3, ', '.join(heavy) or 'none'))
+
+        if heavy:
+            ok = False
+
+        if args.max_import > 0.0 and t_imp_med > args.max_import:
+            ok = False
+
+    sys.exit(0 if ok else 1)
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
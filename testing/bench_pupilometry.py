@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+End-to-end VideoPupilometry benchmark on synthetic eye video
+
+Renders a synthetic eye video with known pupil trajectory, glint, blinks and
+MR scanline artifacts (see mrgaze.synthetic), runs VideoPupilometry on it
+with per-stage timing enabled and reports throughput, stage timings and
+pupil center and area errors against ground truth.
+
+Pass any of the --min_fps, --max_center_err, --max_area_err or
+--max_blink_err limits to use the benchmark as a regression gate. The exit
+status is 1 if any limit is exceeded.
+
+Example
+----
+>>> python testing/bench_pupilometry.py -n 900 --max_center_err 1.5 --max_blink_err 0.2
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import configparser
+import numpy as np
+
+# Run from a source checkout without installing mrgaze
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mrgaze import config, synthetic, pupilometry, engine
+
+
+def BenchConfig(use_cascade=False):
+    '''
+    Default config for headless benchmarking
+    '''
+
+    cfg = config.InitConfig(configparser.ConfigParser())
+
+    cfg.set('OUTPUT', 'verbose', 'False')
+    cfg.set('OUTPUT', 'graphics', 'False')
+    cfg.set('OUTPUT', 'metrics', 'True')
+    cfg.set('OUTPUT', 'checkpointinterval', '0')
+
+    # Synthetic eye is not what the LBP cascades were trained on,
+    # so use a fixed ROI covering the eye opening by default
+    if not use_cascade:
+        cfg.set('PUPILDETECT', 'enabled', 'False')
+        cfg.set('PUPILDETECT', 'manualroi', '[0.5, 0.5, 0.6]')
+
+    return cfg
+
+
+def Accuracy(p, gt):
+    '''
+    Pupilometry errors against ground truth
+
+    Pupil area is reported by the engine in arbitrary units, so area
+    errors are measured after normalizing by the median area ratio.
+    '''
+
+    n = min(p.shape[0], gt.shape[0])
+    p, gt = p[:n, :], gt[:n, :]
+
+    gt_blink = gt[:, 7] > 0
+    blink = p[:, 4] > 0
+
+    # Frames where pupil is visible and was found
+    ok = ~gt_blink & ~blink
+
+    err = {'frames': n}
+
+    if ok.sum() > 0:
+
+        d = np.hypot(p[ok, 2] - gt[ok, 1], p[ok, 3] - gt[ok, 2])
+        err['center_err_median'] = float(np.median(d))
+        err['center_err_p95'] = float(np.percentile(d, 95))
+
+        ratio = p[ok, 1] / gt[ok, 6]
+        scale = np.median(ratio)
+        rel = np.abs(ratio / scale - 1.0)
+        err['area_scale'] = float(scale)
+        err['area_err_median'] = float(np.median(rel))
+        err['area_err_p95'] = float(np.percentile(rel, 95))
+
+    else:
+
+        err['center_err_median'] = err['center_err_p95'] = float('inf')
+        err['area_scale'] = float('nan')
+        err['area_err_median'] = err['area_err_p95'] = float('inf')
+
+    # Blink detection errors
+    err['blink_missed'] = float(np.mean(~blink[gt_blink])) if gt_blink.any() else 0.0
+    err['blink_false'] = float(np.mean(blink[~gt_blink])) if (~gt_blink).any() else 0.0
+
+    return err
+
+
+def RunBenchmark(work_dir, n_frames, seed, use_cascade):
+    '''
+    Render synthetic session, run VideoPupilometry and collect results
+    '''
+
+    subj_sess = 'synthetic'
+    vid_dir = os.path.join(work_dir, subj_sess, 'videos')
+    res_dir = os.path.join(work_dir, subj_sess, 'results')
+    os.makedirs(vid_dir, exist_ok=True)
+    os.makedirs(res_dir, exist_ok=True)
+
+    print('  Rendering %d synthetic frames' % n_frames)
+    gt_csv = os.path.join(vid_dir, 'gaze_truth.csv')
+    gt = synthetic.EyeVideo(os.path.join(vid_dir, 'gaze.avi'), gt_csv,
+                            n_frames=n_frames, seed=seed)
+
+    cfg = BenchConfig(use_cascade)
+
+    print('  Running VideoPupilometry')
+    t0 = time.time()
+    pupilometry.VideoPupilometry(work_dir, subj_sess, 'gaze', cfg)
+    t_wall = time.time() - t0
+
+    p = engine.ReadPupilometry(os.path.join(res_dir, 'gaze_pupils.csv'))
+
+    with open(os.path.join(res_dir, 'gaze_metrics.json'), 'r') as f:
+        timing = json.load(f)
+
+    res = Accuracy(p, gt)
+    res['wall_s'] = t_wall
+    res['fps'] = timing['fps']
+    res['stages'] = dict((k, dict((m, v[m]) for m in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')))
+                         for k, v in timing['stages'].items())
+
+    return res
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Synthetic video pupilometry benchmark')
+    parser.add_argument('-n', '--nframes', type=int, default=900, help='Frames to render [900]')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed [0]')
+    parser.add_argument('-o', '--outdir', default='', help='Keep benchmark session in this directory')
+    parser.add_argument('-j', '--json', default='', help='Write results to JSON file')
+    parser.add_argument('--cascade', action='store_true', help='Use LBP cascade pupil detection')
+    parser.add_argument('--min_fps', type=float, default=0.0)
+    parser.add_argument('--max_center_err', type=float, default=0.0, help='Median center error limit (pixels)')
+    parser.add_argument('--max_area_err', type=float, default=0.0, help='Median relative area error limit')
+    parser.add_argument('--max_blink_err', type=float, default=0.0, help='Missed + false blink fraction limit')
+    args = parser.parse_args()
+
+    work_dir = args.outdir if args.outdir else tempfile.mkdtemp(prefix='mrgaze_bench_')
+
+    try:
+        res = RunBenchmark(work_dir, args.nframes, args.seed, args.cascade)
+    finally:
+        if not args.outdir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print('')
+    print('  Throughput          : %0.1f frames/s (%0.1f s wall)' % (res['fps'], res['wall_s']))
+    print('  Center error        : %0.2f median, %0.2f p95 (pixels)' % (res['center_err_median'], res['center_err_p95']))
+    print('  Area error          : %0.3f median, %0.3f p95 (relative, scale %0.2f)' % (
+        res['area_err_median'], res['area_err_p95'], res['area_scale']))
+    print('  Blinks missed/false : %0.3f / %0.3f' % (res['blink_missed'], res['blink_false']))
+    print('')
+    print('  %-10s %10s %10s %10s %10s' % ('Stage', 'Mean (ms)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for stage in sorted(res['stages']):
+        s = res['stages'][stage]
+        print('  %-10s %10.3f %10.3f %10.3f %10.3f' % (stage, s['mean_ms'], s['p50_ms'], s['p95_ms'], s['p99_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(res, f, indent=2)
+
+    # Regression gate
+    fail = []
+    if args.min_fps > 0.0 and res['fps'] < args.min_fps:
+        fail.append('throughput %0.1f < %0.1f frames/s' % (res['fps'], args.min_fps))
+    if args.max_center_err > 0.0 and res['center_err_median'] > args.max_center_err:
+        fail.append('center error %0.2f > %0.2f' % (res['center_err_median'], args.max_center_err))
+    if args.max_area_err > 0.0 and res['area_err_median'] > args.max_area_err:
+        fail.append('area error %0.3f > %0.3f' % (res['area_err_median'], args.max_area_err))
+    if args.max_blink_err > 0.0 and res['blink_missed'] + res['blink_false'] > args.max_blink_err:
+        fail.append('blink error %0.3f > %0.3f' % (res['blink_missed'] + res['blink_false'], args.max_blink_err))
+
+    print('')
+    for msg in fail:
+        print('* FAIL : %s' % msg)
+
+    sys.exit(1 if fail else 0)
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
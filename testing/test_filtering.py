@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Check that chunked pupilometry filtering does not depend on the chunk size
+
+Writes a synthetic pupilometry CSV with a leading gap, blinks and missing
+fits, filters it with FilterPupilometry (median, blink interpolation and
+low-pass) in chunks of 1, 7 and 65536 rows and compares the outputs.
+The exit status is 1 if any output differs from the single chunk result.
+
+Example
+----
+>>> python testing/test_filtering.py
+
+This file is part of mrgaze.
+
+    mrgaze is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    mrgaze is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with mrgaze.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright 2016 California Institute of Technology.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import configparser
+import numpy as np
+
+# Run from a source checkout without installing mrgaze
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mrgaze import config, filtering
+
+
+def SyntheticPupils(pupils_csv, n=600, fps=30.0, seed=0):
+    '''
+    Write a pupilometry CSV with a leading gap, blinks and missing fits
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    t = np.arange(n) / fps
+    area = 100.0 + 5.0 * np.sin(t) + rng.normal(0.0, 1.0, n)
+    px = 160.0 + 20.0 * np.sin(0.7 * t) + rng.normal(0.0, 0.5, n)
+    py = 120.0 + 10.0 * np.cos(0.5 * t) + rng.normal(0.0, 0.5, n)
+    blink = np.zeros(n)
+    art = np.abs(rng.normal(0.0, 0.1, n))
+
+    # Leading gap longer than maxgap, a short blink and a long missing run
+    area[:30] = px[:30] = py[:30] = np.nan
+    blink[200:206] = 1
+    area[400:440] = px[400:440] = py[400:440] = np.nan
+
+    np.savetxt(pupils_csv, np.array((t, area, px, py, blink, art)).T,
+               fmt=filtering.FILT_FORMAT)
+
+
+def main():
+
+    cfg = config.InitConfig(configparser.ConfigParser())
+    cfg.set('FILTER', 'lowpass', '4.0')
+
+    work_dir = tempfile.mkdtemp(prefix='mrgaze_filt_')
+
+    try:
+
+        pupils_csv = os.path.join(work_dir, 'gaze_pupils.csv')
+        SyntheticPupils(pupils_csv)
+
+        results = {}
+
+        for chunk in (65536, 7, 1):
+            filt_csv = os.path.join(work_dir, 'gaze_pupils_filt_%d.csv' % chunk)
+            filtering.FilterPupilometry(pupils_csv, filt_csv, cfg, chunk=chunk)
+            results[chunk] = np.loadtxt(filt_csv, delimiter=',', usecols=range(6), ndmin=2)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    ref = results[65536]
+    failed = False
+
+    for chunk in (7, 1):
+        p = results[chunk]
+        same = p.shape == ref.shape and np.allclose(p, ref, atol=1e-3, equal_nan=True)
+        err = np.nanmax(np.abs(p - ref)) if p.shape == ref.shape else np.inf
+        print('  chunk %5d : max difference %0.4f %s' % (chunk, err, 'OK' if same else 'FAIL'))
+        failed = failed or not same
+
+    sys.exit(1 if failed else 0)
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()